@@ -1,6 +1,5 @@
 import util
 from database import Database
-import threading
 from typing import List
 
 
@@ -12,7 +11,7 @@ def run(database: Database, key: str, params, input_format, output_format, offse
   num_files = int((content_length + split_size - 1) / split_size)
   file_id = 1
 
-  threads = []
+  payloads = []
   token = "{0:f}-{1:d}".format(output_format["timestamp"], output_format["nonce"])
   while file_id <= num_files:
     offsets = [(file_id - 1) * split_size, min(content_length, (file_id) * split_size) - 1]
@@ -25,10 +24,8 @@ def run(database: Database, key: str, params, input_format, output_format, offse
     payload = database.create_payload(params["bucket"], util.file_name(input_format), extra_params)
     payload["log"] = [token, output_format["prefix"], output_format["bin"], output_format["num_bins"], file_id, num_files]
 
-    threads.append(threading.Thread(target=database.invoke, args=(params["output_function"], payload)))
-    threads[-1].start()
+    payloads.append(payload)
     file_id += 1
 
-  for thread in threads:
-    thread.join()
+  database.invoke_many(params["output_function"], payloads)
   return []
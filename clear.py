@@ -1,21 +1,25 @@
 import argparse
-import boto3
+from database import S3
 
 
-def clear(bucket_name, token=None, prefix=None):
-  s3 = boto3.resource("s3")
-  bucket = s3.Bucket(bucket_name)
+def clear(bucket_name, token=None, prefix=None, key_layout=None):
+  database = S3({"key_layout": key_layout} if key_layout else {})
   if prefix is None and token is None:
-    bucket.objects.all().delete()
+    keys = list(map(lambda entry: entry.key, database.iterate_entries(bucket_name)))
   elif prefix is None and token is not None:
-    objects = list(bucket.objects.all())
-    objects = list(filter(lambda o: token == o.key.split("/")[1], objects))
-    for obj in objects:
-      s3.Object(bucket_name, obj.key).delete()
+    keys = database.get_run_keys(bucket_name, token)
+    database.coordinator.clear(bucket_name, "{0:s}/{1:s}".format(database.manifest_prefix, token))
   elif prefix is not None and token is None:
-    bucket.objects.filter(Prefix=str(prefix)).delete()
+    stage_prefix = str(prefix) + "/"
+    if key_layout == "token" and prefix != 0:
+      # Stages are spread over every run in the token layout, so the whole bucket is listed
+      entries = filter(lambda entry: entry.key.startswith(stage_prefix), database.iterate_entries(bucket_name))
+    else:
+      entries = database.iterate_entries(bucket_name, stage_prefix)
+    keys = list(map(lambda entry: entry.key, entries))
   else:
-    bucket.objects.filter(Prefix=str(prefix) + "/" + token).delete()
+    keys = database.get_run_keys(bucket_name, token, [prefix])
+  database.delete(bucket_name, keys)
 
 
 def main():
@@ -23,8 +27,9 @@ def main():
   parser.add_argument("--bucket_name", type=str, required=True, help="Bucket to clear")
   parser.add_argument("--token", type=str, default=None, help="Only delete objects with the specified timestamp / nonce pair")
   parser.add_argument("--prefix", type=int, default=None, help="Only delete objects with the specified prefix")
+  parser.add_argument("--key_layout", type=str, default=None, help="Key layout of the pipeline that wrote the objects")
   args = parser.parse_args()
-  clear(args.bucket_name, args.token, args.prefix)
+  clear(args.bucket_name, args.token, args.prefix, args.key_layout)
 
 
 if __name__ == "__main__":
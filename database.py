@@ -1,25 +1,114 @@
+import asyncio
+import base64
+import bisect
 import boto3
 import botocore
+import collections
+import fcntl
+import hashlib
+import io
+import itertools
 import json
+import lzma
+import mmap
 import os
 import random
+import re
+import shutil
+import struct
+import threading
 import time
-from typing import Any, BinaryIO, Dict, List, Optional, Union
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 
 class Statistics:
+  # Counters are sharded per thread. Each thread only updates its own shard,
+  # so updates don't need a lock, and reading a counter sums the shards.
+  counters: List[str] = [
+    "background_io_time",
+    "cache_hit_count",
+    "cache_miss_count",
+    "delete_count",
+    "invoke_count",
+    "invoke_throttle_count",
+    "io_time",
+    "list_count",
+    "read_byte_count",
+    "read_count",
+    "retry_count",
+    "throttle_count",
+    "write_byte_count",
+    "write_count",
+  ]
+  # Upper bounds in seconds of the latency histogram buckets. The last bucket counts anything slower.
+  latency_bounds: List[float] = [0.001 * 2 ** i for i in range(15)]
+  background_io_time: float
+  cache_hit_count: int
+  cache_miss_count: int
+  delete_count: int
+  invoke_count: int
+  invoke_latencies: List[float]
+  invoke_throttle_count: int
+  io_time: float
   list_count: int
   read_byte_count: int
   read_count: int
+  retry_count: int
+  start_time: float
+  throttle_count: int
+  throttle_wait_times: List[float]
   write_byte_count: int
   write_count: int
 
   def __init__(self):
-    self.list_count = 0
-    self.read_byte_count = 0
-    self.read_count = 0
-    self.write_byte_count = 0
-    self.write_count = 0
+    self.invoke_latencies = []
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.shards: List[Dict[str, Any]] = []
+    self.start_time = time.time()
+    self.throttle_wait_times = []
+
+  def __getattr__(self, name: str) -> Any:
+    if name not in Statistics.counters:
+      raise AttributeError(name)
+    return sum(map(lambda shard: shard[name], list(self.shards)))
+
+  def __shard__(self) -> Dict[str, Any]:
+    if not hasattr(self.local, "shard"):
+      self.local.shard = {**dict.fromkeys(self.counters, 0), "latency_histograms": {}}
+      with self.lock:
+        self.shards.append(self.local.shard)
+    return self.local.shard
+
+  def add(self, counter: str, value: Union[int, float] = 1):
+    self.__shard__()[counter] += value
+
+  @property
+  def latency_histograms(self) -> Dict[str, List[int]]:
+    histograms: Dict[str, List[int]] = {}
+    for shard in list(self.shards):
+      for [operation, histogram] in list(shard["latency_histograms"].items()):
+        if operation not in histograms:
+          histograms[operation] = [0] * len(histogram)
+        histograms[operation] = list(map(sum, zip(histograms[operation], histogram)))
+    return histograms
+
+  def record(self, operation: str, start_time: float):
+    # I/O on the main thread blocks the stage, I/O on other threads (prefetching, uploads) overlaps with it
+    latency: float = time.time() - start_time
+    shard: Dict[str, Any] = self.__shard__()
+    if operation not in shard["latency_histograms"]:
+      shard["latency_histograms"][operation] = [0] * (len(self.latency_bounds) + 1)
+    shard["latency_histograms"][operation][bisect.bisect_left(self.latency_bounds, latency)] += 1
+    if threading.current_thread() is threading.main_thread():
+      shard["io_time"] += latency
+    else:
+      shard["background_io_time"] += latency
+
+  def user_time(self) -> float:
+    return max(time.time() - self.start_time - self.io_time, 0.0)
 
   def calculate_total_cost(self) -> float:
     list_cost: float = (self.list_count / 1000.0) * 0.005
@@ -33,55 +122,853 @@ class Statistics:
     return total_cost
 
 
+class TokenBucket:
+  # Allows bursts of up to capacity requests and refills at rate requests per second.
+  # The rate is halved when a request is throttled and recovers additively on success.
+  capacity: float
+  max_rate: float
+  min_rate: float
+  rate: float
+
+  def __init__(self, rate: float, capacity: float, min_rate: float):
+    self.backoff = 0.0
+    self.blocked_until = 0.0
+    self.capacity = capacity
+    self.lock = threading.Lock()
+    self.max_rate = rate
+    self.min_rate = min_rate
+    self.rate = rate
+    self.tokens = capacity
+    self.updated = time.time()
+
+  def acquire(self) -> float:
+    waited: float = 0.0
+    while True:
+      with self.lock:
+        now: float = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait: float = max(self.blocked_until - now, 0.0)
+        if wait == 0.0:
+          if self.tokens >= 1:
+            self.tokens -= 1
+            return waited
+          wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+      waited += wait
+
+  def succeeded(self):
+    with self.lock:
+      self.backoff = 0.0
+      self.rate = min(self.max_rate, self.rate + self.max_rate / 100.0)
+
+  def throttled(self, max_backoff: float):
+    with self.lock:
+      self.rate = max(self.min_rate, self.rate / 2)
+      self.tokens = min(self.tokens, 0.0)
+      self.backoff = min(max(2 * self.backoff, 0.05), max_backoff)
+      # Full jitter so concurrent callers don't retry in lockstep
+      self.blocked_until = max(self.blocked_until, time.time() + random.uniform(0, self.backoff))
+
+
+class RateLimiter:
+  # Keeps a token bucket per operation and key prefix, so throttling on one prefix
+  # doesn't slow down requests to the others.
+  max_backoff: float = 5.0
+  min_rate: float = 1.0
+  prefix_depth: int = 2
+  # Per prefix request rates documented for S3
+  rates: Dict[str, float] = {"get": 5500.0, "list": 5500.0, "put": 3500.0}
+
+  def __init__(self, statistics: "Statistics", is_throttled: Callable[[Exception], bool]):
+    self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+    self.is_throttled = is_throttled
+    self.lock = threading.Lock()
+    self.statistics = statistics
+
+  def __bucket__(self, operation: str, key: str) -> TokenBucket:
+    prefix: str = "/".join(key.split("/")[:self.prefix_depth])
+    with self.lock:
+      if (operation, prefix) not in self.buckets:
+        rate: float = self.rates[operation]
+        self.buckets[(operation, prefix)] = TokenBucket(rate, rate, self.min_rate)
+      return self.buckets[(operation, prefix)]
+
+  def call(self, operation: str, key: str, function: Callable[[], Any]) -> Any:
+    bucket: TokenBucket = self.__bucket__(operation, key)
+    throttled: bool = False
+    waited: float = 0.0
+    while True:
+      waited += bucket.acquire()
+      try:
+        result = function()
+        bucket.succeeded()
+        if throttled:
+          self.statistics.throttle_wait_times.append(waited)
+        return result
+      except Exception as e:
+        if not self.is_throttled(e):
+          raise e
+        print("Warning: {0:s} {1:s} rate limited".format(operation, key))
+        throttled = True
+        self.statistics.add("retry_count")
+        self.statistics.add("throttle_count")
+        bucket.throttled(self.max_backoff)
+
+
+class BlockCache:
+  # Caches byte ranges of entries in fixed size blocks. Recently used blocks are kept in memory.
+  # Blocks evicted from memory are spilled to disk if disk_size is non-zero.
+  block_size: int
+  directory: str
+  disk_size: int
+  memory_size: int
+
+  def __init__(self, block_size: int, memory_size: int, disk_size: int = 0, directory: str = "/tmp/block_cache"):
+    assert(block_size > 0)
+    self.block_size = block_size
+    self.directory = directory
+    self.disk_byte_count = 0
+    self.disk_blocks: collections.OrderedDict = collections.OrderedDict()
+    self.disk_size = disk_size
+    self.lock = threading.Lock()
+    self.memory_blocks: collections.OrderedDict = collections.OrderedDict()
+    self.memory_byte_count = 0
+    self.memory_size = memory_size
+    if self.disk_size > 0 and not os.path.isdir(self.directory):
+      os.makedirs(self.directory, exist_ok=True)
+
+  def __block_path__(self, block_id: Tuple[str, int]) -> str:
+    name: str = hashlib.sha1(block_id[0].encode("utf-8")).hexdigest()
+    return "{0:s}/{1:s}-{2:d}".format(self.directory, name, block_id[1])
+
+  def __evict__(self):
+    while self.memory_byte_count > self.memory_size and len(self.memory_blocks) > 0:
+      [block_id, block] = self.memory_blocks.popitem(last=False)
+      self.memory_byte_count -= len(block)
+      if len(block) <= self.disk_size:
+        self.__spill__(block_id, block)
+
+    while self.disk_byte_count > self.disk_size and len(self.disk_blocks) > 0:
+      [block_id, length] = self.disk_blocks.popitem(last=False)
+      self.disk_byte_count -= length
+      os.remove(self.__block_path__(block_id))
+
+  def __lookup__(self, block_id: Tuple[str, int]) -> Optional[bytes]:
+    with self.lock:
+      if block_id in self.memory_blocks:
+        self.memory_blocks.move_to_end(block_id)
+        return self.memory_blocks[block_id]
+      if block_id not in self.disk_blocks:
+        return None
+      length: int = self.disk_blocks.pop(block_id)
+      self.disk_byte_count -= length
+      with open(self.__block_path__(block_id), "rb") as f:
+        block: bytes = f.read()
+      os.remove(self.__block_path__(block_id))
+      self.__store__(block_id, block)
+      return block
+
+  def __spill__(self, block_id: Tuple[str, int], block: bytes):
+    with open(self.__block_path__(block_id), "wb+") as f:
+      f.write(block)
+    self.disk_blocks[block_id] = len(block)
+    self.disk_byte_count += len(block)
+
+  def __store__(self, block_id: Tuple[str, int], block: bytes):
+    if block_id in self.memory_blocks:
+      self.memory_byte_count -= len(self.memory_blocks[block_id])
+    self.memory_blocks[block_id] = block
+    self.memory_blocks.move_to_end(block_id)
+    self.memory_byte_count += len(block)
+    self.__evict__()
+
+  def get_range(self, entry: "Entry", start_index: int, end_index: int) -> bytes:
+    name: str = entry.cache_key()
+    first_block: int = int(start_index / self.block_size)
+    last_block: int = int(end_index / self.block_size)
+    blocks: Dict[int, bytes] = {}
+    missing: List[int] = []
+    for block_index in range(first_block, last_block + 1):
+      block: Optional[bytes] = self.__lookup__((name, block_index))
+      if block is None:
+        missing.append(block_index)
+      else:
+        blocks[block_index] = block
+
+    entry.statistics.add("cache_hit_count", len(blocks))
+    entry.statistics.add("cache_miss_count", len(missing))
+
+    # Fetch each run of consecutive missing blocks with one request
+    i: int = 0
+    while i < len(missing):
+      j: int = i
+      while j + 1 < len(missing) and missing[j + 1] == missing[j] + 1:
+        j += 1
+      entry.statistics.add("read_count")
+      start_time: float = time.time()
+      content: bytes = entry.__get_range__(missing[i] * self.block_size, (missing[j] + 1) * self.block_size - 1)
+      entry.statistics.record("get", start_time)
+      entry.statistics.add("read_byte_count", len(content))
+      for block_index in range(missing[i], missing[j] + 1):
+        offset: int = (block_index - missing[i]) * self.block_size
+        blocks[block_index] = content[offset:offset + self.block_size]
+        with self.lock:
+          self.__store__((name, block_index), blocks[block_index])
+      i = j + 1
+
+    content = b"".join(map(lambda block_index: blocks[block_index], range(first_block, last_block + 1)))
+    offset = first_block * self.block_size
+    return content[start_index - offset:end_index - offset + 1]
+
+  def invalidate(self, name: str):
+    with self.lock:
+      for block_id in list(self.memory_blocks.keys()):
+        if block_id[0] == name:
+          self.memory_byte_count -= len(self.memory_blocks.pop(block_id))
+      for block_id in list(self.disk_blocks.keys()):
+        if block_id[0] == name:
+          self.disk_byte_count -= self.disk_blocks.pop(block_id)
+          os.remove(self.__block_path__(block_id))
+
+
+class Codec:
+  # Compresses content as independently compressed frames of frame_size bytes, followed by a
+  # footer with the compressed end offset of each frame, the uncompressed length and the frame count.
+  # A byte range is read by fetching and decompressing only the frames that overlap it.
+  codecs: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    "lzma": (lzma.compress, lzma.decompress),
+    "zlib": (zlib.compress, zlib.decompress),
+  }
+  footer_format: str = ">QQ"
+  footer_size: int = 16
+  frame_size: int
+  metadata_keys: List[str] = ["codec", "frame_size"]
+  name: str
+
+  def __init__(self, name: str, frame_size: int = 1000*1000):
+    if name not in self.codecs:
+      raise Exception("Codec {0:s} not supported".format(name))
+    self.frame_size = frame_size
+    self.name = name
+
+  def compress(self, frame: bytes) -> bytes:
+    return self.codecs[self.name][0](frame)
+
+  def decompress(self, frame: bytes) -> bytes:
+    return self.codecs[self.name][1](frame)
+
+  def encode(self, content: bytes) -> bytes:
+    frames: List[bytes] = list(map(lambda i: self.compress(content[i:i + self.frame_size]), range(0, len(content), self.frame_size)))
+    ends: List[int] = list(itertools.accumulate(map(len, frames)))
+    return b"".join(frames) + self.footer(ends, len(content))
+
+  def footer(self, ends: List[int], length: int) -> bytes:
+    return struct.pack(">{0:d}Q".format(len(ends)), *ends) + struct.pack(self.footer_format, length, len(ends))
+
+  def get_metadata(self) -> Dict[str, str]:
+    return {"codec": self.name, "frame_size": str(self.frame_size)}
+
+
+class FrameIndex:
+  codec: Codec
+  ends: List[int]
+  length: int
+
+  def __init__(self, codec: Codec, ends: List[int], length: int):
+    self.codec = codec
+    self.ends = ends
+    self.length = length
+
+  def get_range(self, entry: "Entry", start_index: int, end_index: int) -> bytes:
+    end_index = min(end_index, self.length - 1)
+    if start_index > end_index:
+      return b""
+    frame_size: int = self.codec.frame_size
+    first_frame: int = int(start_index / frame_size)
+    last_frame: int = int(end_index / frame_size)
+    starts: List[int] = [0] + self.ends[:-1]
+    offset: int = starts[first_frame]
+    content: bytes = entry.__read__(offset, self.ends[last_frame] - 1)
+    frames: List[bytes] = list(map(lambda i: self.codec.decompress(content[starts[i] - offset:self.ends[i] - offset]), range(first_frame, last_frame + 1)))
+    content = b"".join(frames)
+    offset = first_frame * frame_size
+    return content[start_index - offset:end_index - offset + 1]
+
+
+class RangePlan:
+  # Ranges that were declared ahead of time and are fetched together with one request.
+  # The content is kept until every byte of the declared ranges has been read.
+  content: Optional[bytes]
+  end_index: int
+  pending: List[Tuple[int, int]]
+  start_index: int
+
+  def __init__(self, start_index: int, end_index: int):
+    self.content = None
+    self.end_index = end_index
+    self.lock = threading.Lock()
+    self.pending = []
+    self.start_index = start_index
+
+  def add(self, start_index: int, end_index: int):
+    self.start_index = min(self.start_index, start_index)
+    self.end_index = max(self.end_index, end_index)
+    self.pending.append((start_index, end_index))
+
+  def consume(self, start_index: int, end_index: int):
+    # Removes the range that was read from the pending ranges
+    pending: List[Tuple[int, int]] = []
+    for [s, e] in self.pending:
+      if e < start_index or end_index < s:
+        pending.append((s, e))
+        continue
+      if s < start_index:
+        pending.append((s, start_index - 1))
+      if end_index < e:
+        pending.append((end_index + 1, e))
+    self.pending = pending
+
+  def contains(self, start_index: int, end_index: int) -> bool:
+    return self.start_index <= start_index and end_index <= self.end_index
+
+
 class Entry:
+  cache: Optional[BlockCache]
+  download_concurrency: int = 8
+  download_part_size: int = 8*1024*1024
+  frame_index: Optional[FrameIndex]
   key: str
+  # Planned ranges are merged if the gap between them is at most range_gap_size,
+  # as long as the merged range doesn't grow beyond max_plan_size.
+  max_plan_size: int = 16*1024*1024
+  plans: List[RangePlan]
+  range_gap_size: int = 64*1024
   resources: Any
   statistics: Optional[Statistics]
 
-  def __init__(self, key: str, resources: Any, statistics: Optional[Statistics]):
+  def __init__(self, key: str, resources: Any, statistics: Optional[Statistics], cache: Optional[BlockCache]=None):
+    self.cache = cache
+    self.frame_index = None
+    self.frame_index_loaded = False
     self.key = key
+    self.plan_lock = threading.Lock()
+    self.plans = []
     self.resources = resources
     self.statistics = statistics
 
+  def __content_length__(self) -> int:
+    raise Exception("Entry::__content_length__ not implemented")
+
   def __download__(self, f: BinaryIO) -> int:
     raise Exception("Entry::__download__ not implemented")
 
+  def __download_range__(self, fd: int, offset: int, start_index: int, end_index: int) -> int:
+    count = 0
+    while True:
+      self.statistics.add("read_count")
+      start_time: float = time.time()
+      try:
+        content: bytes = self.__get_range__(start_index, end_index)
+        self.statistics.record("get", start_time)
+        self.statistics.add("read_byte_count", len(content))
+        if len(content) != end_index - start_index + 1:
+          raise Exception("Entry::download expected {0:d} bytes for range {1:d}-{2:d} but received {3:d}".format(end_index - start_index + 1, start_index, end_index, len(content)))
+        os.pwrite(fd, content, offset + start_index)
+        return len(content)
+      except Exception as e:
+        count += 1
+        if count == 3:
+          raise e
+        self.statistics.add("retry_count")
+
+  def __download_ranges__(self, f: BinaryIO, content_length: int) -> int:
+    # Preallocates the file and fills it with byte ranges fetched in parallel.
+    # A failed range is retried on its own, so completed ranges aren't downloaded again.
+    f.flush()
+    offset: int = f.tell()
+    fd: int = f.fileno()
+    os.ftruncate(fd, offset + content_length)
+    ranges: List[Tuple[int, int]] = list(map(lambda start_index: (start_index, min(start_index + self.download_part_size, content_length) - 1), range(0, content_length, self.download_part_size)))
+    start_time: float = time.time()
+    with ThreadPoolExecutor(max_workers=min(self.download_concurrency, len(ranges))) as executor:
+      byte_count: int = sum(executor.map(lambda r: self.__download_range__(fd, offset, r[0], r[1]), ranges))
+    # The ranges were fetched on worker threads, but the caller was blocked waiting on them
+    self.statistics.add("io_time", time.time() - start_time)
+    if byte_count != content_length or os.fstat(fd).st_size != offset + content_length:
+      raise Exception("Entry::download expected {0:d} bytes but received {1:d}".format(content_length, byte_count))
+    f.seek(offset + content_length)
+    return content_length
+
   def __get_content__(self) -> bytes:
     raise Exception("Entry::__get_content__ not implemented")
 
+  def __get_index__(self) -> Optional[bytes]:
+    # Entries that aren't stored in a database don't have an item index
+    return None
+
   def __get_range__(self, start_index: int, end_index: int) -> bytes:
     raise Exception("Entry::get_range not implemented")
 
+  def cache_key(self) -> str:
+    return self.key
+
+  def __get_frame_index__(self) -> Optional[FrameIndex]:
+    # Compressed objects are stored with the codec in their metadata and a frame index at the end
+    if not self.frame_index_loaded:
+      metadata: Dict[str, str] = self.get_metadata()
+      if "codec" in metadata:
+        codec: Codec = Codec(metadata["codec"], int(metadata["frame_size"]))
+        stored_length: int = self.__content_length__()
+        footer: bytes = self.__read__(stored_length - Codec.footer_size, stored_length - 1)
+        [length, frame_count] = struct.unpack(Codec.footer_format, footer)
+        index_start: int = stored_length - Codec.footer_size - 8 * frame_count
+        index: bytes = self.__read__(index_start, stored_length - Codec.footer_size - 1) if frame_count > 0 else b""
+        self.frame_index = FrameIndex(codec, list(struct.unpack(">{0:d}Q".format(frame_count), index)), length)
+      self.frame_index_loaded = True
+    return self.frame_index
+
+  async def aget_content(self) -> bytes:
+    return await asyncio.get_event_loop().run_in_executor(None, self.get_content)
+
+  async def aget_range(self, start_index: int, end_index: int) -> bytes:
+    return await asyncio.get_event_loop().run_in_executor(None, self.get_range, start_index, end_index)
+
+  async def aload(self) -> "MemoryEntry":
+    # Reads the content into an entry that's served from memory
+    content: bytes = await self.aget_content()
+    metadata: Dict[str, str] = dict(filter(lambda item: item[0] not in Codec.metadata_keys, self.get_metadata().items()))
+    return MemoryEntry(self.key, content, metadata, self.statistics)
+
+  def __get_planned_range__(self, start_index: int, end_index: int) -> Optional[bytes]:
+    # Serves the range from a plan that contains it, fetching the whole plan on first use
+    with self.plan_lock:
+      plan: Optional[RangePlan] = next(filter(lambda plan: plan.contains(start_index, end_index), self.plans), None)
+    if plan is None:
+      return None
+    with plan.lock:
+      if plan.content is None:
+        plan.content = self.__get_unplanned_range__(plan.start_index, plan.end_index)
+      content: bytes = plan.content[start_index - plan.start_index:end_index - plan.start_index + 1]
+      plan.consume(start_index, end_index)
+      done: bool = len(plan.pending) == 0
+    if done:
+      with self.plan_lock:
+        if plan in self.plans:
+          self.plans.remove(plan)
+    return content
+
+  def __get_unplanned_range__(self, start_index: int, end_index: int) -> bytes:
+    frame_index: Optional[FrameIndex] = self.__get_frame_index__()
+    if frame_index is not None:
+      return frame_index.get_range(self, start_index, end_index)
+    return self.__read__(start_index, end_index)
+
+  def __is_file__(self, f: BinaryIO) -> bool:
+    try:
+      f.fileno()
+      return True
+    except (AttributeError, io.UnsupportedOperation):
+      return False
+
+  def __read__(self, start_index: int, end_index: int) -> bytes:
+    # Reads stored bytes, which are only the logical content if the entry isn't compressed
+    if self.cache is not None and start_index <= end_index:
+      return self.cache.get_range(self, start_index, end_index)
+    self.statistics.add("read_count")
+    start_time: float = time.time()
+    content: bytes = self.__get_range__(start_index, end_index)
+    self.statistics.record("get", start_time)
+    self.statistics.add("read_byte_count", len(content))
+    return content
+
   def content_length(self) -> int:
-    raise Exception("Entry::content_length not implemented")
+    frame_index: Optional[FrameIndex] = self.__get_frame_index__()
+    if frame_index is not None:
+      return frame_index.length
+    return self.__content_length__()
 
   def download(self, f: BinaryIO) -> int:
+    if self.is_compressed():
+      content: bytes = self.get_content()
+      f.write(content)
+      return len(content)
+
+    content_length: int = self.__content_length__()
+    if content_length > self.download_part_size and self.__is_file__(f):
+      return self.__download_ranges__(f, content_length)
+
+    offset: int = f.tell()
     count = 0
     done = False
     while not done:
-      self.statistics.read_count += 1
+      self.statistics.add("read_count")
+      start_time: float = time.time()
       try:
-        content_length: int = self.__download__(f)
+        content_length = self.__download__(f)
+        self.statistics.record("get", start_time)
+        self.statistics.add("read_byte_count", content_length)
         return content_length
       except Exception as e:
         count += 1
         if count == 3:
           raise e
+        self.statistics.add("retry_count")
+        # Drop the partial transfer before starting again
+        f.seek(offset)
+        f.truncate()
 
   def get_content(self) -> bytes:
-    self.statistics.read_count += 1
-    return self.__get_content__()
+    if self.is_compressed():
+      return self.get_range(0, self.content_length() - 1)
+    self.statistics.add("read_count")
+    start_time: float = time.time()
+    content: bytes = self.__get_content__()
+    self.statistics.record("get", start_time)
+    self.statistics.add("read_byte_count", len(content))
+    return content
+
+  def get_index(self) -> Optional[bytes]:
+    # Item index written with Database.write_index, if the object has one
+    if "item_index" not in self.get_metadata():
+      return None
+    return self.__get_index__()
 
   def get_metadata(self) -> Dict[str, str]:
     raise Exception("Entry::get_metadata not implemented")
 
   def get_range(self, start_index: int, end_index: int) -> bytes:
-    self.statistics.read_count += 1
-    return self.__get_range__(start_index, end_index)
+    if len(self.plans) > 0:
+      content: Optional[bytes] = self.__get_planned_range__(start_index, end_index)
+      if content is not None:
+        return content
+    return self.__get_unplanned_range__(start_index, end_index)
+
+  def get_view(self, start_index: int, end_index: int) -> memoryview:
+    # Range as a memoryview. Entries that can serve it without copying the content override this.
+    return memoryview(self.get_range(start_index, end_index))
+
+  def is_compressed(self) -> bool:
+    return self.__get_frame_index__() is not None
 
   def last_modified_at(self) -> float:
     raise Exception("Entry::last_modified_at not implemented")
 
+  def plan_ranges(self, ranges: List[Tuple[int, int]]):
+    # Declares ranges that are about to be read. Ranges close to each other are fetched
+    # with one request when the first of them is read, and the rest are served from it.
+    plans: List[RangePlan] = []
+    for [start_index, end_index] in sorted(ranges):
+      if start_index > end_index:
+        continue
+      if len(plans) > 0:
+        plan: RangePlan = plans[-1]
+        size: int = max(plan.end_index, end_index) - plan.start_index + 1
+        if start_index - plan.end_index - 1 <= self.range_gap_size and size <= max(self.max_plan_size, plan.end_index - plan.start_index + 1):
+          plan.add(start_index, end_index)
+          continue
+      plans.append(RangePlan(start_index, end_index))
+      plans[-1].add(start_index, end_index)
+    with self.plan_lock:
+      self.plans += plans
+
+
+class MemoryEntry(Entry):
+  # Entry whose content is already in memory, such as content relayed in the invocation
+  # payload by the previous stage or an entry read with aload. It's served without any S3 requests.
+  content: bytes
+  metadata: Dict[str, str]
+
+  def __init__(self, key: str, content: bytes, metadata: Dict[str, str], statistics: Statistics):
+    Entry.__init__(self, key, None, statistics)
+    self.content = content
+    self.last_modified = time.time()
+    self.metadata = metadata
+
+  def __content_length__(self) -> int:
+    return len(self.content)
+
+  def __read__(self, start_index: int, end_index: int) -> bytes:
+    return self.content[start_index:end_index + 1]
+
+  def download(self, f: BinaryIO) -> int:
+    content: bytes = self.get_content()
+    f.write(content)
+    return len(content)
+
+  def get_content(self) -> bytes:
+    return self.get_range(0, self.content_length() - 1)
+
+  def get_metadata(self) -> Dict[str, str]:
+    return self.metadata
+
+  def last_modified_at(self) -> float:
+    return self.last_modified
+
+
+class BundleEntry(Entry):
+  # One part of a bundle, an object that holds several outputs back to back
+  # followed by a JSON index of the byte range and metadata of each part.
+  end_index: int
+  entry: Entry
+  metadata: Dict[str, str]
+  start_index: int
+
+  def __init__(self, entry: Entry, start_index: int, end_index: int, metadata: Dict[str, str]):
+    Entry.__init__(self, entry.key, entry.resources, entry.statistics)
+    self.end_index = end_index
+    self.entry = entry
+    self.metadata = metadata
+    self.start_index = start_index
+
+  def __content_length__(self) -> int:
+    return self.end_index - self.start_index + 1
+
+  def __read__(self, start_index: int, end_index: int) -> bytes:
+    end_index = min(self.start_index + end_index, self.end_index)
+    if self.start_index + start_index > end_index:
+      return b""
+    return self.entry.get_range(self.start_index + start_index, end_index)
+
+  def download(self, f: BinaryIO) -> int:
+    content: bytes = self.get_content()
+    f.write(content)
+    return len(content)
+
+  def get_content(self) -> bytes:
+    return self.get_range(0, self.content_length() - 1)
+
+  def get_metadata(self) -> Dict[str, str]:
+    return self.metadata
+
+  def last_modified_at(self) -> float:
+    return self.entry.last_modified_at()
+
+
+class KeyLayout:
+  # Keys are laid out as <prefix>/<token>/<bin>-<num_bins>/<file> by default, where the
+  # token is the <timestamp>-<nonce> of the run. The token layout stores them as
+  # <token>/<prefix>/<shard>/<bin>-<num_bins>/<file> instead, so every listing of a run
+  # stays within the run and the bins of a stage are spread over hash shards rather than
+  # sharing one key range. Keys that don't belong to a run are stored as they are, and so
+  # are the inputs of a run (prefix 0), which upload.py writes and S3 triggers on.
+  input_prefix: str = "0"
+  shard_length: int = 4
+  token_pattern = re.compile(r"^\d+(\.\d+)?-\d+$")
+
+  @classmethod
+  def is_standard(cls: Any, parts: List[str]) -> bool:
+    return len(parts) >= 2 and parts[0].isdigit() and cls.token_pattern.match(parts[1]) is not None
+
+  @classmethod
+  def is_token_first(cls: Any, parts: List[str]) -> bool:
+    return len(parts) >= 2 and cls.token_pattern.match(parts[0]) is not None and parts[1].isdigit()
+
+  @classmethod
+  def shard(cls: Any, token: str, prefix: str, bin_name: str) -> str:
+    return hashlib.md5("{0:s}/{1:s}/{2:s}".format(token, prefix, bin_name).encode("utf-8")).hexdigest()[:cls.shard_length]
+
+  @classmethod
+  def to_standard(cls: Any, key: str) -> str:
+    parts: List[str] = key.split("/")
+    if not cls.is_token_first(parts):
+      return key
+    # The shard is dropped, since it's derived from the rest of the key
+    return "/".join([parts[1], parts[0]] + parts[3:])
+
+  @classmethod
+  def to_token_first(cls: Any, key: str) -> str:
+    parts: List[str] = key.split("/")
+    if not cls.is_standard(parts) or len(parts) < 4 or parts[0] == cls.input_prefix:
+      return key
+    [prefix, token, bin_name] = parts[:3]
+    return "/".join([token, prefix, cls.shard(token, prefix, bin_name)] + parts[2:])
+
+  @classmethod
+  def to_token_first_prefix(cls: Any, prefix: str) -> str:
+    # Returns the longest stored prefix that contains every key starting with prefix.
+    # Listings of it are filtered, since it may contain keys of other bins or runs.
+    parts: List[str] = prefix.split("/")
+    if parts[0] == cls.input_prefix:
+      return prefix
+    if len(parts) >= 4:
+      return cls.to_token_first(prefix)
+    if len(parts) == 3 and cls.is_standard(parts):
+      return "{0:s}/{1:s}/".format(parts[1], parts[0])
+    if len(parts) == 2 and parts[0].isdigit():
+      # A stage prefix without a token is spread over every run, so it has no stored prefix
+      raise Exception("KeyLayout::to_token_first_prefix {0:s} spans every run. List each run with its token instead.".format(prefix))
+    return prefix
+
+  @classmethod
+  def run_key(cls: Any, key: str) -> str:
+    # Key with the token first and no shard, for objects that belong to a run but aren't stage outputs
+    parts: List[str] = key.split("/")
+    if not cls.is_standard(parts):
+      return key
+    return "/".join([parts[1], parts[0]] + parts[2:])
+
+  @classmethod
+  def token(cls: Any, key: str) -> Optional[str]:
+    parts: List[str] = key.split("/")
+    if cls.is_standard(parts):
+      return parts[1]
+    if cls.is_token_first(parts):
+      return parts[0]
+    return None
+
+
+class Coordinator:
+  # Records the arrivals at each barrier of a run. Each arrival writes a marker of its own, and a
+  # counter holds the number of arrivals and the arrival that completed the barrier. Only the counter
+  # is updated atomically, and it stays the same size however many files arrive. A duplicate arrival
+  # is counted again, so the arrival that reaches the expected count checks the markers before it
+  # completes the barrier. Exactly one arrival completes it, and it completes it again if it's retried.
+  # The marker of a key that was relayed instead of written holds its content, and only those
+  # markers are read once the barrier is complete.
+  def __mark__(self, table_name: str, manifest_name: str, key: str, content: bytes):
+    raise Exception("Coordinator::__mark__ not implemented")
+
+  def __marker__(self, table_name: str, manifest_name: str, key: str) -> bytes:
+    raise Exception("Coordinator::__marker__ not implemented")
+
+  def __markers__(self, table_name: str, manifest_name: str) -> Dict[str, int]:
+    # Returns the size of the marker of each key that arrived
+    raise Exception("Coordinator::__markers__ not implemented")
+
+  def __update__(self, table_name: str, manifest_name: str, update: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+    raise Exception("Coordinator::__update__ not implemented")
+
+  def arrive(self, table_name: str, manifest_name: str, key: str, expected: int, content: bytes=b"") -> Tuple[Optional[str], List[str], Dict[str, bytes]]:
+    # Returns the key that completed the barrier, the keys that arrived and the content of the
+    # relayed keys, or None and no keys if the barrier isn't complete yet
+    self.__mark__(table_name, manifest_name, key, content)
+    counter: Dict[str, Any] = self.__update__(table_name, manifest_name, lambda counter: {**counter, "count": counter["count"] + 1})
+    markers: Optional[Dict[str, int]] = None
+    if counter["last"] is None and counter["count"] >= expected:
+      markers = self.__markers__(table_name, manifest_name)
+      if len(markers) >= expected:
+        counter = self.__update__(table_name, manifest_name, lambda counter: counter if counter["last"] is not None else {**counter, "last": key})
+    if counter["last"] is None:
+      return (None, [], {})
+    if markers is None:
+      markers = self.__markers__(table_name, manifest_name)
+    relayed: Dict[str, bytes] = {}
+    for [marker_key, size] in markers.items():
+      if size > 0:
+        relayed[marker_key] = self.__marker__(table_name, manifest_name, marker_key)
+    return (counter["last"], sorted(markers.keys()), relayed)
+
+  def clear(self, table_name: str, prefix: str):
+    raise Exception("Coordinator::clear not implemented")
+
+  def empty_counter(self) -> Dict[str, Any]:
+    return {"count": 0, "last": None}
+
+
+class S3Coordinator(Coordinator):
+  # The counter of a barrier is one object that is replaced with conditional writes. A write that
+  # loses the race to another arrival fails its precondition and is retried on the new counter after
+  # a jittered backoff, so arrivals at a busy barrier don't retry in lockstep.
+  conflict_codes: List[str] = ["ConditionalRequestConflict", "PreconditionFailed", "409", "412"]
+  max_backoff: float = 1.0
+
+  def __init__(self, database: Any):
+    self.database = database
+
+  def __mark__(self, table_name: str, manifest_name: str, key: str, content: bytes):
+    self.database.__write_content__(table_name, "{0:s}/{1:s}".format(manifest_name, key), content, {}, False)
+
+  def __marker__(self, table_name: str, manifest_name: str, key: str) -> bytes:
+    return self.database.get_entry(table_name, "{0:s}/{1:s}".format(manifest_name, key)).get_content()
+
+  def __markers__(self, table_name: str, manifest_name: str) -> Dict[str, int]:
+    # The sizes come from the listing, so markers aren't read to tell which keys were relayed
+    prefix: str = manifest_name + "/"
+    return dict(map(lambda entry: (entry.key[len(prefix):], entry.__content_length__()), self.database.iterate_entries(table_name, prefix)))
+
+  def __update__(self, table_name: str, manifest_name: str, update: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+    client = self.database.s3.meta.client
+    counter_key: str = manifest_name + ".json"
+    backoff: TokenBucket = TokenBucket(RateLimiter.rates["put"], 1.0, RateLimiter.min_rate)
+    while True:
+      args: Dict[str, Any] = {}
+      try:
+        response = self.database.limiter.call("get", "{0:s}/{1:s}".format(table_name, counter_key), lambda: client.get_object(Bucket=table_name, Key=counter_key))
+        counter: Dict[str, Any] = json.loads(response["Body"].read().decode("utf-8"))
+        args["IfMatch"] = response["ETag"]
+      except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ["NoSuchKey", "404"]:
+          raise e
+        counter = self.empty_counter()
+        args["IfNoneMatch"] = "*"
+      self.database.statistics.add("read_count")
+
+      counter = update(counter)
+      try:
+        self.database.limiter.call("put", "{0:s}/{1:s}".format(table_name, counter_key), lambda: client.put_object(Bucket=table_name, Key=counter_key, Body=json.dumps(counter).encode("utf-8"), **args))
+        self.database.statistics.add("write_count")
+        return counter
+      except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in self.conflict_codes:
+          raise e
+        self.database.statistics.add("retry_count")
+        backoff.throttled(self.max_backoff)
+        backoff.acquire()
+
+  def clear(self, table_name: str, prefix: str):
+    keys: List[str] = list(map(lambda entry: entry.key, self.database.iterate_entries(table_name, prefix + "/")))
+    self.database.delete(table_name, keys)
+
+
+class LocalCoordinator(Coordinator):
+  # Stand-in for S3Coordinator that keeps each barrier in files under root. Counter updates
+  # hold an exclusive lock on the counter, so they're atomic across threads and processes.
+  root: str
+  temp_prefix: str = ".tmp-"
+
+  def __init__(self, root: str):
+    self.root = root
+
+  def __mark__(self, table_name: str, manifest_name: str, key: str, content: bytes):
+    path: str = "{0:s}/{1:s}/{2:s}/{3:s}".format(self.root, table_name, manifest_name, key)
+    [directory, name] = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    temp_path: str = "{0:s}/{1:s}{2:s}.{3:d}-{4:d}".format(directory, self.temp_prefix, name, os.getpid(), threading.get_ident())
+    with open(temp_path, "wb+") as f:
+      f.write(content)
+    os.replace(temp_path, path)
+
+  def __marker__(self, table_name: str, manifest_name: str, key: str) -> bytes:
+    with open("{0:s}/{1:s}/{2:s}/{3:s}".format(self.root, table_name, manifest_name, key), "rb") as f:
+      return f.read()
+
+  def __markers__(self, table_name: str, manifest_name: str) -> Dict[str, int]:
+    directory: str = "{0:s}/{1:s}/{2:s}".format(self.root, table_name, manifest_name)
+    markers: Dict[str, int] = {}
+    for [path, _, files] in os.walk(directory):
+      for name in filter(lambda name: not name.startswith(self.temp_prefix), files):
+        markers[os.path.relpath(os.path.join(path, name), directory)] = os.path.getsize(os.path.join(path, name))
+    return markers
+
+  def __update__(self, table_name: str, manifest_name: str, update: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+    path: str = "{0:s}/{1:s}/{2:s}.json".format(self.root, table_name, manifest_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a+") as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      counter: Dict[str, Any] = self.empty_counter()
+      if os.path.isfile(path):
+        with open(path, "r") as f:
+          counter = json.loads(f.read())
+      counter = update(counter)
+      with open(path + ".tmp", "w+") as f:
+        f.write(json.dumps(counter))
+      os.replace(path + ".tmp", path)
+      return counter
+
+  def clear(self, table_name: str, prefix: str):
+    shutil.rmtree("{0:s}/{1:s}/{2:s}".format(self.root, table_name, prefix), ignore_errors=True)
+
 
 class Table:
   name: str
@@ -94,109 +981,826 @@ class Table:
     self.statistics = statistics
 
 
+class MultipartWriter:
+  # File-like object that uploads content in parts as it is written.
+  # Parts are uploaded in parallel and the object only appears once close is called.
+  # Content smaller than one part is written with a single request instead.
+  closed: bool
+  max_copy_size: int = 5*1024*1024*1024
+  metadata: Dict[str, str]
+  min_part_size: int
+  part_size: int
+
+  def __init__(self, database: "Database", table_name: str, key: str, metadata: Dict[str, str], invoke: bool, part_size: int, max_workers: int):
+    assert(part_size >= database.min_part_size)
+    self.buffer = bytearray()
+    self.closed = False
+    self.codec: Optional[Codec] = database.codec
+    self.database = database
+    self.executor: Optional[ThreadPoolExecutor] = None
+    self.frame = bytearray()
+    self.frame_ends: List[int] = []
+    self.index: Optional[bytes] = None
+    self.invoke = invoke
+    self.key = key
+    self.length = 0
+    self.max_workers = max_workers
+    self.metadata = self.__metadata__(metadata)
+    self.min_part_size = database.min_part_size
+    self.part_size = part_size
+    self.parts: List[Future] = []
+    self.table_name = table_name
+    self.upload_id: Optional[str] = None
+    self.upload_metadata: Dict[str, str] = {}
+
+  def __append__(self, content: bytes):
+    self.buffer += content
+    while len(self.buffer) >= self.part_size:
+      self.__submit__(self.__part_upload__(bytes(self.buffer[:self.part_size])))
+      del self.buffer[:self.part_size]
+
+  def __append_frame__(self, frame: bytes):
+    compressed: bytes = self.codec.compress(frame)
+    self.frame_ends.append((self.frame_ends[-1] if len(self.frame_ends) > 0 else 0) + len(compressed))
+    self.length += len(frame)
+    self.__append__(compressed)
+
+  def __copy_upload__(self, entry: Entry, start_index: int, end_index: int) -> Callable[[int], str]:
+    return lambda part_number: self.database.upload_part_copy(self.table_name, self.key, self.upload_id, part_number, entry, start_index, end_index)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None:
+      self.abort()
+    elif not self.closed:
+      self.close()
+
+  def __flush__(self):
+    if len(self.buffer) > 0:
+      self.__submit__(self.__part_upload__(bytes(self.buffer)))
+      self.buffer = bytearray()
+
+  def __metadata__(self, metadata: Dict[str, str]) -> Dict[str, str]:
+    # Copied, so the writer doesn't change the caller's metadata
+    if self.codec is None:
+      return dict(metadata)
+    return {**metadata, **self.codec.get_metadata()}
+
+  def __part_upload__(self, part: bytes) -> Callable[[int], str]:
+    return lambda part_number: self.database.upload_part(self.table_name, self.key, self.upload_id, part_number, part)
+
+  def __submit__(self, upload: Callable[[int], str]):
+    if self.upload_id is None:
+      self.upload_metadata = dict(self.metadata)
+      self.upload_id = self.database.create_upload(self.table_name, self.key, self.upload_metadata)
+      self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    # Bound the number of parts held in memory
+    pending: List[Future] = list(filter(lambda future: not future.done(), self.parts))
+    if len(pending) >= 2 * self.max_workers:
+      pending[0].result()
+
+    part_number: int = len(self.parts) + 1
+    self.parts.append(self.executor.submit(self.__upload_part__, part_number, upload))
+
+  def __upload_part__(self, part_number: int, upload: Callable[[int], str]) -> Dict[str, Any]:
+    count = 0
+    while True:
+      try:
+        etag: str = upload(part_number)
+        return {"ETag": etag, "PartNumber": part_number}
+      except Exception as e:
+        count += 1
+        if count == 3:
+          raise e
+        self.database.statistics.add("retry_count")
+
+  def abort(self):
+    if self.closed:
+      return
+    self.closed = True
+    if self.upload_id is not None:
+      for part in self.parts:
+        part.cancel()
+      self.executor.shutdown(wait=True)
+      self.database.abort_upload(self.table_name, self.key, self.upload_id)
+
+  def close(self, metadata: Optional[Dict[str, str]] = None):
+    # Metadata passed to close is added to the metadata the writer was created with
+    assert(not self.closed)
+    if metadata is not None:
+      self.set_metadata(metadata)
+    if self.index is None:
+      # The items turned out not to be indexable
+      self.metadata.pop("item_index", None)
+    else:
+      # The index is written first, so it exists by the time the next stage reads the object
+      self.database.write_index(self.table_name, self.key, self.index)
+      self.metadata["item_index"] = "True"
+    if self.codec is not None:
+      if len(self.frame) > 0:
+        self.__append_frame__(bytes(self.frame))
+        self.frame = bytearray()
+      self.__append__(self.codec.footer(self.frame_ends, self.length))
+
+    if self.upload_id is None:
+      self.closed = True
+      self.database.__write_content__(self.table_name, self.key, bytes(self.buffer), self.metadata, self.invoke)
+      return
+
+    try:
+      self.__flush__()
+      parts: List[Dict[str, Any]] = list(map(lambda part: part.result(), self.parts))
+    except Exception as e:
+      self.abort()
+      raise e
+
+    self.closed = True
+    self.executor.shutdown(wait=True)
+    # Metadata can only be set when the upload is created. Metadata that was only known
+    # once parts were uploaded is set with a copy.
+    replace_metadata: Optional[Dict[str, str]] = None
+    if self.metadata != self.upload_metadata:
+      replace_metadata = self.metadata
+    self.database.complete_upload(self.table_name, self.key, self.upload_id, parts, replace_metadata, self.invoke)
+
+  def expect_index(self):
+    # Marks the object as indexed before any part is uploaded, so the upload is created with
+    # item_index in its metadata.
+    self.set_metadata({"item_index": "True"})
+
+  def set_index(self, index: bytes):
+    # Item index to write alongside the object when it's closed
+    self.index = index
+
+  def set_metadata(self, metadata: Dict[str, str]):
+    assert(not self.closed)
+    self.metadata = self.__metadata__({**self.metadata, **metadata})
+
+  def copy(self, entry: Entry, start_index: int, end_index: int):
+    # Appends the byte range of the entry without downloading it. Every part but the last
+    # needs to be at least min_part_size, so buffered content is topped up with bytes from
+    # the entry and ranges too small to be a part are downloaded instead.
+    assert(not self.closed)
+    if isinstance(entry, BundleEntry):
+      self.copy(entry.entry, entry.start_index + start_index, min(entry.start_index + end_index, entry.end_index))
+      return
+
+    if self.codec is not None or entry.is_compressed():
+      # Compressed frames can't be concatenated, so the range is rewritten
+      for part_start_index in range(start_index, end_index + 1, self.part_size):
+        self.write(entry.get_range(part_start_index, min(part_start_index + self.part_size, end_index + 1) - 1))
+      return
+
+    if 0 < len(self.buffer) < self.min_part_size:
+      top_up_index: int = min(start_index + self.min_part_size - len(self.buffer), end_index + 1)
+      self.buffer += entry.get_range(start_index, top_up_index - 1)
+      start_index = top_up_index
+
+    if end_index - start_index + 1 < self.min_part_size:
+      if start_index <= end_index:
+        self.write(entry.get_range(start_index, end_index))
+      return
+
+    self.__flush__()
+    while start_index <= end_index:
+      part_end_index: int = min(start_index + self.max_copy_size, end_index + 1) - 1
+      if 0 < end_index - part_end_index < self.min_part_size:
+        part_end_index = end_index - self.min_part_size
+      self.__submit__(self.__copy_upload__(entry, start_index, part_end_index))
+      start_index = part_end_index + 1
+
+  def write(self, content: bytes) -> int:
+    assert(not self.closed)
+    if self.codec is None:
+      self.__append__(content)
+      return len(content)
+
+    self.frame += content
+    while len(self.frame) >= self.codec.frame_size:
+      self.__append_frame__(bytes(self.frame[:self.codec.frame_size]))
+      del self.frame[:self.codec.frame_size]
+    return len(content)
+
+
 class Database:
+  # Every public method can be called from several threads at once. Writers
+  # returned by writer are file-like objects and should be used by one thread.
+  cache: Optional[BlockCache]
+  codec: Optional[Codec]
+  compressed: bool
+  indexed: bool
+  invoke_concurrency: int = 16
+  # Asynchronous invocation payloads are limited to 256 KB and relayed content is base64 encoded
+  max_relay_size: int = 128*1024
+  params: Dict[str, Any]
   payloads: List[Dict[str, Any]]
   statistics: Statistics
+  throttle_codes: List[str] = ["RequestLimitExceeded", "ServiceUnavailable", "SlowDown", "ThrottlingException", "TooManyRequestsException"]
+  delete_batch_size: int = 1000
+  delete_concurrency: int = 8
+  index_prefix: str = "index"
+  manifest_prefix: str = "manifest"
+  # S3 requires every part but the last to be at least 5 MiB
+  min_part_size: int = 5*1024*1024
+  part_size: int = 8*1024*1024
+  upload_concurrency: int = 4
 
   def __init__(self):
+    self.cache = None
+    self.codec = None
+    # Whether objects may have been compressed or indexed by a stage of the pipeline
+    self.compressed = False
+    self.indexed = False
+    self.coordinator: Optional[Coordinator] = None
+    self.entries: Dict[Tuple[str, str], Entry] = {}
     self.payloads = []
+    self.relayed: Dict[Tuple[str, str], Dict[str, Any]] = {}
     self.statistics = Statistics()
+    self.limiter = RateLimiter(self.statistics, self.__is_throttled__)
     self.max_sleep_time = 5
 
-  def __download__(self, table_name: str, key: str, f: BinaryIO) -> int:
-    raise Exception("Database::__download__ not implemented")
+  def __abort_upload__(self, table_name: str, key: str, upload_id: str):
+    raise Exception("Database::__abort_upload__ not implemented")
+
+  def __complete_upload__(self, table_name: str, key: str, upload_id: str, parts: List[Dict[str, Any]], metadata: Optional[Dict[str, str]], invoke: bool):
+    raise Exception("Database::__complete_upload__ not implemented")
+
+  def __create_upload__(self, table_name: str, key: str, metadata: Dict[str, str]) -> str:
+    raise Exception("Database::__create_upload__ not implemented")
+
+  def __delete__(self, table_name: str, keys: List[str]):
+    raise Exception("Database::__delete__ not implemented")
+
+  def __write_index__(self, table_name: str, key: str, content: bytes):
+    # Indexes are stored under index_prefix, so they aren't part of the listings of a stage
+    self.__write__(table_name, "{0:s}/{1:s}".format(self.index_prefix, key), content, {}, False)
 
   def __get_entries__(self, table_name: str, prefix: Optional[str]=None) -> List[Entry]:
     raise Exception("Database::__get_entries__ not implemented")
 
+  def __get_entries_page__(self, table_name: str, prefix: Optional[str], token: Optional[str]) -> Tuple[List[Entry], Optional[str]]:
+    # Backends without paginated listings return every entry in one page
+    return (self.__get_entries__(table_name, prefix), None)
+
+  def __invoke__(self, name: str, payload: Dict[str, Any]):
+    raise Exception("Database::__invoke__ not implemented")
+
+  def __invoke_with_backoff__(self, name: str, payload: Dict[str, Any]) -> float:
+    start: float = time.time()
+    sleep_time: float = 0.1
+    while True:
+      try:
+        self.__invoke__(name, payload)
+        self.statistics.record("invoke", start)
+        return time.time() - start
+      except Exception as e:
+        if not self.__is_throttled__(e) or sleep_time > self.max_sleep_time:
+          raise e
+        self.statistics.add("invoke_throttle_count")
+        self.statistics.add("retry_count")
+        time.sleep(sleep_time * (1 + random.random()))
+        sleep_time *= 2
+
+  def __is_throttled__(self, e: Exception) -> bool:
+    if isinstance(e, botocore.exceptions.ClientError):
+      return e.response["Error"]["Code"] in self.throttle_codes
+    return False
+
+  def __physical_key__(self, key: str) -> str:
+    # Callers always use the standard layout. It's only translated when talking to the backend.
+    if "key_layout" in self.params and self.params["key_layout"] == "token":
+      return KeyLayout.to_token_first(key)
+    return key
+
+  def __physical_prefix__(self, prefix: str) -> str:
+    if "key_layout" in self.params and self.params["key_layout"] == "token":
+      return KeyLayout.to_token_first_prefix(prefix)
+    return prefix
+
   def __put__(self, table_name: str, key: str, content: BinaryIO, metadata: Dict[str, str]):
     raise Exception("Database::__put__ not implemented")
 
+  def __relayable__(self, content_length: int) -> bool:
+    if "output_function" not in self.params or "relay_size" not in self.params:
+      return False
+    return content_length <= min(self.params["relay_size"], self.max_relay_size)
+
+  def __load_relayed__(self, table_name: str, key: str, relay: Dict[str, Any]):
+    self.relayed[(table_name, key)] = relay
+    self.entries[(table_name, key)] = MemoryEntry(key, base64.b64decode(relay["content"]), relay["metadata"], self.statistics)
+
+  def __trigger__(self, table_name: str, key: str, invoke: bool, relay: Optional[Tuple[bytes, Dict[str, str]]]=None):
+    if invoke and "output_function" not in self.params and "gc" in self.params and self.params["gc"]:
+      self.collect_garbage(table_name, KeyLayout.to_standard(key), self.params["gc_keep"] if "gc_keep" in self.params else [])
+    if "output_function" in self.params and invoke:
+      key = KeyLayout.to_standard(key)
+      payload = {
+        "Records": [{
+          "s3": {
+            "bucket": {
+              "name": table_name
+            },
+            "object": {
+              "key": key
+            },
+            "ancestry": self.params["ancestry"],
+          },
+        }]
+      }
+      if relay is not None:
+        payload["Records"][0]["s3"]["relay"] = {
+          "content": base64.b64encode(relay[0]).decode("utf-8"),
+          "metadata": relay[1],
+        }
+      if "reexecute" in self.params:
+        payload["execute"] = self.params["reexecute"]
+      self.invoke(self.params["output_function"], payload)
+
+  def __upload_part__(self, table_name: str, key: str, upload_id: str, part_number: int, content: bytes) -> str:
+    raise Exception("Database::__upload_part__ not implemented")
+
+  def __upload_part_copy__(self, table_name: str, key: str, upload_id: str, part_number: int, entry: Entry, start_index: int, end_index: int) -> str:
+    raise Exception("Database::__upload_part_copy__ not implemented")
+
   def __write__(self, table_name: str, key: str, content: bytes, metadata: Dict[str, str]):
     raise Exception("Database::__write__ not implemented")
 
+  def __write_content__(self, table_name: str, key: str, content: bytes, metadata: Dict[str, str], invoke: bool):
+    if invoke and self.__relayable__(len(content)):
+      # Small outputs are passed to the next stage in its payload and only
+      # written to S3 if the stage needs to keep them.
+      if "durable" in self.params and self.params["durable"]:
+        self.__write_content__(table_name, key, content, metadata, False)
+      self.__trigger__(table_name, key, invoke, (content, metadata))
+      return
+
+    self.invalidate(table_name, key)
+    self.statistics.add("write_count")
+    self.statistics.add("write_byte_count", len(content))
+    start_time: float = time.time()
+    self.__write__(table_name, self.__physical_key__(key), content, metadata, invoke)
+    self.statistics.record("put", start_time)
+
+  # The async methods run the blocking methods on the event loop's executor, which is
+  # safe since every public method can be called from several threads.
+  async def aget_entries(self, table_name: str, prefix: Optional[str]=None) -> List[Entry]:
+    return await asyncio.get_event_loop().run_in_executor(None, self.get_entries, table_name, prefix)
+
+  async def ainvoke(self, name: str, payload: Dict[str, Any]) -> float:
+    return await asyncio.get_event_loop().run_in_executor(None, self.invoke, name, payload)
+
+  async def aput(self, table_name: str, key: str, content: BinaryIO, metadata: Dict[str, str], invoke=True):
+    await asyncio.get_event_loop().run_in_executor(None, self.put, table_name, key, content, metadata, invoke)
+
+  async def awrite(self, table_name: str, key: str, content: bytes, metadata: Dict[str, str], invoke=True):
+    await asyncio.get_event_loop().run_in_executor(None, self.write, table_name, key, content, metadata, invoke)
+
+  def abort_upload(self, table_name: str, key: str, upload_id: str):
+    self.statistics.add("write_count")
+    start_time: float = time.time()
+    self.__abort_upload__(table_name, self.__physical_key__(key), upload_id)
+    self.statistics.record("upload", start_time)
+
+  def arrive(self, table_name: str, name: str, key: str, expected: int) -> Tuple[Optional[str], List[str]]:
+    # Records that key arrived at the barrier name, which completes once expected keys arrived.
+    # Returns the key that completed the barrier and the keys that arrived, once it's complete.
+    # The name is in the standard layout, such as <prefix>/<token>/<bin>-<num_bins>, and the
+    # barrier is stored under the token of the run. A key relayed to this invocation was never
+    # written, so its content is kept with its arrival and served by get_entry once the barrier
+    # is complete.
+    manifest_name: str = "{0:s}/{1:s}".format(self.manifest_prefix, KeyLayout.run_key(name))
+    content: bytes = b""
+    if (table_name, key) in self.relayed:
+      content = json.dumps(self.relayed[(table_name, key)]).encode("utf-8")
+    start_time: float = time.time()
+    [last, keys, relayed] = self.coordinator.arrive(table_name, manifest_name, key, expected, content)
+    self.statistics.record("manifest", start_time)
+    for [relayed_key, relay] in relayed.items():
+      if (table_name, relayed_key) not in self.relayed:
+        self.__load_relayed__(table_name, relayed_key, json.loads(relay.decode("utf-8")))
+    return (last, keys)
+
+  def collect_garbage(self, table_name: str, key: str, keep: List[int]):
+    # Called with each output of the final stage. Once every file of every bin has arrived,
+    # deletes the outputs of the stages before it, except for the input and the stages in keep.
+    parts: List[str] = key.split("/")
+    [prefix, token, bin_name] = parts[:3]
+    # The file name is <file_id>-<execute>-<num_files>, followed by -<suffix> if the stage has one,
+    # and the execute time has a decimal point, so the extension is stripped first
+    num_files: int = int(os.path.splitext(parts[3])[0].split("-")[2])
+    [last, _] = self.arrive(table_name, "/".join(parts[:3]), key, num_files)
+    if last != key:
+      return
+    num_bins: int = int(bin_name.split("-")[1])
+    [last, _] = self.arrive(table_name, "{0:s}/{1:s}/gc".format(prefix, token), bin_name, num_bins)
+    if last != bin_name:
+      return
+
+    prefixes: List[int] = list(filter(lambda p: p not in keep, range(1, int(prefix))))
+    self.delete(table_name, self.get_run_keys(table_name, token, prefixes))
+    if "index" in self.params and self.params["index"]:
+      # Item indexes are stored under their own prefix, so they aren't listed with the run
+      for p in prefixes:
+        index_prefix: str = "{0:s}/{1:s}".format(self.index_prefix, self.__physical_prefix__("{0:d}/{1:s}/".format(p, token)))
+        self.delete(table_name, list(map(lambda entry: entry.key, self.iterate_entries(table_name, index_prefix))))
+    self.coordinator.clear(table_name, "{0:s}/{1:s}".format(self.manifest_prefix, token))
+
+  def complete_upload(self, table_name: str, key: str, upload_id: str, parts: List[Dict[str, Any]], metadata: Optional[Dict[str, str]], invoke=True):
+    self.invalidate(table_name, key)
+    self.statistics.add("write_count")
+    start_time: float = time.time()
+    self.__complete_upload__(table_name, self.__physical_key__(key), upload_id, parts, metadata, invoke)
+    self.statistics.record("upload", start_time)
+
   def contains(self, table_name: str, key: str) -> bool:
     raise Exception("Database::contains not implemented")
 
   def create_payload(self, table_name: str, key: str, extra: Dict[str, Any]) -> Dict[str, Any]:
-    raise Exception("Database::create_payload not implemented")
+    payload = {
+      "Records": [{
+        "s3": {
+          "bucket": {
+            "name": table_name
+          },
+          "object": {
+            "key": key
+          },
+          "extra_params": extra,
+          "ancestry": self.params["ancestry"],
+        }
+      }]
+    }
+
+    if "reexecute" in self.params:
+      payload["execute"] = self.params["reexecute"]
+    return payload
+
+  def get_bundle_entry(self, table_name: str, key: str, name: str) -> BundleEntry:
+    entry: Entry = self.get_entry(table_name, key)
+    index_size: int = int(entry.get_metadata()["bundle_index_size"])
+    content_length: int = entry.content_length()
+    index: Dict[str, Any] = json.loads(entry.get_range(content_length - index_size, content_length - 1).decode("utf-8"))
+    [start_index, end_index, metadata] = index[name]
+    return BundleEntry(entry, start_index, end_index, metadata)
+
+  def create_upload(self, table_name: str, key: str, metadata: Dict[str, str]) -> str:
+    self.statistics.add("write_count")
+    start_time: float = time.time()
+    upload_id: str = self.__create_upload__(table_name, self.__physical_key__(key), metadata)
+    self.statistics.record("upload", start_time)
+    return upload_id
+
+  def delete(self, table_name: str, keys: List[str]):
+    # Deletes the keys in batches of delete_batch_size, with several batches in flight at once
+    if len(keys) == 0:
+      return
+    for key in keys:
+      entry: Optional[Entry] = self.entries.pop((table_name, key), None)
+      if entry is not None and self.cache is not None:
+        self.cache.invalidate(entry.cache_key())
+    physical_keys: List[str] = list(map(self.__physical_key__, keys))
+    batches: List[List[str]] = [physical_keys[i:i + self.delete_batch_size] for i in range(0, len(physical_keys), self.delete_batch_size)]
+
+    def delete_batch(batch: List[str]):
+      start_time: float = time.time()
+      self.__delete__(table_name, batch)
+      self.statistics.record("delete", start_time)
+
+    start_time: float = time.time()
+    with ThreadPoolExecutor(max_workers=min(self.delete_concurrency, len(batches))) as executor:
+      list(executor.map(delete_batch, batches))
+    # The batches ran on worker threads, but the caller was blocked waiting on them
+    self.statistics.add("io_time", time.time() - start_time)
+    self.statistics.add("delete_count", len(keys))
 
   def download(self, table_name: str, key: str, file_name: str) -> int:
-    count = 0
-    done = False
-    while not done:
-      self.statistics.read_count += 1
-      try:
-        with open(file_name, "wb+") as f:
-          content_length: int = self.__download__(table_name, key, f)
-        return content_length
-      except Exception as e:
-        count += 1
-        if count == 3:
-          raise e
+    entry: Optional[Entry] = self.get_entry(table_name, key)
+    if entry is None:
+      raise Exception("Database::download {0:s}/{1:s} does not exist".format(table_name, key))
+    with open(file_name, "wb+") as f:
+      return entry.download(f)
 
   def get_entry(self, table_name: str, key: str) -> Optional[Entry]:
     raise Exception("Database::key not implemented")
 
   def get_entries(self, table_name: str, prefix: Optional[str]=None) -> List[Entry]:
-    self.statistics.list_count += 1
-    return self.__get_entries__(table_name, prefix)
+    return list(self.iterate_entries(table_name, prefix))
+
+  def get_run_keys(self, table_name: str, token: str, prefixes: Optional[List[int]]=None) -> List[str]:
+    # Returns the keys of the run with the token, either of the given stage prefixes or of every stage
+    if prefixes is not None:
+      entries: Iterable[Entry] = itertools.chain(*map(lambda prefix: self.iterate_entries(table_name, "{0:d}/{1:s}/".format(prefix, token)), prefixes))
+    elif "key_layout" in self.params and self.params["key_layout"] == "token":
+      # Every stage of the run but the input is stored under the token, so only the run is listed
+      input_prefix: str = "{0:s}/{1:s}/".format(KeyLayout.input_prefix, token)
+      entries = itertools.chain(self.iterate_entries(table_name, input_prefix), self.iterate_entries(table_name, token + "/"))
+    else:
+      entries = filter(lambda entry: KeyLayout.token(entry.key) == token, self.iterate_entries(table_name))
+    return list(map(lambda entry: entry.key, entries))
 
   def get_statistics(self) -> Dict[str, Any]:
     return {
+      "background_io_time": self.statistics.background_io_time,
+      "cache_hit_count": self.statistics.cache_hit_count,
+      "cache_miss_count": self.statistics.cache_miss_count,
+      "delete_count": self.statistics.delete_count,
+      "invoke_count": self.statistics.invoke_count,
+      "invoke_latencies": self.statistics.invoke_latencies,
+      "invoke_throttle_count": self.statistics.invoke_throttle_count,
+      "io_time": self.statistics.io_time,
+      "latency_bounds": self.statistics.latency_bounds,
+      "latency_histograms": self.statistics.latency_histograms,
       "payloads": self.payloads,
       "read_count": self.statistics.read_count,
       "write_count": self.statistics.write_count,
       "list_count": self.statistics.list_count,
       "write_byte_count": self.statistics.write_byte_count,
       "read_byte_count": self.statistics.read_byte_count,
+      "retry_count": self.statistics.retry_count,
+      "throttle_count": self.statistics.throttle_count,
+      "throttle_wait_times": self.statistics.throttle_wait_times,
+      "user_time": self.statistics.user_time(),
     }
 
   def get_table(self, table_name: str) -> Table:
     raise Exception("Database::get_table not implemented")
 
-  def invoke(self, name, payload):
-    raise Exception("Database::invoke not implemented")
+  def invoke(self, name: str, payload: Dict[str, Any]) -> float:
+    self.payloads.append(payload)
+    latency: float = self.__invoke_with_backoff__(name, payload)
+    self.statistics.add("invoke_count")
+    self.statistics.invoke_latencies.append(latency)
+    return latency
+
+  def invoke_many(self, name: str, payloads: List[Dict[str, Any]], max_workers: Optional[int]=None) -> List[float]:
+    # Invokes the function once per payload using a bounded number of threads.
+    # Throttled invocations are retried with backoff. Returns the latency of each invocation.
+    if len(payloads) == 0:
+      return []
+    if max_workers is None:
+      max_workers = self.invoke_concurrency
+    self.payloads += payloads
+    start_time: float = time.time()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(payloads))) as executor:
+      latencies: List[float] = list(executor.map(lambda payload: self.__invoke_with_backoff__(name, payload), payloads))
+    # The invocations ran on worker threads, but the caller was blocked waiting on them
+    self.statistics.add("io_time", time.time() - start_time)
+    self.statistics.add("invoke_count", len(latencies))
+    self.statistics.invoke_latencies += latencies
+    return latencies
+
+  def iterate_entries(self, table_name: str, prefix: Optional[str]=None) -> Iterable[Entry]:
+    # Lists one page at a time, so callers that stop early don't list the whole prefix
+    physical_prefix: Optional[str] = self.__physical_prefix__(prefix) if prefix else prefix
+    token: Optional[str] = None
+    done = False
+    while not done:
+      self.statistics.add("list_count")
+      start_time: float = time.time()
+      [entries, token] = self.__get_entries_page__(table_name, physical_prefix, token)
+      self.statistics.record("list", start_time)
+      for entry in entries:
+        # Backends return keys in the standard layout, which may not all start with the prefix
+        # if a wider prefix had to be listed
+        if physical_prefix == prefix or entry.key.startswith(prefix):
+          yield entry
+      done = token is None
+
+  def log_key(self, event: Dict[str, Any]) -> str:
+    # Key of the log of one invocation. Functions that split an object invoke the next function
+    # once per file with the key of the object, so those invocations are told apart by their file.
+    key: str = event["Records"][0]["s3"]["object"]["key"]
+    name: str = self.params["name"] if "name" in self.params else "stage"
+    if "log" in event:
+      [file_id, num_files] = event["log"][4:6]
+      return "{0:s}.{1:s}-{2:d}-{3:d}.log".format(key, name, file_id, num_files)
+    return "{0:s}.{1:s}.log".format(key, name)
+
+  def load_relayed(self, event: Dict[str, Any]):
+    # Makes content relayed in the event available through get_entry
+    for record in event["Records"]:
+      if "relay" in record["s3"]:
+        self.__load_relayed__(record["s3"]["bucket"]["name"], record["s3"]["object"]["key"], record["s3"]["relay"])
+
+  def invalidate(self, table_name: str, key: str):
+    self.relayed.pop((table_name, key), None)
+    entry: Optional[Entry] = self.entries.pop((table_name, key), None)
+    if self.cache is not None:
+      if entry is None:
+        entry = self.get_entry(table_name, key)
+        self.entries.pop((table_name, key), None)
+      if entry is not None:
+        self.cache.invalidate(entry.cache_key())
 
   def put(self, table_name: str, key: str, content: BinaryIO, metadata: Dict[str, str], invoke=True):
-    self.statistics.write_count += 1
-    self.statistics.write_byte_count += os.path.getsize(content.name)
-    self.__put__(table_name, key, content, metadata, invoke)
+    size: int = os.path.getsize(content.name)
+    if size > 2 * self.part_size:
+      with self.writer(table_name, key, metadata, invoke) as f:
+        shutil.copyfileobj(content, f, self.part_size)
+      return
+    if self.codec is not None:
+      self.write(table_name, key, content.read(), metadata, invoke)
+      return
+
+    self.invalidate(table_name, key)
+    self.statistics.add("write_count")
+    self.statistics.add("write_byte_count", size)
+    start_time: float = time.time()
+    self.__put__(table_name, self.__physical_key__(key), content, metadata, invoke)
+    self.statistics.record("put", start_time)
 
   def read(self, table_name: str, key: str) -> bytes:
-    self.statistics.read_count += 1
-    content: bytes = self.__read__(table_name, key)
-    self.statistics.read_byte_count += len(content)
+    entry: Optional[Entry] = self.get_entry(table_name, key)
+    if entry is not None and entry.is_compressed():
+      return entry.get_content()
+
+    self.statistics.add("read_count")
+    start_time: float = time.time()
+    content: bytes = self.__read__(table_name, self.__physical_key__(key))
+    self.statistics.record("get", start_time)
+    self.statistics.add("read_byte_count", len(content))
     return content
 
+  def run_stage(self, func: Callable[..., Any], *args: Any, event: Optional[Dict[str, Any]]=None) -> Any:
+    # Runs the stage function of one invocation. Coroutine functions are run to completion on
+    # the event loop of the thread, since asyncio.run isn't available on the python3.6 runtime.
+    # If the event is passed, content relayed in it is served by get_entry, and if the stage
+    # has a log bucket, the statistics of the invocation are written to it once the function returns.
+    start_time: float = time.time()
+    if event is not None:
+      self.load_relayed(event)
+    result: Any
+    if asyncio.iscoroutinefunction(func):
+      result = asyncio.get_event_loop().run_until_complete(func(self, *args))
+    else:
+      result = func(self, *args)
+    if event is not None and "log" in self.params:
+      self.write_log(self.params["log"], self.log_key(event), {"duration": time.time() - start_time})
+    return result
+
+  def upload_part(self, table_name: str, key: str, upload_id: str, part_number: int, content: bytes) -> str:
+    self.statistics.add("write_count")
+    self.statistics.add("write_byte_count", len(content))
+    start_time: float = time.time()
+    etag: str = self.__upload_part__(table_name, self.__physical_key__(key), upload_id, part_number, content)
+    self.statistics.record("put", start_time)
+    return etag
+
+  def upload_part_copy(self, table_name: str, key: str, upload_id: str, part_number: int, entry: Entry, start_index: int, end_index: int) -> str:
+    self.statistics.add("write_count")
+    start_time: float = time.time()
+    etag: str = self.__upload_part_copy__(table_name, self.__physical_key__(key), upload_id, part_number, entry, start_index, end_index)
+    self.statistics.record("copy", start_time)
+    return etag
+
   def write(self, table_name: str, key: str, content: bytes, metadata: Dict[str, str], invoke=True):
-    self.statistics.write_count += 1
-    self.statistics.write_byte_count += len(content)
-    self.__write__(table_name, key, content, metadata, invoke)
+    if self.codec is not None:
+      content = self.codec.encode(content)
+      metadata = {**metadata, **self.codec.get_metadata()}
+    self.__write_content__(table_name, key, content, metadata, invoke)
+
+  def write_index(self, table_name: str, key: str, content: bytes):
+    # Writes the item index of the object with the key. Entry.get_index returns it
+    # if the object is written with item_index in its metadata.
+    self.statistics.add("write_count")
+    self.statistics.add("write_byte_count", len(content))
+    start_time: float = time.time()
+    self.__write_index__(table_name, self.__physical_key__(key), content)
+    self.statistics.record("put", start_time)
+
+  def write_log(self, table_name: str, key: str, log: Dict[str, Any]):
+    # Serializes the statistics of this invocation along with the caller's log fields
+    content: bytes = json.dumps({**log, **self.get_statistics()}).encode("utf-8")
+    self.write(table_name, key, content, {}, False)
+
+  def write_bundle(self, table_name: str, key: str, parts: List[Tuple[str, bytes, Dict[str, str]]], metadata: Dict[str, str], invoke=True):
+    # Writes the parts as one object, so each can be read with get_bundle_entry
+    index: Dict[str, Any] = {}
+    start_index: int = 0
+    for [name, content, part_metadata] in parts:
+      index[name] = [start_index, start_index + len(content) - 1, part_metadata]
+      start_index += len(content)
+    footer: bytes = json.dumps(index).encode("utf-8")
+    content: bytes = b"".join(map(lambda part: part[1], parts)) + footer
+    self.write(table_name, key, content, {**metadata, "bundle_index_size": str(len(footer))}, invoke)
+
+  def writer(self, table_name: str, key: str, metadata: Dict[str, str], invoke=True) -> MultipartWriter:
+    return MultipartWriter(self, table_name, key, metadata, invoke, self.part_size, self.upload_concurrency)
 
 
 class Object(Entry):
-  def __init__(self, key: str, resources: Any, statistics: Statistics):
-    Entry.__init__(self, key, resources, statistics)
+  # Objects returned by a listing already know their size, modification time and ETag.
+  # Everything else comes from a single HEAD request that is cached on the object.
+  # Reads send the cached ETag with If-Match, so an object replaced since then is detected and reloaded.
+  # Requests go through the client of the resource, since clients can be shared between threads.
+  # The key of the resource is the stored key, which differs from the key with the token layout.
+  # Objects of a pipeline that doesn't compress or index are never compressed or indexed,
+  # so they don't read their metadata to find out. GETs and HEADs go through the rate limiter of
+  # the database, if it's given, since S3 limits them per prefix.
+  compressed: bool
+  etag: Optional[str]
+  indexed: bool
+  limiter: Optional[RateLimiter]
+  last_modified: Optional[float]
+  length: Optional[int]
+  metadata: Optional[Dict[str, str]]
+
+  def __init__(self, key: str, resources: Any, statistics: Statistics, cache: Optional[BlockCache]=None, length: Optional[int]=None, last_modified: Optional[float]=None, etag: Optional[str]=None, compressed: bool=True, indexed: bool=True, limiter: Optional[RateLimiter]=None):
+    Entry.__init__(self, key, resources, statistics, cache)
+    self.compressed = compressed
+    self.etag = etag
+    self.indexed = indexed
+    self.limiter = limiter
+    self.last_modified = last_modified
+    self.length = length
+    self.metadata = None
+
+  def cache_key(self) -> str:
+    return "{0:s}/{1:s}".format(self.resources.bucket_name, self.resources.key)
 
   def __download__(self, f: BinaryIO) -> int:
-    self.resources.download_fileobj(f)
+    self.resources.meta.client.download_fileobj(self.resources.bucket_name, self.resources.key, f)
     return f.tell()
 
+  def __get__(self, key: str, function: Callable[[], Any]) -> Any:
+    if self.limiter is None:
+      return function()
+    return self.limiter.call("get", "{0:s}/{1:s}".format(self.resources.bucket_name, key), function)
+
+  def __get_object__(self, args: Dict[str, Any]) -> bytes:
+    if self.etag is not None:
+      args["IfMatch"] = self.etag
+    try:
+      response = self.__get__(self.resources.key, lambda: self.resources.meta.client.get_object(Bucket=self.resources.bucket_name, Key=self.resources.key, **args))
+    except botocore.exceptions.ClientError as e:
+      if "IfMatch" not in args or e.response["Error"]["Code"] not in ["PreconditionFailed", "412"]:
+        raise e
+      self.__reload__()
+      return self.__get_object__(args)
+    if self.etag is None:
+      self.etag = response["ETag"]
+    return response["Body"].read()
+
   def __get_content__(self) -> bytes:
-    return self.resources.get()["Body"].read()
+    return self.__get_object__({})
+
+  def __get_frame_index__(self) -> Optional[FrameIndex]:
+    if not self.compressed:
+      return None
+    return Entry.__get_frame_index__(self)
+
+  def __get_index__(self) -> Optional[bytes]:
+    self.statistics.add("read_count")
+    start_time: float = time.time()
+    key: str = "{0:s}/{1:s}".format(Database.index_prefix, self.resources.key)
+    content: bytes = self.__get__(key, lambda: self.resources.meta.client.get_object(Bucket=self.resources.bucket_name, Key=key))["Body"].read()
+    self.statistics.record("get", start_time)
+    self.statistics.add("read_byte_count", len(content))
+    return content
 
   def __get_range__(self, start_index: int, end_index: int) -> bytes:
-    return self.resources.get(Range="bytes={0:d}-{1:d}".format(start_index, end_index))["Body"].read()
-
-  def content_length(self) -> int:
-    return self.resources.content_length
+    return self.__get_object__({"Range": "bytes={0:d}-{1:d}".format(start_index, end_index)})
+
+  def __head__(self):
+    self.statistics.add("read_count")
+    start_time: float = time.time()
+    response = self.__get__(self.resources.key, lambda: self.resources.meta.client.head_object(Bucket=self.resources.bucket_name, Key=self.resources.key))
+    self.statistics.record("head", start_time)
+    self.etag = response["ETag"]
+    self.last_modified = response["LastModified"].timestamp()
+    self.length = response["ContentLength"]
+    self.metadata = response["Metadata"]
+
+  def __reload__(self):
+    # The object was replaced after its head was cached, so cached blocks of it are stale too
+    if self.cache is not None:
+      self.cache.invalidate(self.cache_key())
+    self.frame_index = None
+    self.frame_index_loaded = False
+    self.__head__()
+
+  def __content_length__(self) -> int:
+    if self.length is None:
+      self.__head__()
+    return self.length
+
+  def get_index(self) -> Optional[bytes]:
+    if not self.indexed:
+      return None
+    return Entry.get_index(self)
 
   def get_metadata(self) -> Dict[str, str]:
-    return self.resources.metadata
+    if self.metadata is None:
+      self.__head__()
+    return self.metadata
 
   def last_modified_at(self) -> float:
-    return self.resources.last_modified.timestamp()
+    if self.last_modified is None:
+      self.__head__()
+    return self.last_modified
 
 
 class Bucket(Table):
@@ -207,119 +1811,410 @@ class Bucket(Table):
 
 class S3(Database):
   def __init__(self, params):
-    self.s3 = boto3.resource("s3")
+    # Clients are thread-safe, but resources and sessions aren't
     self.client = boto3.client("lambda")
+    self.local = threading.local()
     self.params = params
-    self.sleep_time = 1
     Database.__init__(self)
-
-  def __download__(self, table_name: str, key: str, f: BinaryIO) -> int:
-    bucket = self.s3.Bucket(table_name)
-    bucket.download_fileobj(key, f)
-    return f.tell()
+    self.coordinator = S3Coordinator(self)
+    # Set on every stage of a pipeline in which a stage compresses its output
+    self.compressed = "codec" in params or ("compressed" in params and params["compressed"])
+    self.indexed = "index" in params and params["index"]
+    if "invoke_concurrency" in params:
+      self.invoke_concurrency = params["invoke_concurrency"]
+    if "cache_memory_size" in params:
+      block_size: int = params["cache_block_size"] if "cache_block_size" in params else 1000*1000
+      disk_size: int = params["cache_disk_size"] if "cache_disk_size" in params else 0
+      self.cache = BlockCache(block_size, params["cache_memory_size"] * 1000 * 1000, disk_size * 1000 * 1000)
+    if "codec" in params:
+      frame_size: int = params["codec_frame_size"] if "codec_frame_size" in params else 1000*1000
+      self.codec = Codec(params["codec"], frame_size)
+
+  @property
+  def s3(self) -> Any:
+    # Each thread gets its own session and resource
+    if not hasattr(self.local, "s3"):
+      self.local.s3 = boto3.session.Session().resource("s3")
+    return self.local.s3
+
+  def __abort_upload__(self, table_name: str, key: str, upload_id: str):
+    self.s3.meta.client.abort_multipart_upload(Bucket=table_name, Key=key, UploadId=upload_id)
+
+  def __complete_upload__(self, table_name: str, key: str, upload_id: str, parts: List[Dict[str, Any]], metadata: Optional[Dict[str, str]], invoke: bool):
+    self.s3.meta.client.complete_multipart_upload(Bucket=table_name, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    if metadata is not None:
+      # Only the prefix 0 uploads have S3 triggers, so copying in place doesn't re-trigger the pipeline.
+      self.__replace_metadata__(table_name, key, metadata)
+    self.__trigger__(table_name, key, invoke)
+
+  def __replace_metadata__(self, table_name: str, key: str, metadata: Dict[str, str]):
+    source: Dict[str, str] = {"Bucket": table_name, "Key": key}
+    length: int = self.s3.meta.client.head_object(**source)["ContentLength"]
+    if length <= MultipartWriter.max_copy_size:
+      self.s3.meta.client.copy_object(Bucket=table_name, Key=key, CopySource=source, Metadata=metadata, MetadataDirective="REPLACE")
+      return
+
+    # Objects over 5 GB can only be copied in parts
+    upload_id: str = self.s3.meta.client.create_multipart_upload(Bucket=table_name, Key=key, Metadata=metadata)["UploadId"]
+    parts: List[Dict[str, Any]] = []
+    try:
+      for start_index in range(0, length, MultipartWriter.max_copy_size):
+        end_index: int = min(start_index + MultipartWriter.max_copy_size, length) - 1
+        response = self.s3.meta.client.upload_part_copy(
+          Bucket=table_name,
+          Key=key,
+          UploadId=upload_id,
+          PartNumber=len(parts) + 1,
+          CopySource=source,
+          CopySourceRange="bytes={0:d}-{1:d}".format(start_index, end_index),
+        )
+        parts.append({"ETag": response["CopyPartResult"]["ETag"], "PartNumber": len(parts) + 1})
+      self.s3.meta.client.complete_multipart_upload(Bucket=table_name, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except Exception as e:
+      self.s3.meta.client.abort_multipart_upload(Bucket=table_name, Key=key, UploadId=upload_id)
+      raise e
+
+  def __create_upload__(self, table_name: str, key: str, metadata: Dict[str, str]) -> str:
+    return self.s3.meta.client.create_multipart_upload(Bucket=table_name, Key=key, Metadata=metadata)["UploadId"]
+
+  def __delete__(self, table_name: str, keys: List[str]):
+    response = self.limiter.call("put", "{0:s}/{1:s}".format(table_name, keys[0]), lambda: self.s3.meta.client.delete_objects(
+      Bucket=table_name,
+      Delete={"Objects": list(map(lambda key: {"Key": key}, keys)), "Quiet": True},
+    ))
+    if "Errors" in response and len(response["Errors"]) > 0:
+      raise Exception("S3::__delete__ failed to delete", response["Errors"])
 
   def __get_content__(self, table_name: str, key: str, start_byte: int, end_byte: int) -> bytes:
     obj = self.s3.Object(table_name, key)
-    return obj.get(Range="bytes={0:d}-{1:d}".format(start_byte, end_byte))["Body"].read()
-
-  def __get_entries__(self, table_name: str, prefix: Optional[str]=None) -> List[Entry]:
-    done = False
-    bucket = self.s3.Bucket(table_name)
-    while not done:
-      try:
-        if prefix:
-          objects = bucket.objects.filter(Prefix=prefix)
-        else:
-          objects = bucket.objects.all()
-        objects = list(map(lambda obj: Object(obj.key, self.s3.Object(table_name, obj.key), self.statistics), objects))
-        done = True
-        self.sleep_time = min(max(int(self.sleep_time / 2), 1), self.max_sleep_time)
-      except Exception as e:
-        time.sleep(self.sleep_time)
-        self.sleep_time *= 2
-
-    return objects
+    return self.limiter.call("get", "{0:s}/{1:s}".format(table_name, key), lambda: obj.get(Range="bytes={0:d}-{1:d}".format(start_byte, end_byte)))["Body"].read()
+
+  def __get_entries_page__(self, table_name: str, prefix: Optional[str], token: Optional[str]) -> Tuple[List[Entry], Optional[str]]:
+    args: Dict[str, Any] = {"Bucket": table_name}
+    if prefix:
+      args["Prefix"] = prefix
+    if token:
+      args["ContinuationToken"] = token
+
+    response = self.limiter.call("list", "{0:s}/{1:s}".format(table_name, prefix if prefix else ""), lambda: self.s3.meta.client.list_objects_v2(**args))
+    objects = response["Contents"] if "Contents" in response else []
+    entries: List[Entry] = list(map(lambda obj: Object(
+      KeyLayout.to_standard(obj["Key"]),
+      self.s3.Object(table_name, obj["Key"]),
+      self.statistics,
+      self.cache,
+      obj["Size"],
+      obj["LastModified"].timestamp(),
+      obj["ETag"],
+      self.compressed,
+      self.indexed,
+      self.limiter,
+    ), objects))
+    next_token: Optional[str] = response["NextContinuationToken"] if response["IsTruncated"] else None
+    return (entries, next_token)
+
+  def __invoke__(self, name: str, payload: Dict[str, Any]):
+    response = self.client.invoke(
+      FunctionName=name,
+      InvocationType="Event",
+      Payload=json.JSONEncoder().encode(payload)
+    )
+    assert(response["ResponseMetadata"]["HTTPStatusCode"] == 202)
 
   def __put__(self, table_name: str, key: str, content: BinaryIO, metadata: Dict[str, str], invoke=True):
     self.__s3_write__(table_name, key, content, metadata)
 
   def __read__(self, table_name: str, key: str) -> bytes:
     obj = self.s3.Object(table_name, key)
-    content = obj.get()["Body"].read()
+    content = self.limiter.call("get", "{0:s}/{1:s}".format(table_name, key), lambda: obj.get())["Body"].read()
     return content
 
   def __write__(self, table_name: str, key: str, content: bytes, metadata: Dict[str, str], invoke=True):
     self.__s3_write__(table_name, key, content, metadata, invoke)
 
   def __s3_write__(self, table_name: str, key: str, content: Union[bytes, BinaryIO], metadata: Dict[str, str], invoke=True):
-    done: bool = False
-    while not done:
-      try:
-        self.s3.Object(table_name, key).put(Body=content, Metadata=metadata)
-        self.sleep_time = min(max(int(self.sleep_time / 2), 1), self.max_sleep_time)
-        done = True
-      except botocore.exceptions.ClientError as e:
-        print("Warning: S3::write Rate Limited. Sleeping for", self.sleep_time)
-        time.sleep(self.sleep_time)
-        self.sleep_time *= 2
-
-    if "output_function" in self.params and invoke:
-      payload = {
-        "Records": [{
-          "s3": {
-            "bucket": {
-              "name": table_name
-            },
-            "object": {
-              "key": key
-            },
-            "ancestry": self.params["ancestry"],
-          },
-        }]
-      }
-      if "reexecute" in self.params:
-        payload["execute"] = self.params["reexecute"]
-      self.payloads.append(payload)
-      self.invoke(self.params["output_function"], payload)
+    def put():
+      if not isinstance(content, bytes):
+        # Upload the whole file again if a previous attempt was throttled
+        content.seek(0)
+      self.s3.Object(table_name, key).put(Body=content, Metadata=metadata)
+
+    self.limiter.call("put", "{0:s}/{1:s}".format(table_name, key), put)
+    self.__trigger__(table_name, key, invoke)
+
+  def __upload_part__(self, table_name: str, key: str, upload_id: str, part_number: int, content: bytes) -> str:
+    response = self.limiter.call("put", "{0:s}/{1:s}".format(table_name, key), lambda: self.s3.meta.client.upload_part(
+      Bucket=table_name,
+      Key=key,
+      UploadId=upload_id,
+      PartNumber=part_number,
+      Body=content,
+    ))
+    return response["ETag"]
+
+  def __upload_part_copy__(self, table_name: str, key: str, upload_id: str, part_number: int, entry: Entry, start_index: int, end_index: int) -> str:
+    response = self.limiter.call("put", "{0:s}/{1:s}".format(table_name, key), lambda: self.s3.meta.client.upload_part_copy(
+      Bucket=table_name,
+      Key=key,
+      UploadId=upload_id,
+      PartNumber=part_number,
+      CopySource={"Bucket": entry.resources.bucket_name, "Key": entry.resources.key},
+      CopySourceRange="bytes={0:d}-{1:d}".format(start_index, end_index),
+    ))
+    return response["CopyPartResult"]["ETag"]
 
   def contains(self, table_name: str, key: str) -> bool:
     try:
-      self.s3.Object(table_name, key).load()
+      obj = self.s3.Object(table_name, self.__physical_key__(key))
+      self.limiter.call("get", "{0:s}/{1:s}".format(table_name, obj.key), obj.load)
       return True
     except Exception:
       return False
 
   def get_entry(self, table_name: str, key: str) -> Optional[Object]:
-    return Object(key, self.s3.Object(table_name, key), self.statistics)
+    # Reuse the entry so its cached head isn't requested again during this invocation
+    entry: Optional[Entry] = self.entries.get((table_name, key))
+    if entry is None:
+      entry = self.entries.setdefault((table_name, key), Object(key, self.s3.Object(table_name, self.__physical_key__(key)), self.statistics, self.cache, compressed=self.compressed, indexed=self.indexed, limiter=self.limiter))
+    return entry
 
   def get_table(self, table_name: str) -> Table:
     return Table(table_name, self.statistics, self.s3)
 
-  def create_payload(self, table_name: str, key: str, extra: Dict[str, Any]) -> Dict[str, Any]:
-    payload = {
-      "Records": [{
-        "s3": {
-          "bucket": {
-            "name": table_name
-          },
-          "object": {
-            "key": key
-          },
-          "extra_params": extra,
-          "ancestry": self.params["ancestry"],
-        }
-      }]
-    }
 
-    if "reexecute" in self.params:
-      payload["execute"] = self.params["reexecute"]
-    return payload
+class LocalEntry(Entry):
+  # Entry backed by a file. Ranges are served from a memory map of the file,
+  # so reads don't copy the content through a read buffer.
+  path: str
 
-  def invoke(self, name, payload):
-    self.payloads.append(payload)
-    response = self.client.invoke(
-      FunctionName=name,
-      InvocationType="Event",
-      Payload=json.JSONEncoder().encode(payload)
-    )
-    assert(response["ResponseMetadata"]["HTTPStatusCode"] == 202)
+  def __init__(self, key: str, path: str, statistics: Statistics, cache: Optional[BlockCache]=None):
+    Entry.__init__(self, key, None, statistics, cache)
+    self.map: Optional[mmap.mmap] = None
+    self.path = path
+
+  def __download__(self, f: BinaryIO) -> int:
+    with open(self.path, "rb") as g:
+      shutil.copyfileobj(g, f)
+    return f.tell()
+
+  def __get_content__(self) -> bytes:
+    return self.__get_range__(0, self.__content_length__() - 1)
+
+  def __get_range__(self, start_index: int, end_index: int) -> bytes:
+    # get_range returns bytes, so the range is copied out of the map. Readers that don't need
+    # bytes take get_view instead.
+    m: Optional[mmap.mmap] = self.__get_map__()
+    if m is None:
+      return b""
+    return m[start_index:end_index + 1]
+
+  def __get_index__(self) -> Optional[bytes]:
+    with open(LocalDatabase.index_path(self.path), "rb") as f:
+      return f.read()
+
+  def __get_map__(self) -> Optional[mmap.mmap]:
+    if self.map is None and self.__content_length__() > 0:
+      with open(self.path, "rb") as f:
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return self.map
+
+  def cache_key(self) -> str:
+    return self.path
+
+  def close(self):
+    if self.map is not None:
+      self.map.close()
+      self.map = None
+
+  def __content_length__(self) -> int:
+    return os.path.getsize(self.path)
+
+  def get_metadata(self) -> Dict[str, str]:
+    metadata_path: str = LocalDatabase.metadata_path(self.path)
+    if not os.path.isfile(metadata_path):
+      return {}
+    with open(metadata_path, "r") as f:
+      return json.loads(f.read())
+
+  def get_view(self, start_index: int, end_index: int) -> memoryview:
+    # Zero-copy view of the range. The view is only valid until the entry is closed.
+    if self.cache is not None or len(self.plans) > 0 or self.is_compressed():
+      return Entry.get_view(self, start_index, end_index)
+    m: Optional[mmap.mmap] = self.__get_map__()
+    if m is None:
+      return memoryview(b"")
+    view: memoryview = memoryview(m)[start_index:end_index + 1]
+    self.statistics.add("read_count")
+    self.statistics.add("read_byte_count", len(view))
+    return view
+
+  def last_modified_at(self) -> float:
+    return os.path.getmtime(self.path)
+
+
+class LocalTable(Table):
+  def __init__(self, name: str, statistics: Statistics, resources: Any):
+    Table.__init__(self, name, statistics, resources)
+
+
+class LocalDatabase(Database):
+  # Database that stores each table as a directory under root. Keys map to paths in the
+  # directory. Writes go to a temporary file that is renamed into place, so readers never
+  # see a partially written object.
+  hidden_prefix: str = ".ripple"
+  manifest_prefix: str = ".ripple-manifest"
+  root: str
+
+  def __init__(self, root: str, params: Optional[Dict[str, Any]]=None):
+    Database.__init__(self)
+    if params is None:
+      params = {}
+    self.coordinator = LocalCoordinator(root)
+    self.params = params
+    self.root = root
+    if "codec" in params:
+      frame_size: int = params["codec_frame_size"] if "codec_frame_size" in params else 1000*1000
+      self.codec = Codec(params["codec"], frame_size)
+    self.upload_count = 0
+    self.upload_lock = threading.Lock()
+
+  @classmethod
+  def index_path(cls: Any, path: str) -> str:
+    [directory, name] = os.path.split(path)
+    return "{0:s}/{1:s}.{2:s}.index".format(directory, cls.hidden_prefix, name)
+
+  @classmethod
+  def metadata_path(cls: Any, path: str) -> str:
+    [directory, name] = os.path.split(path)
+    return "{0:s}/{1:s}.{2:s}.metadata".format(directory, cls.hidden_prefix, name)
+
+  def __abort_upload__(self, table_name: str, key: str, upload_id: str):
+    shutil.rmtree(upload_id)
+
+  def __complete_upload__(self, table_name: str, key: str, upload_id: str, parts: List[Dict[str, Any]], metadata: Optional[Dict[str, str]], invoke: bool):
+    path: str = self.__path__(table_name, key)
+    temp_path: str = self.__temp_path__(path)
+    with open(temp_path, "wb+") as f:
+      for part in parts:
+        with open("{0:s}/{1:d}".format(upload_id, part["PartNumber"]), "rb") as g:
+          shutil.copyfileobj(g, f)
+    if metadata is None:
+      with open("{0:s}/metadata".format(upload_id), "r") as g:
+        metadata = json.loads(g.read())
+    self.__write_metadata__(path, metadata)
+    os.replace(temp_path, path)
+    shutil.rmtree(upload_id)
+    self.__trigger__(table_name, key, invoke)
+
+  def __create_upload__(self, table_name: str, key: str, metadata: Dict[str, str]) -> str:
+    with self.upload_lock:
+      self.upload_count += 1
+      upload_id: str = "{0:s}/{1:s}/{2:s}.upload-{3:d}-{4:d}".format(self.root, table_name, self.hidden_prefix, os.getpid(), self.upload_count)
+    os.makedirs(upload_id)
+    with open("{0:s}/metadata".format(upload_id), "w+") as f:
+      f.write(json.dumps(metadata))
+    return upload_id
+
+  def __delete__(self, table_name: str, keys: List[str]):
+    for key in keys:
+      path: str = self.__path__(table_name, key)
+      for p in [path, self.index_path(path), self.metadata_path(path)]:
+        if os.path.isfile(p):
+          os.remove(p)
+
+  def __get_entries__(self, table_name: str, prefix: Optional[str]=None) -> List[Entry]:
+    directory: str = "{0:s}/{1:s}".format(self.root, table_name)
+    keys: List[str] = []
+    for [path, folders, files] in os.walk(directory):
+      folders[:] = list(filter(lambda folder: not folder.startswith(self.hidden_prefix), folders))
+      for name in files:
+        if not name.startswith(self.hidden_prefix):
+          keys.append(os.path.relpath(os.path.join(path, name), directory))
+    if prefix:
+      keys = list(filter(lambda key: key.startswith(prefix), keys))
+    keys.sort()
+    return list(map(lambda key: LocalEntry(KeyLayout.to_standard(key), self.__path__(table_name, key), self.statistics, self.cache), keys))
+
+  def __path__(self, table_name: str, key: str) -> str:
+    return "{0:s}/{1:s}/{2:s}".format(self.root, table_name, key)
+
+  def __put__(self, table_name: str, key: str, content: BinaryIO, metadata: Dict[str, str], invoke=True):
+    path: str = self.__path__(table_name, key)
+    temp_path: str = self.__temp_path__(path)
+    with open(temp_path, "wb+") as f:
+      shutil.copyfileobj(content, f)
+    self.__write_metadata__(path, metadata)
+    os.replace(temp_path, path)
+    self.__trigger__(table_name, key, invoke)
+
+  def __read__(self, table_name: str, key: str) -> bytes:
+    with open(self.__path__(table_name, key), "rb") as f:
+      return f.read()
+
+  def __temp_path__(self, path: str) -> str:
+    [directory, name] = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    return "{0:s}/{1:s}.{2:s}.{3:d}-{4:d}".format(directory, self.hidden_prefix, name, os.getpid(), threading.get_ident())
+
+  def __upload_part__(self, table_name: str, key: str, upload_id: str, part_number: int, content: bytes) -> str:
+    with open("{0:s}/{1:d}".format(upload_id, part_number), "wb+") as f:
+      f.write(content)
+    return str(part_number)
+
+  def __upload_part_copy__(self, table_name: str, key: str, upload_id: str, part_number: int, entry: Entry, start_index: int, end_index: int) -> str:
+    with open("{0:s}/{1:d}".format(upload_id, part_number), "wb+") as f:
+      if isinstance(entry, LocalEntry):
+        f.write(entry.get_view(start_index, end_index))
+      else:
+        f.write(entry.get_range(start_index, end_index))
+    return str(part_number)
+
+  def __write__(self, table_name: str, key: str, content: bytes, metadata: Dict[str, str], invoke=True):
+    path: str = self.__path__(table_name, key)
+    temp_path: str = self.__temp_path__(path)
+    with open(temp_path, "wb+") as f:
+      f.write(content)
+    self.__write_metadata__(path, metadata)
+    os.replace(temp_path, path)
+    self.__trigger__(table_name, key, invoke)
+
+  def __write_index__(self, table_name: str, key: str, content: bytes):
+    path: str = self.index_path(self.__path__(table_name, key))
+    temp_path: str = self.__temp_path__(path)
+    with open(temp_path, "wb+") as f:
+      f.write(content)
+    os.replace(temp_path, path)
+
+  def __write_metadata__(self, path: str, metadata: Dict[str, str]):
+    metadata_path: str = self.metadata_path(path)
+    if len(metadata) == 0:
+      if os.path.isfile(metadata_path):
+        os.remove(metadata_path)
+      return
+    temp_path: str = self.__temp_path__(metadata_path)
+    with open(temp_path, "w+") as f:
+      f.write(json.dumps(metadata))
+    os.replace(temp_path, metadata_path)
+
+  def contains(self, table_name: str, key: str) -> bool:
+    return os.path.isfile(self.__path__(table_name, self.__physical_key__(key)))
+
+  def create_table(self, table_name: str) -> LocalTable:
+    os.makedirs("{0:s}/{1:s}".format(self.root, table_name), exist_ok=True)
+    return self.get_table(table_name)
+
+  def get_entry(self, table_name: str, key: str) -> Optional[Entry]:
+    entry: Optional[Entry] = self.entries.get((table_name, key))
+    if entry is not None:
+      return entry
+    path: str = self.__path__(table_name, self.__physical_key__(key))
+    if not os.path.isfile(path):
+      return None
+    return LocalEntry(key, path, self.statistics, self.cache)
+
+  def get_table(self, table_name: str) -> LocalTable:
+    return LocalTable(table_name, self.statistics, "{0:s}/{1:s}".format(self.root, table_name))
+
+  def __invoke__(self, name: str, payload: Dict[str, Any]):
+    # There is no function to invoke locally. The recorded payloads are run by the caller.
+    pass
@@ -1,7 +1,7 @@
 import new_line
 from enum import Enum
 from iterator import OffsetBounds, Options
-from typing import Any, ClassVar, Generic, List, Optional, TypeVar
+from typing import Any, ClassVar, Generic, List, Optional, TypeVar, Union
 
 
 T = TypeVar("T")
@@ -23,3 +23,7 @@ class Iterator(new_line.Iterator):
     parts = item.split(b"\t")
     return float(parts[identifier.value + 1])
 
+  @classmethod
+  def get_identifier_values(cls: Any, content_or_items: Union[bytes, List[bytes]], identifier: T) -> Any:
+    return cls.__column_values__(content_or_items, identifier.value + 1, b"\t", identifier)
+
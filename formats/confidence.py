@@ -1,8 +1,8 @@
 import tsv
 import util
 from enum import Enum
-from iterator import OffsetBounds
-from typing import Any, BinaryIO, ClassVar, Dict, List, Optional, Tuple
+from iterator import OffsetBounds, Options
+from typing import Any, BinaryIO, ClassVar, Dict, List, Optional, Tuple, Union
 
 
 class Identifiers(Enum):
@@ -21,6 +21,10 @@ class Iterator(tsv.Iterator[Identifiers]):
   def get_identifier_value(cls: Any, item: str, identifier: Identifiers) -> float:
     return float(cls.to_tsv_array(item)[identifier])
 
+  @classmethod
+  def get_identifier_values(cls: Any, content_or_items: Union[bytes, List[bytes]], identifier: Identifiers) -> Any:
+    return cls.__column_values__(content_or_items, identifier.value, str.encode(cls.item_delimiter), identifier)
+
   def sum(self, identifier: Identifiers) -> int:
     [count, total] = self.fraction(identifier)
     return count
@@ -31,8 +35,11 @@ class Iterator(tsv.Iterator[Identifiers]):
     total: int = 0
     while more:
       total += 1
-      [items, _, more] = self.next()
-      for item in items:
-        if float(self.get_identifier_value(item, Identifiers.qvalue)) <= self.threshold:
-          count += 1
+      [items, offset_bounds, more] = self.next()
+      items = list(items)
+      # The header is the first line of the file, so it's skipped in the first window
+      if self.options.has_header and offset_bounds is not None and offset_bounds.start_index == 0:
+        items = items[1:]
+      values = self.get_identifier_values(items, Identifiers.qvalue)
+      count += sum(map(lambda value: value <= self.threshold, values))
     return (count, total)
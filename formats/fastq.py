@@ -11,7 +11,7 @@ class Identifiers(Enum):
 
 
 class Iterator(iterator.Iterator[Identifiers]):
-  delimiter: Delimiter = Delimiter(item_token="\n", offset_token="\n", position=DelimiterPosition.inbetween, regex=b"(@([^\n]*\n){3}[^\n]*)")
+  delimiter: Delimiter = Delimiter(item_token="\n", offset_token="\n", position=DelimiterPosition.inbetween, regex=b"(@([^\n]*\n){3}[^\n]*)", record_start="@", record_lines=4)
   options: ClassVar[Options] = Options(has_header = False)
   identifiers: Identifiers
   signature_length: ClassVar[int] = 8
@@ -1,11 +1,21 @@
+import bisect
 import boto3
+import collections
 import heapq
-import os
+import itertools
 import re
+import struct
 import util
-from database import Entry
+from concurrent.futures import Future, ThreadPoolExecutor
+from database import Entry, MultipartWriter
 from enum import Enum
-from typing import Any, BinaryIO, ClassVar, Dict, Generic, Iterable, List, Optional, Tuple, TypeVar
+from typing import Any, BinaryIO, ClassVar, Dict, Generic, Iterable, List, Optional, Tuple, TypeVar, Union
+
+# NumPy comes from a layer on Lambda, so functions without it fall back to lists
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 
 T = TypeVar("T")
@@ -17,10 +27,178 @@ class DelimiterPosition(Enum):
   end = 3
 
 
+class Tokenizer:
+  # Finds the delimiters and items of a format in a chunk. The tokenizers give the same
+  # results, and Delimiter uses the fastest one that supports it for each operation.
+  name: ClassVar[str] = "tokenizer"
+  non_whitespace_regex: ClassVar[Any] = re.compile(rb"\S")
+
+  def __init__(self, delimiter: "Delimiter"):
+    self.delimiter = delimiter
+
+  @classmethod
+  def supports(cls: Any, delimiter: "Delimiter") -> bool:
+    raise Exception("Tokenizer::supports not implemented")
+
+  def item_tokens(self, content: bytes) -> Iterable[Tuple[int, int]]:
+    raise Exception("Tokenizer::item_tokens not implemented")
+
+  def last_offset_token(self, content: bytes) -> int:
+    # Start of the last offset token, or -1 if the content doesn't have one
+    raise Exception("Tokenizer::last_offset_token not implemented")
+
+  def item_spans(self, content: bytes) -> Optional[List[Tuple[int, int]]]:
+    # Spans of the items to_array splits the content into, or None if an item isn't a slice of the content
+    spans: List[Tuple[int, int]] = []
+    start: int = 0
+    token_length: int = len(self.delimiter.item_token)
+    for [token_start, token_end] in itertools.chain(self.item_tokens(content), [(len(content), len(content))]):
+      if self.non_whitespace_regex.search(content, start, token_start) is not None:
+        if self.delimiter.position == DelimiterPosition.inbetween:
+          spans.append((start, token_start))
+        elif self.delimiter.position == DelimiterPosition.start:
+          if start == 0:
+            return None
+          spans.append((start - token_length, token_start))
+        else:
+          if token_start == len(content):
+            return None
+          spans.append((start, token_end))
+      start = token_end
+    return spans
+
+
+class RegexTokenizer(Tokenizer):
+  # Supports every delimiter
+  name: ClassVar[str] = "regex"
+
+  @classmethod
+  def supports(cls: Any, delimiter: "Delimiter") -> bool:
+    return True
+
+  def item_spans(self, content: bytes) -> Optional[List[Tuple[int, int]]]:
+    if self.delimiter.regex is not None:
+      group: int = 1 if self.delimiter.regex.groups > 0 else 0
+      return list(map(lambda m: m.span(group), self.delimiter.regex.finditer(content)))
+    return Tokenizer.item_spans(self, content)
+
+  def item_tokens(self, content: bytes) -> Iterable[Tuple[int, int]]:
+    return map(lambda m: m.span(), self.delimiter.item_regex.finditer(content))
+
+  def last_offset_token(self, content: bytes) -> int:
+    start: int = -1
+    for m in self.delimiter.offset_regex.finditer(content):
+      start = m.start()
+    return start
+
+
+class FindTokenizer(Tokenizer):
+  # Searches for the tokens with bytes.find and bytes.rfind. Tokens of start delimiters
+  # only count at the start of a line, as with the regex.
+  metacharacters: ClassVar[bytes] = b".^$*+?{}[]\\|()"
+  name: ClassVar[str] = "find"
+
+  def __init__(self, delimiter: "Delimiter"):
+    Tokenizer.__init__(self, delimiter)
+    self.line_start: bool = delimiter.position == DelimiterPosition.start
+
+  @classmethod
+  def overlaps(cls: Any, token: bytes) -> bool:
+    # Whether two matches of the token can overlap, in which case the last match
+    # isn't necessarily where rfind finds the token
+    return any(map(lambda i: token[:i] == token[-i:], range(1, len(token))))
+
+  @classmethod
+  def plain(cls: Any, delimiter: "Delimiter") -> bool:
+    # Whether the tokens match themselves, so they can be searched for as they are
+    tokens: List[bytes] = [delimiter.item_token, delimiter.offset_token]
+    return all(map(lambda token: len(token) > 0 and not any(map(lambda c: c in cls.metacharacters, token)), tokens))
+
+  @classmethod
+  def supports(cls: Any, delimiter: "Delimiter") -> bool:
+    return delimiter.regex is None and cls.plain(delimiter)
+
+  def __find__(self, content: bytes, token: bytes) -> Iterable[Tuple[int, int]]:
+    # Matches don't overlap, as with re.finditer
+    start: int = content.find(token)
+    while start != -1:
+      if not self.line_start or start == 0 or content[start - 1] == 10:
+        yield (start, start + len(token))
+        start = content.find(token, start + len(token))
+      else:
+        start = content.find(token, start + 1)
+
+  def item_spans(self, content: bytes) -> Optional[List[Tuple[int, int]]]:
+    if self.line_start:
+      return Tokenizer.item_spans(self, content)
+    # Tokens that don't need to be at the start of a line are split on all at once, which
+    # matches them from left to right like the regex
+    token_length: int = len(self.delimiter.item_token)
+    pieces: List[bytes] = content.split(self.delimiter.item_token)
+    starts: List[int] = self.__starts__(pieces, 0, token_length)
+    items: List[int] = list(itertools.compress(range(len(pieces)), map(bytes.strip, pieces)))
+    if self.delimiter.position == DelimiterPosition.inbetween:
+      return [(starts[i], starts[i + 1] - token_length) for i in items]
+    if len(items) > 0 and items[-1] == len(pieces) - 1:
+      # The last item doesn't end with a token
+      return None
+    return [(starts[i], starts[i + 1]) for i in items]
+
+  @classmethod
+  def __starts__(cls: Any, pieces: List[bytes], start: int, separator_length: int) -> List[int]:
+    # Offsets of the pieces of a split content, and the end of the content plus one separator
+    offsets: List[int] = [start]
+    for piece in pieces:
+      offsets.append(offsets[-1] + len(piece) + separator_length)
+    return offsets
+
+  def item_tokens(self, content: bytes) -> Iterable[Tuple[int, int]]:
+    return self.__find__(content, self.delimiter.item_token)
+
+  def last_offset_token(self, content: bytes) -> int:
+    token: bytes = self.delimiter.offset_token
+    if self.overlaps(token):
+      # The last match depends on every match before it, which the regex finds faster
+      start: int = -1
+      for m in self.delimiter.offset_regex.finditer(content):
+        start = m.start()
+      return start
+    start = content.rfind(token)
+    while start > 0 and self.line_start and content[start - 1] != 10:
+      start = content.rfind(token, 0, start + len(token) - 1)
+    return start
+
+
+class LineTokenizer(FindTokenizer):
+  # Finds the offsets of formats whose items are records of a fixed number of lines, such as
+  # the 4 line fastq record. The offset token ends every line, so the last one is found with
+  # rfind even though the records need the regex. It isn't used to split chunks into items.
+  name: ClassVar[str] = "line"
+
+  @classmethod
+  def supports(cls: Any, delimiter: "Delimiter") -> bool:
+    return cls.plain(delimiter) and delimiter.record_start is not None and delimiter.record_lines > 0
+
+  def item_spans(self, content: bytes) -> Optional[List[Tuple[int, int]]]:
+    raise Exception("LineTokenizer::item_spans not supported")
+
+  def item_tokens(self, content: bytes) -> Iterable[Tuple[int, int]]:
+    raise Exception("LineTokenizer::item_tokens not supported")
+
+
 class Delimiter:
-  def __init__(self, item_token: str, offset_token: str, position: DelimiterPosition, regex=None):
+  # Fastest first for each operation, as measured by tests/tokenizer_benchmark.py. RegexTokenizer
+  # supports every delimiter, so it's last.
+  item_tokenizers: ClassVar[List[Any]] = [FindTokenizer, RegexTokenizer]
+  offset_tokenizers: ClassVar[List[Any]] = [LineTokenizer, FindTokenizer, RegexTokenizer]
+
+  def __init__(self, item_token: str, offset_token: str, position: DelimiterPosition, regex=None, record_start: Optional[str] = None, record_lines: int = 0):
+    # If regex is set, items are its matches. Formats whose regex matches records of record_lines
+    # lines starting with record_start set both, so offsets can be found without the regex.
     self.item_token = str.encode(item_token)
     self.offset_token = str.encode(offset_token)
+    self.record_lines = record_lines
+    self.record_start: Optional[bytes] = str.encode(record_start) if record_start is not None else None
     if regex:
       self.regex = re.compile(regex, re.MULTILINE)
     else:
@@ -32,6 +210,11 @@ class Delimiter:
       self.item_regex = re.compile(self.item_token)
       self.offset_regex = re.compile(self.offset_token)
     self.position = position
+    self.item_tokenizer: Tokenizer = self.fastest(self.item_tokenizers)
+    self.offset_tokenizer: Tokenizer = self.fastest(self.offset_tokenizers)
+
+  def fastest(self, tokenizers: List[Any]) -> Tokenizer:
+    return next(filter(lambda tokenizer: tokenizer.supports(self), tokenizers))(self)
 
 
 class OffsetBounds:
@@ -47,6 +230,156 @@ class OffsetBounds:
     return "[{0:d},{1:d}]".format(self.start_index, self.end_index)
 
 
+class ItemIndex:
+  # Byte spans of the items of an object, stored next to it by Database.write_index.
+  # Each span starts at the first byte of an item and ends after its last byte. If the
+  # stage has an identifier, the index also holds the identifier value of each item.
+  header: ClassVar[struct.Struct] = struct.Struct("<4sHQ")
+  magic: ClassVar[bytes] = b"RIX1"
+
+  def __init__(self, identifier: Optional[str] = None):
+    self.ends: List[int] = []
+    self.identifier = identifier
+    self.starts: List[int] = []
+    self.values: Optional[List[float]] = [] if identifier is not None else None
+
+  def __len__(self):
+    return len(self.starts)
+
+  def add(self, start: int, end: int, value: Optional[float] = None):
+    assert(start < end)
+    assert(len(self.ends) == 0 or self.ends[-1] <= start)
+    self.starts.append(start)
+    self.ends.append(end)
+    if self.values is not None:
+      self.values.append(value)
+
+  def align(self, start_byte: int, end_byte: int, content_length: int) -> Tuple[int, int]:
+    # Items belong to the range their first byte is in, and the range is extended to the
+    # start of the next item, so it includes any delimiter after its last item.
+    i: int = bisect.bisect_left(self.starts, start_byte)
+    j: int = bisect.bisect_right(self.starts, end_byte)
+    start_index: int = self.starts[i] if i < len(self.starts) and start_byte > 0 else start_byte
+    end_index: int = self.starts[j] - 1 if j < len(self.starts) else content_length - 1
+    return (start_index, end_index)
+
+  def find(self, start_byte: int, end_byte: int) -> Tuple[int, int]:
+    # Positions of the items that are entirely inside the inclusive byte range
+    i: int = bisect.bisect_left(self.starts, start_byte)
+    j: int = bisect.bisect_right(self.ends, end_byte + 1)
+    return (i, max(i, j))
+
+  def split(self, split_size: int, content_length: int) -> List[Tuple[int, int]]:
+    # Inclusive byte ranges of roughly split_size bytes that start at the start of an item
+    ranges: List[Tuple[int, int]] = []
+    start_index: int = 0
+    for start in self.starts:
+      if start - start_index >= split_size:
+        ranges.append((start_index, start - 1))
+        start_index = start
+    ranges.append((start_index, content_length - 1))
+    return ranges
+
+  @classmethod
+  def from_bytes(cls: Any, content: bytes) -> "ItemIndex":
+    [magic, identifier_length, count] = cls.header.unpack_from(content, 0)
+    assert(magic == cls.magic)
+    offset: int = cls.header.size
+    identifier: Optional[str] = None
+    if identifier_length > 0:
+      identifier = content[offset:offset + identifier_length].decode("utf-8")
+      offset += identifier_length
+    index = ItemIndex(identifier)
+    index.starts = list(struct.unpack_from("<{0:d}Q".format(count), content, offset))
+    offset += 8 * count
+    index.ends = list(struct.unpack_from("<{0:d}Q".format(count), content, offset))
+    offset += 8 * count
+    if identifier is not None:
+      index.values = list(struct.unpack_from("<{0:d}d".format(count), content, offset))
+    return index
+
+  @classmethod
+  def identifier_name(cls: Any, identifier: Any) -> str:
+    # Identifiers are enums of the format in some stages and names in others
+    return identifier.name if isinstance(identifier, Enum) else str(identifier)
+
+  def extend(self, other: "ItemIndex", shift: int):
+    # Appends the items of another object that was written at the offset shift
+    for i in range(len(other)):
+      value: Optional[float] = other.values[i] if other.values is not None else None
+      self.add(other.starts[i] + shift, other.ends[i] + shift, value)
+
+  def get_values(self, i: int, j: int) -> Optional[List[float]]:
+    if self.values is None:
+      return None
+    return self.values[i:j]
+
+  def to_bytes(self) -> bytes:
+    identifier: bytes = self.identifier.encode("utf-8") if self.identifier is not None else b""
+    count: int = len(self.starts)
+    content: bytes = self.header.pack(self.magic, len(identifier), count) + identifier
+    content += struct.pack("<{0:d}Q".format(count), *self.starts)
+    content += struct.pack("<{0:d}Q".format(count), *self.ends)
+    if self.values is not None:
+      content += struct.pack("<{0:d}d".format(count), *self.values)
+    return content
+
+
+class ItemViews:
+  # Items of a chunk as spans of one shared buffer. An item is only copied out of the
+  # buffer when it's read, and runs of items that are adjacent in the buffer are written
+  # or joined with one slice.
+  def __init__(self, buffer: bytes, starts: List[int], ends: List[int]):
+    assert(len(starts) == len(ends))
+    self.buffer = buffer
+    self.ends = ends
+    self.starts = starts
+
+  def __getitem__(self, i: int) -> bytes:
+    return self.buffer[self.starts[i]:self.ends[i]]
+
+  def __iter__(self):
+    return map(lambda i: self.buffer[self.starts[i]:self.ends[i]], range(len(self.starts)))
+
+  def __len__(self):
+    return len(self.starts)
+
+  def __runs__(self, separator: bytes) -> Iterable[Tuple[int, int]]:
+    # Spans of the buffer that hold consecutive items already separated by the separator
+    run_start: Optional[int] = None
+    run_end: int = 0
+    for i in range(len(self.starts)):
+      start: int = self.starts[i]
+      if run_start is not None and start == run_end + len(separator) and self.buffer[run_end:start] == separator:
+        run_end = self.ends[i]
+      else:
+        if run_start is not None:
+          yield (run_start, run_end)
+        [run_start, run_end] = [start, self.ends[i]]
+    if run_start is not None:
+      yield (run_start, run_end)
+
+  def join(self, separator: bytes) -> bytes:
+    view = memoryview(self.buffer)
+    return separator.join(map(lambda run: view[run[0]:run[1]], self.__runs__(separator)))
+
+  def lengths(self) -> List[int]:
+    return list(map(lambda i: self.ends[i] - self.starts[i], range(len(self.starts))))
+
+  def take(self, positions: List[int]) -> "ItemViews":
+    # Views of the items at the positions, in that order, over the same buffer
+    return ItemViews(self.buffer, list(map(lambda i: self.starts[i], positions)), list(map(lambda i: self.ends[i], positions)))
+
+  def write(self, f: BinaryIO, separator: bytes):
+    view = memoryview(self.buffer)
+    count: int = 0
+    for [start, end] in self.__runs__(separator):
+      if count > 0:
+        f.write(separator)
+      f.write(view[start:end])
+      count += 1
+
+
 class Options:
   def __init__(self, has_header: bool):
     self.has_header = has_header
@@ -56,7 +389,11 @@ class Iterator(Generic[T]):
   adjust_chunk_size: ClassVar[int] = 1000
   next_index: int = -1
   options: ClassVar[Options]
+  # Fraction of the function's memory_size that read-ahead windows may occupy.
+  prefetch_memory_fraction: ClassVar[float] = 0.25
   read_chunk_size: ClassVar[int] = 10*1000*1000
+  # Number of items the sorted combine writes at a time
+  write_batch_size: ClassVar[int] = 10*1000
   delimiter: Delimiter
   identifiers: T
 
@@ -64,30 +401,184 @@ class Iterator(Generic[T]):
     self.cls = cls
     self.item_count = None
     self.entry = entry
+    self.index: Optional[ItemIndex] = None
+    self.index_loaded: bool = False
     self.offset_bounds = offset_bounds
     self.offsets: List[int] = []
-    self.remainder: bytes = b''
+    self.prefetch_count: int = 0
+    self.prefetch_executor: Optional[ThreadPoolExecutor] = None
+    self.prefetched: collections.deque = collections.deque()
+    # Partial item at the end of the last window. The buffer is reused from window to window.
+    self.remainder = bytearray()
     self.__setup__()
 
-  def __adjust__(self, end_index: int, token) -> int:
+  def __adjust__(self, end_index: int) -> int:
     content: bytes = self.entry.get_range(max(end_index - self.adjust_chunk_size, 0), end_index)
     last_byte: int = len(content) - 1
-    index = list(token.finditer(content))[-1].span()[0] + len(self.delimiter.offset_token) - 1
+    start: int = self.delimiter.offset_tokenizer.last_offset_token(content)
+    assert(start != -1)
+    index = start + len(self.delimiter.offset_token) - 1
     offset_index: int = last_byte - index
     assert(offset_index >= 0)
     return offset_index
 
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    # Consumers that stop before the last window don't leave the prefetch thread behind
+    self.stop_prefetch()
+
+  def __fetch__(self, start_index: int, end_index: int) -> memoryview:
+    # Windows are views, so entries backed by a memory map aren't copied until the stream is built
+    if self.prefetch_count == 0:
+      return self.entry.get_view(start_index, end_index)
+
+    # Windows are contiguous, so anything queued before the requested window is stale.
+    while len(self.prefetched) > 0 and self.prefetched[0][0] != start_index:
+      self.prefetched.popleft()[2].cancel()
+    if len(self.prefetched) == 0:
+      self.__prefetch_window__(start_index)
+
+    while len(self.prefetched) <= self.prefetch_count:
+      last_end_index: int = self.prefetched[-1][1]
+      if last_end_index >= self.get_offset_end_index():
+        break
+      self.__prefetch_window__(last_end_index + 1)
+
+    [window_start_index, window_end_index, future] = self.prefetched.popleft()
+    assert(window_end_index == end_index)
+    return future.result()
+
+  @classmethod
+  def __rfind__(cls: Any, window: memoryview, token: bytes) -> int:
+    # Views don't have rfind, so the end of the window is copied, growing until it has the token
+    size: int = 4096
+    while True:
+      start_index: int = max(len(window) - size, 0)
+      index: int = window[start_index:].tobytes().rfind(token)
+      if index != -1:
+        return start_index + index
+      if start_index == 0:
+        return -1
+      size *= 4
+
+  @classmethod
+  def __index_items__(cls: Any, index: ItemIndex, items: List[bytes], offset: int, extra: Dict[str, Any]) -> int:
+    # Adds the items the base from_array writes at the offset, and returns the offset after them
+    separator_length: int = len(cls.delimiter.item_token) if cls.delimiter.position == DelimiterPosition.inbetween else 0
+    if not isinstance(items, ItemViews):
+      items = list(filter(lambda item: len(item) > 0, items))
+    lengths: List[int] = items.lengths() if isinstance(items, ItemViews) else list(map(lambda item: len(item), items))
+    values: Optional[Any] = cls.get_identifier_values(items, extra["identifier"]) if index.values is not None else None
+    for i in range(len(lengths)):
+      index.add(offset, offset + lengths[i], float(values[i]) if values is not None else None)
+      offset += lengths[i] + separator_length
+    return offset - separator_length if len(items) > 0 else offset
+
+  @classmethod
+  def __index_value__(cls: Any, index: ItemIndex, item: Any, extra: Dict[str, Any]) -> Optional[float]:
+    if index.values is None:
+      return None
+    return cls.get_identifier_value(item, extra["identifier"])
+
+  @classmethod
+  def __indexed__(cls: Any, f: Optional[BinaryIO], extra: Dict[str, Any]) -> bool:
+    # Item indexes are written alongside the object by the writer
+    return util.is_set(extra, "index") and isinstance(f, MultipartWriter)
+
+  @classmethod
+  def __item_spans__(cls: Any, content: bytes) -> Optional[List[Tuple[int, int]]]:
+    # Spans of the items to_array splits the content into, or None if an item isn't a slice of the content
+    return cls.delimiter.item_tokenizer.item_spans(content)
+
+  @classmethod
+  def __new_index__(cls: Any, f: MultipartWriter, extra: Dict[str, Any]) -> ItemIndex:
+    # Called before anything is written, so the upload is created with item_index in its metadata
+    f.expect_index()
+    return ItemIndex(ItemIndex.identifier_name(extra["identifier"]) if "identifier" in extra else None)
+
+  @classmethod
+  def __column_values__(cls: Any, content_or_items: Union[bytes, List[bytes]], column: int, separator: bytes, identifier: T) -> Any:
+    # Parses one column of every line of the chunk with NumPy instead of splitting each line
+    if np is None:
+      return Iterator.get_identifier_values.__func__(cls, content_or_items, identifier)
+    content: bytes
+    if isinstance(content_or_items, bytes):
+      content = content_or_items
+    elif isinstance(content_or_items, ItemViews):
+      content = content_or_items.join(cls.delimiter.item_token)
+    else:
+      content = cls.delimiter.item_token.join(content_or_items)
+    if len(content) == 0:
+      return np.array([], dtype=float)
+    assert(len(cls.delimiter.item_token) == 1 and len(separator) == 1)
+    buf = np.frombuffer(content, dtype=np.uint8)
+    line_ends = np.flatnonzero(buf == cls.delimiter.item_token[0])
+    if len(line_ends) == 0 or line_ends[-1] != len(buf) - 1:
+      line_ends = np.append(line_ends, len(buf))
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+    nonempty = line_ends > line_starts
+    line_starts = line_starts[nonempty]
+    line_ends = line_ends[nonempty]
+
+    # The separators before a column of a line are found by their position after the start of the line
+    separators = np.append(np.flatnonzero(buf == separator[0]), len(buf))
+    first = np.searchsorted(separators, line_starts)
+    starts = line_starts
+    if column > 0:
+      before = np.minimum(first + column - 1, len(separators) - 1)
+      if np.any(separators[before] >= line_ends):
+        raise Exception("Iterator::__column_values__ line without column", column)
+      starts = separators[before] + 1
+    ends = np.minimum(separators[np.minimum(first + column, len(separators) - 1)], line_ends)
+
+    # Each value is copied into a fixed width field padded with spaces, so they're all converted at once
+    widths = ends - starts
+    width: int = max(int(widths.max()), 1)
+    positions = np.arange(width)
+    fields = buf[np.minimum(starts[:, None] + positions, len(buf) - 1)]
+    fields = np.where(positions < widths[:, None], fields, ord(" ")).astype(np.uint8)
+    return fields.view("S{0:d}".format(width)).ravel().astype(float)
+
+  @classmethod
+  def __header_length__(cls: Any, entry: Entry, content_length: int) -> int:
+    token: bytes = cls.delimiter.item_token
+    start_index: int = 0
+    while start_index < content_length:
+      end_index: int = min(start_index + cls.adjust_chunk_size, content_length) - 1
+      # Overlap the chunks so a token split across them is still found
+      search_index: int = max(start_index - len(token) + 1, 0)
+      content: bytes = entry.get_range(search_index, end_index)
+      index: int = content.find(token)
+      if index != -1:
+        return search_index + index + len(token)
+      start_index = end_index + 1
+    return content_length
+
+  def __prefetch_window__(self, start_index: int):
+    end_index: int = min(start_index + self.read_chunk_size, self.get_offset_end_index())
+    future: Future = self.prefetch_executor.submit(self.entry.get_view, start_index, end_index)
+    self.prefetched.append((start_index, end_index, future))
+
   def __setup__(self):
-    if self.offset_bounds:
+    if self.offset_bounds and self.get_index() is not None:
+      # Items are aligned with the index, so the ends of the split don't need to be searched
+      end_index: int = min(self.offset_bounds.end_index, self.entry.content_length() - 1)
+      [self.start_index, self.end_index] = self.get_index().align(self.offset_bounds.start_index, end_index, self.entry.content_length())
+    elif self.offset_bounds:
       self.start_index = self.offset_bounds.start_index
       self.end_index = min(self.offset_bounds.end_index, self.entry.content_length() - 1)
+      if self.end_index - self.start_index <= self.read_chunk_size:
+        # The split fits in one window, so the probes at both ends and the window are fetched together
+        self.entry.plan_ranges([(max(self.start_index - self.adjust_chunk_size, 0), self.end_index)])
       if self.start_index != 0:
-        self.start_index -= self.__adjust__(self.start_index, self.delimiter.offset_regex)
+        self.start_index -= self.__adjust__(self.start_index)
         if self.delimiter.position != DelimiterPosition.start:
           # Don't include delimiter
           self.start_index += 1
       if self.end_index != (self.entry.content_length() - 1):
-        self.end_index -= self.__adjust__(self.end_index, self.delimiter.offset_regex)
+        self.end_index -= self.__adjust__(self.end_index)
         if self.delimiter.position == DelimiterPosition.start:
           self.end_index -= 1
     else:
@@ -103,54 +594,175 @@ class Iterator(Generic[T]):
     metadata: Dict[str, str] = {}
 
     if util.is_set(extra, "sort"):
-      items = []
-      for i in range(len(entries)):
-        it = cls(entries[i], None)
-        sub_items = it.get(it.get_start_index(), it.get_end_index())
-        items += list(map(lambda item: (it.get_identifier_value(item, extra["identifier"]), item), sub_items))
-      items = sorted(items, key=lambda i: i[0])
-      items = list(map(lambda i: i[1], items))
-      content, metadata = cls.from_array(items, f, extra)
-      f.write(content)
+      # Merges the sorted runs of the entries instead of sorting all of the items together.
+      # Ties keep the order of the entries, as a stable sort would.
+      entries = list(filter(lambda entry: entry.content_length() > 0, entries))
+      runs = list(map(lambda entry: cls.__sorted_run__(entry, extra), entries))
+      items = map(lambda i: i[1], cls.__merge__(runs))
+      metadata = cls.write_array(items, f, extra)
+    elif util.is_set(extra, "server_side") and isinstance(f, MultipartWriter):
+      metadata = cls.concatenate(entries, f, extra)
     else:
       count = 0
-      for i in range(len(entries)):
-        entry = entries[i]
-        if entry.content_length() == 0:
-          continue
+      # Output may be streamed, so track the end of the last write instead of seeking back
+      end: bytes = b""
+      index: Optional[ItemIndex] = cls.__new_index__(f, extra) if cls.__indexed__(f, extra) else None
+      position: int = 0
+      for [entry, content] in cls.get_contents(entries, extra):
         if count > 0 and cls.delimiter.position == DelimiterPosition.inbetween:
-          f.seek(-1 * len(cls.delimiter.item_token), os.SEEK_END)
-          end: str = f.read(len(cls.delimiter.item_token))
           if end != cls.delimiter.item_token:
             f.write(cls.delimiter.item_token)
+            end = cls.delimiter.item_token
+            position += len(cls.delimiter.item_token)
         if cls.options.has_header and count > 0:
-          lines = entry.get_content().split(cls.delimiter.item_token)[1:]
+          lines = content.split(cls.delimiter.item_token)[1:]
           content = cls.delimiter.item_token.join(lines)
-          f.write(content)
-        else:
-          # TODO: There seems to be a bug where if I do entry.download(f), it's not guaranteed
-          # the entire file will write at the end. I need to figure out why because downloading,
-          # loading into memory and then writing to disk is slower.
-          f.write(entry.get_content())
+        if index is not None:
+          spans: Optional[List[Tuple[int, int]]] = cls.__item_spans__(content)
+          if spans is None:
+            index = None
+          else:
+            for [start, stop] in spans:
+              index.add(position + start, position + stop, cls.__index_value__(index, content[start:stop], extra))
+        # TODO: There seems to be a bug where if I do entry.download(f), it's not guaranteed
+        # the entire file will write at the end. I need to figure out why because downloading,
+        # loading into memory and then writing to disk is slower.
+        f.write(content)
+        position += len(content)
+        end = (end + content[-len(cls.delimiter.item_token):])[-len(cls.delimiter.item_token):]
         count += 1
+      if index is not None:
+        f.set_index(index.to_bytes())
 
     return metadata
 
+  @classmethod
+  def __merge__(cls: Any, runs: List[Iterable[Tuple[float, Any]]]) -> Iterable[Tuple[float, Any]]:
+    # K-way merge of (value, item) runs that are each sorted by value
+    return heapq.merge(*runs, key=lambda i: i[0])
+
+  @classmethod
+  def __iterate_items__(cls: Any, entry: Entry, extra: Dict[str, Any]) -> Iterable[Any]:
+    # Yields the items of the entry one window at a time
+    with cls(entry) as it:
+      it.enable_prefetch(extra)
+      more: bool = True
+      while more:
+        [items, _, more] = it.next()
+        yield from items
+
+  @classmethod
+  def __sorted_run__(cls: Any, entry: Entry, extra: Dict[str, Any]) -> Iterable[Tuple[float, Any]]:
+    # Entries written with sorted in their metadata are streamed. Any other entry is sorted in memory.
+    items: Iterable[Tuple[float, Any]] = map(lambda item: (cls.get_identifier_value(item, extra["identifier"]), item), cls.__iterate_items__(entry, extra))
+    metadata: Dict[str, str] = entry.get_metadata()
+    if "sorted" in metadata and metadata["sorted"] == "True":
+      return items
+    return iter(sorted(items, key=lambda i: i[0]))
+
+  @classmethod
+  def concatenate(cls: Any, entries: List[Entry], f: MultipartWriter, extra: Dict[str, Any]) -> Dict[str, str]:
+    # Same output as the unsorted combine, but the entries are copied on the server side.
+    # Only delimiters and the bytes needed to find headers and delimiters are downloaded.
+    token: bytes = cls.delimiter.item_token
+    count = 0
+    end: bytes = b""
+    for entry in entries:
+      content_length: int = entry.content_length()
+      if content_length == 0:
+        continue
+      if count > 0 and cls.delimiter.position == DelimiterPosition.inbetween:
+        if end != token:
+          f.write(token)
+          end = token
+      start_index: int = 0
+      if cls.options.has_header and count > 0:
+        start_index = cls.__header_length__(entry, content_length)
+      if start_index < content_length:
+        f.copy(entry, start_index, content_length - 1)
+        if cls.delimiter.position == DelimiterPosition.inbetween:
+          tail: bytes = entry.get_range(max(start_index, content_length - len(token)), content_length - 1)
+          end = (end + tail)[-len(token):]
+      count += 1
+    return {}
+
+  @classmethod
+  def get_contents(cls: Any, entries: List[Entry], extra: Dict[str, Any]) -> Iterable[Tuple[Entry, bytes]]:
+    # Yields the content of each non-empty entry in order. If prefetch is set, the next
+    # entries are downloaded in the background while the caller handles the current one.
+    entries = list(filter(lambda entry: entry.content_length() > 0, entries))
+    window_count: int = extra["prefetch"] if "prefetch" in extra else 0
+    if window_count <= 0:
+      for entry in entries:
+        yield (entry, entry.get_content())
+      return
+
+    with ThreadPoolExecutor(max_workers=window_count) as executor:
+      pending: collections.deque = collections.deque()
+      for entry in entries:
+        pending.append((entry, executor.submit(entry.get_content)))
+        if len(pending) > window_count:
+          [next_entry, future] = pending.popleft()
+          yield (next_entry, future.result())
+      while len(pending) > 0:
+        [next_entry, future] = pending.popleft()
+        yield (next_entry, future.result())
+
   @classmethod
   def from_array(cls: Any, items: List[Any], f: Optional[BinaryIO], extra: Dict[str, Any]) -> Tuple[str, Dict[str, str]]:
     metadata: Dict[str, str] = {}
-    if cls.delimiter.position == DelimiterPosition.inbetween:
-      content = cls.delimiter.item_token.join(items)
+    index: Optional[ItemIndex] = cls.__new_index__(f, extra) if cls.__indexed__(f, extra) else None
+    separator: bytes = cls.delimiter.item_token if cls.delimiter.position == DelimiterPosition.inbetween else b""
+    if isinstance(items, ItemViews) and f:
+      # Views are written straight from their buffer, so the content isn't joined
+      content = b""
+      items.write(f, separator)
+    elif isinstance(items, ItemViews):
+      content = items.join(separator)
     else:
-      content = b"".join(items)
+      content = separator.join(items)
 
     if f:
-      f.write(content)
+      if len(content) > 0:
+        f.write(content)
+      if index is not None:
+        cls.__index_items__(index, items, 0, extra)
+        f.set_index(index.to_bytes())
     return (content, metadata)
 
+  @classmethod
+  def write_array(cls: Any, items: Iterable[Any], f: BinaryIO, extra: Dict[str, Any]) -> Dict[str, str]:
+    # Writes the same output as from_array, but in batches, so the items don't have to be in memory at once.
+    # Formats with their own from_array write all of the items with it.
+    if cls.from_array.__func__ is not Iterator.from_array.__func__:
+      [_, metadata] = cls.from_array(list(items), f, extra)
+      return metadata
+
+    count: int = 0
+    index: Optional[ItemIndex] = cls.__new_index__(f, extra) if cls.__indexed__(f, extra) else None
+    position: int = 0
+    while True:
+      batch: List[Any] = list(itertools.islice(items, cls.write_batch_size))
+      if len(batch) == 0:
+        break
+      if count > 0 and cls.delimiter.position == DelimiterPosition.inbetween:
+        f.write(cls.delimiter.item_token)
+        position += len(cls.delimiter.item_token)
+      cls.from_array(batch, f, {**extra, "index": False})
+      if index is not None:
+        position = cls.__index_items__(index, batch, position, extra)
+      count += len(batch)
+    if index is not None:
+      f.set_index(index.to_bytes())
+    return {}
+
   @classmethod
   def to_array(cls: Any, content: bytes) -> Iterable[Any]:
     token = cls.delimiter.item_regex
+    spans: Optional[List[Tuple[int, int]]] = cls.__item_spans__(content)
+    if spans is not None:
+      # Each item is a slice of the content, so the items are views of it
+      return ItemViews(content, list(map(lambda span: span[0], spans)), list(map(lambda span: span[1], spans)))
     if cls.delimiter.regex is not None:
       items = map(lambda item: item[0], re.findall(cls.delimiter.regex, content))
     else:
@@ -165,10 +777,37 @@ class Iterator(Generic[T]):
   def get_identifier_value(cls: Any, item: bytes, identifier: T) -> float:
     raise Exception("Not Implemented")
 
+  @classmethod
+  def get_identifier_values(cls: Any, content_or_items: Union[bytes, Iterable[Any]], identifier: T) -> Any:
+    # Identifier values of every item of a chunk, given either its content or its items.
+    # Formats that can parse the values of a chunk at once override this. Returns a NumPy
+    # array, or a list if NumPy isn't available.
+    items: Iterable[Any] = cls.to_array(content_or_items) if isinstance(content_or_items, bytes) else content_or_items
+    values: List[float] = list(map(lambda item: cls.get_identifier_value(item, identifier), items))
+    return np.array(values, dtype=float) if np is not None else values
+
   def get(self, start_byte: int, end_byte: int) -> Iterable[Any]:
     content: bytes = self.entry.get_range(start_byte, end_byte)
+    index: Optional[ItemIndex] = self.get_index()
+    if index is not None and self.to_array.__func__ is Iterator.to_array.__func__:
+      # The items are sliced out with the index instead of splitting the content again
+      [i, j] = index.find(start_byte, end_byte)
+      return ItemViews(content, list(map(lambda start: start - start_byte, index.starts[i:j])), list(map(lambda end: end - start_byte, index.ends[i:j])))
     return self.to_array(content)
 
+  def get_index(self) -> Optional[ItemIndex]:
+    # Item index the previous stage wrote alongside the entry, if any
+    if not self.index_loaded:
+      content: Optional[bytes] = self.entry.get_index()
+      self.index = ItemIndex.from_bytes(content) if content is not None else None
+      self.index_loaded = True
+    return self.index
+
+  def enable_prefetch(self, params: Dict[str, Any]):
+    if "prefetch" in params:
+      memory_size: Optional[int] = params["memory_size"] if "memory_size" in params else None
+      self.prefetch(params["prefetch"], memory_size)
+
   def get_extra(self) -> Dict[str, Any]:
     return {}
 
@@ -193,24 +832,39 @@ class Iterator(Generic[T]):
     next_start_index: int = self.next_index
     next_end_index: int = min(next_start_index + self.read_chunk_size, self.get_offset_end_index())
     more: bool = True
-    stream: bytes = self.entry.get_range(next_start_index, next_end_index)
-    stream = self.remainder + stream
+    window: memoryview = self.__fetch__(next_start_index, next_end_index)
+    token = self.delimiter.offset_token
+    # The last delimiter of the window ends the stream, unless the window doesn't have one
+    window_index: int = self.__rfind__(window, token) if next_end_index != self.get_offset_end_index() else -1
+    stream: bytes
     if next_end_index == self.get_offset_end_index():
+      stream = b"".join((self.remainder, window))
       next_start_index -= len(self.remainder)
-      self.remainder = b''
+      del self.remainder[:]
       more = False
+      self.stop_prefetch()
+    elif window_index != -1:
+      if self.delimiter.position == DelimiterPosition.inbetween:
+        window_index += len(token)
+      # The stream is copied once from the remainder and the window, and the rest of the window
+      # replaces the remainder in place
+      stream = b"".join((self.remainder, window[:window_index]))
+      next_end_index -= (len(window) - window_index)
+      next_start_index -= len(self.remainder)
+      self.remainder[:] = window[window_index:]
     else:
-      token = self.delimiter.offset_token
-      index: int = stream.rindex(token) if token in stream else -1
+      stream = b"".join((self.remainder, window))
+      index: int = stream.rfind(token)
       if index != -1:
+        # The delimiter starts in the remainder
         if self.delimiter.position == DelimiterPosition.inbetween:
-          index += len(self.delimiter.offset_token)
+          index += len(token)
         next_end_index -= (len(stream) - index)
         next_start_index -= len(self.remainder)
-        self.remainder = stream[index:]
+        self.remainder[:] = memoryview(stream)[index:]
         stream = stream[:index]
       else:
-        self.remainder = stream
+        self.remainder += window
         next_end_index -= len(self.remainder)
         stream = b''
     self.next_index = min(next_end_index + len(self.remainder) + 1, self.get_offset_end_index())
@@ -220,8 +874,38 @@ class Iterator(Generic[T]):
     else:
       offset_bounds = OffsetBounds(next_start_index, next_end_index)
 
+    if more and self.prefetch_count == 0:
+      self.entry.plan_ranges(self.upcoming_ranges(offset_bounds))
     [stream, offset_bounds] = self.transform(stream, offset_bounds)
     return (self.to_array(stream), offset_bounds, more)
 
+  def prefetch(self, window_count: int, memory_size: Optional[int] = None):
+    # memory_size is the function's memory in MB, as configured in the pipeline.
+    if memory_size is not None:
+      budget: int = int(memory_size * 1000 * 1000 * self.prefetch_memory_fraction)
+      # The window being parsed is held in memory alongside the prefetched ones.
+      window_count = min(window_count, int(budget / (self.read_chunk_size + 1)) - 1)
+    self.prefetch_count = max(window_count, 0)
+    if self.prefetch_count > 0 and self.prefetch_executor is None:
+      self.prefetch_executor = ThreadPoolExecutor(max_workers=self.prefetch_count)
+
+  def stop_prefetch(self):
+    for [_, _, future] in self.prefetched:
+      future.cancel()
+    self.prefetched.clear()
+    if self.prefetch_executor is not None:
+      self.prefetch_executor.shutdown(wait=False)
+      self.prefetch_executor = None
+    self.prefetch_count = 0
+
   def transform(self, stream: bytes, offset_bounds: Optional[OffsetBounds]) -> Tuple[bytes, Optional[OffsetBounds]]:
     return (stream, offset_bounds)
+
+  def next_window(self) -> Tuple[int, int]:
+    # Range the next call to next will read
+    return (self.next_index, min(self.next_index + self.read_chunk_size, self.get_offset_end_index()))
+
+  def upcoming_ranges(self, offset_bounds: Optional[OffsetBounds]) -> List[Tuple[int, int]]:
+    # Ranges that transform and the next call to next will read. Iterators that read ahead
+    # of the window in transform return them, so the reads can be combined on the entry.
+    return []
@@ -6,7 +6,7 @@ import util
 import xml.etree.ElementTree as ET
 from enum import Enum
 from database import Entry
-from iterator import Delimiter, DelimiterPosition, OffsetBounds, Options
+from iterator import Delimiter, DelimiterPosition, ItemIndex, OffsetBounds, Options
 from typing import Any, BinaryIO, ClassVar, Dict, Iterable, List, Optional, Pattern, Tuple
 
 
@@ -94,8 +94,7 @@ class Iterator(iterator.Iterator[Identifiers]):
       self.header_end_index = int(metadata["header_end_index"])
     else:
       self.header_start_index = 0
-      start_byte: int = max(0, self.index_list_offset - self.read_chunk_size)
-      end_byte: int = min(self.index_list_offset + self.read_chunk_size, self.entry.content_length())
+      [start_byte, end_byte] = self.__header_probe_range__()
       stream: str = self.entry.get_range(start_byte, end_byte).decode("utf-8")
       offset_matches: List[Any] = list(self.offset_regex.finditer(stream))
       assert(len(offset_matches) > 0)
@@ -107,16 +106,23 @@ class Iterator(iterator.Iterator[Identifiers]):
       self.footer_start_index = int(metadata["footer_start_index"])
       self.footer_end_index = int(metadata["footer_end_index"])
     else:
-      if self.chromatogram_start_index == -1:
-        start_byte = self.index_list_offset - self.read_chunk_size
-      else:
-        start_byte = self.chromatogram_start_index - self.read_chunk_size
-      start_byte = max(0, start_byte)
-      end_byte = min(start_byte + self.read_chunk_size, self.entry.content_length())
+      [start_byte, end_byte] = self.__footer_probe_range__()
       stream = self.entry.get_range(start_byte, end_byte).decode("utf-8")
       self.footer_start_index = start_byte + stream.rindex(self.spectrum_list_close_tag)
       self.footer_end_index = self.entry.content_length()
 
+  def __footer_probe_range__(self) -> Tuple[int, int]:
+    if self.chromatogram_start_index == -1:
+      start_byte = self.index_list_offset - self.read_chunk_size
+    else:
+      start_byte = self.chromatogram_start_index - self.read_chunk_size
+    start_byte = max(0, start_byte)
+    return (start_byte, min(start_byte + self.read_chunk_size, self.entry.content_length()))
+
+  def __header_probe_range__(self) -> Tuple[int, int]:
+    start_byte: int = max(0, self.index_list_offset - self.read_chunk_size)
+    return (start_byte, min(self.index_list_offset + self.read_chunk_size, self.entry.content_length()))
+
   def __get_index_list_offset__(self):
     metadata: Dict[str, str] = self.entry.get_metadata()
     if "index_list_offset" in metadata:
@@ -140,6 +146,14 @@ class Iterator(iterator.Iterator[Identifiers]):
 
   def __get_metadata__(self):
     self.__get_index_list_offset__()
+    # Both probes search around the index list, so they're fetched together
+    metadata: Dict[str, str] = self.entry.get_metadata()
+    ranges: List[Tuple[int, int]] = []
+    if "header_start_index" not in metadata:
+      ranges.append(self.__header_probe_range__())
+    if "footer_start_index" not in metadata:
+      ranges.append(self.__footer_probe_range__())
+    self.entry.plan_ranges(ranges)
     self.__get_header_offset__()
     self.header = self.entry.get_range(self.header_start_index, self.header_end_index).decode("utf-8")
     self.__get_footer_offset__()
@@ -241,12 +255,14 @@ class Iterator(iterator.Iterator[Identifiers]):
     header: str = ""
     for entry in entries:
       iterator = Iterator(entry)
+      iterator.enable_prefetch(extra)
       iterators.append(iterator)
       count += iterator.get_item_count()
 
     assert(len(iterators) > 0)
     header = iterators[0].header
 
+    item_index: Optional[ItemIndex] = cls.__new_index__(f, extra) if cls.__indexed__(f, extra) else None
     content: str = cls.__create_header__(f, header, count, metadata)
     offset = len(content)
     offsets = []
@@ -262,6 +278,8 @@ class Iterator(iterator.Iterator[Identifiers]):
           xml.set("index", str(index))
           offsets.append((xml.get("id"), offset))
           spectrum = ET.tostring(xml).decode()
+          if item_index is not None:
+            item_index.add(offset, offset + len(spectrum), cls.__index_value__(item_index, xml, extra))
           offset += len(spectrum)
           spectra_content += spectrum
           index += 1
@@ -270,11 +288,14 @@ class Iterator(iterator.Iterator[Identifiers]):
     metadata["spectra_end_index"] = str(offset)
 
     cls.__add_footer__(f, content, offsets, metadata)
+    if item_index is not None:
+      f.set_index(item_index.to_bytes())
     return metadata
 
   @classmethod
   def from_array(cls: Any, items: List[Any], f: Optional[BinaryIO], extra: Dict[str, Any]) -> Tuple[str, Dict[str, str]]:
     metadata: Dict[str, str] = {}
+    index: Optional[ItemIndex] = cls.__new_index__(f, extra) if cls.__indexed__(f, extra) else None
     content: str = cls.__create_header__(f, extra["header"], len(items), metadata)
     offset = len(content)
     offsets = []
@@ -286,11 +307,15 @@ class Iterator(iterator.Iterator[Identifiers]):
       assert(m is not None)
       offsets.append((m.group(1), offset))
       spectrum = ET.tostring(xml).decode()
+      if index is not None:
+        index.add(offset, offset + len(spectrum), cls.__index_value__(index, xml, extra))
       offset += len(spectrum)
       content += cls.__add_content__(spectrum, f)
       count += 1
 
     cls.__add_footer__(f, content, offsets, metadata)
+    if index is not None:
+      f.set_index(index.to_bytes())
     return (content, metadata)
 
   def get_extra(self) -> Dict[str, Any]:
@@ -338,6 +363,12 @@ class Iterator(iterator.Iterator[Identifiers]):
     root = ET.fromstring(content)
     return filter(lambda item: cls.__cv_param__(item, "ms level") == 2, root.iter("spectrum"))
 
+  def upcoming_ranges(self, offset_bounds: Optional[OffsetBounds]) -> List[Tuple[int, int]]:
+    # transform reads the offsets after the window, which is the start of the next window
+    if not offset_bounds:
+      return []
+    return [(offset_bounds.end_index, offset_bounds.end_index + self.read_chunk_size), self.next_window()]
+
   def transform(self, stream: bytes, offset_bounds: Optional[OffsetBounds]) -> Tuple[bytes, Optional[OffsetBounds]]:
     start_index: int
     end_index: int
@@ -1,9 +1,10 @@
 import boto3
 import iterator
+import itertools
 import util
 from database import Entry
 from iterator import Delimiter, DelimiterPosition, OffsetBounds, Options
-from typing import Any, BinaryIO, ClassVar, Dict, List, Optional
+from typing import Any, BinaryIO, ClassVar, Dict, Iterable, List, Optional, Tuple
 
 
 class Iterator(iterator.Iterator[None]):
@@ -16,19 +17,21 @@ class Iterator(iterator.Iterator[None]):
 
   @classmethod
   def combine(cls: Any, entries: List[Entry], f: BinaryIO, extra: Dict[str, Any]) -> Dict[str, str]:
-    pivots = set()
+    runs: List[Iterable[Tuple[float, float]]] = []
     file_key: Optional[str] = None
     for entry in entries:
       content: str = entry.get_content().decode("utf-8")
       [file_bucket, file_key, pivot_content] = content.split("\n")
       pivot_content: str = pivot_content.strip()
       if len(pivot_content) > 0:
-        new_pivots = set(list(map(lambda p: float(p), pivot_content.split("\t"))))
-        pivots = pivots.union(new_pivots)
+        # Pivot files are written sorted, so sorting each run again is linear
+        new_pivots: List[float] = sorted(map(lambda p: float(p), pivot_content.split("\t")))
+        runs.append(map(lambda p: (p, p), new_pivots))
     assert(file_key is not None)
 
-    pivots = list(pivots)
-    pivots.sort()
+    # Merges the runs and drops pivots that appear in more than one file
+    merged: Iterable[float] = map(lambda i: i[0], cls.__merge__(runs))
+    pivots: List[float] = list(map(lambda group: group[0], itertools.groupby(merged)))
     super_pivots: List[int] = []
   #  num_bins = int((len(pivots) + cls.increment) / cls.increment)
     num_bins = 10
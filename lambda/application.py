@@ -42,4 +42,4 @@ def run_application(d: Database, bucket_name: str, key: str, input_format: Dict[
 
 
 def handler(event, context):
-  util.handle(event, context, run_application)
+  util.handle(event, context, lambda database, *args: database.run_stage(run_application, *args, event=event))
@@ -1,45 +1,61 @@
+import asyncio
 import importlib
-import os
 import util
 from database import Database, Entry
 from typing import Any, Dict, List
 
 
-def combine(database: Database, table_name, key, input_format, output_format, offsets, params):
-  output_format["file_id"] = input_format["bin"]
+async def gather_entries(entries: List[Entry]) -> List[Entry]:
+  # Reads every input concurrently. The combine then runs on the content in memory.
+  return list(await asyncio.gather(*map(lambda entry: entry.aload(), entries)))
+
+
+async def combine(database: Database, table_name, key, input_format, output_format, offsets, params):
+  # Sort bundles are in bin 0 and the sort invokes each bin with bundle_bin
+  bundled: bool = input_format["bin"] == 0
+  bin_id: int = params["bundle_bin"] if bundled else input_format["bin"]
+  output_format["file_id"] = bin_id
   output_format["bin"] = 1
   output_format["num_bins"] = 1
   output_format["num_files"] = input_format["num_bins"]
   file_name = util.file_name(output_format)
-  util.make_folder(output_format)
-  [combine, last_file, keys] = util.combine_instance(table_name, key, params)
+  if util.is_set(params, "manifest"):
+    # The manifest of the bin records each input as it arrives, so the barrier doesn't list the bin
+    name = "{0:d}/{1:f}-{2:d}/{3:d}-{4:d}".format(input_format["prefix"], input_format["timestamp"], input_format["nonce"], bin_id, input_format["num_bins"])
+    [last_file, keys] = database.arrive(table_name, name, key, input_format["num_files"])
+    combine = last_file == key
+  else:
+    [combine, last_file, keys] = util.combine_instance(table_name, key, params)
   if combine:
     msg = "Combining TIMESTAMP {0:f} NONCE {1:d} BIN {2:d} FILE {3:d}"
-    msg = msg.format(input_format["timestamp"], input_format["nonce"], input_format["bin"], input_format["file_id"])
+    msg = msg.format(input_format["timestamp"], input_format["nonce"], bin_id, input_format["file_id"])
     print(msg)
 
     format_lib = importlib.import_module(params["output_format"])
     iterator_class = getattr(format_lib, "Iterator")
-    temp_name = "/tmp/{0:s}".format(file_name)
     # Make this deterministic and combine in the same order
     keys.sort()
-    entries: List[Entry] = list(map(lambda key: database.get_entry(table_name, key), keys))
+    if bundled:
+      entries: List[Entry] = list(map(lambda key: database.get_bundle_entry(table_name, key, str(bin_id)), keys))
+    else:
+      entries = list(map(lambda key: database.get_entry(table_name, key), keys))
     metadata: Dict[str, str] = {}
     if database.contains(table_name, file_name):
       return True
 
-    with open(temp_name, "wb+") as f:
-      metadata = iterator_class.combine(entries, f, params)
+    if util.is_set(params, "gather") and not util.is_set(params, "server_side"):
+      entries = await gather_entries(entries)
 
-    found = database.contains(table_name, file_name)
-    if not found:
-      with open(temp_name, "rb") as f:
-        database.put(params["bucket"], file_name, f, metadata)
-    os.remove(temp_name)
+    with database.writer(params["bucket"], file_name, {}) as f:
+      metadata = iterator_class.combine(entries, f, params)
+      if database.contains(table_name, file_name):
+        f.abort()
+      else:
+        f.close(metadata)
     return True
   else:
     return database.contains(table_name, file_name) or key != last_file
 
 
 def handler(event, context):
-  util.handle(event, context, combine)
+  util.handle(event, context, lambda database, *args: database.run_stage(combine, *args, event=event))
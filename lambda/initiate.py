@@ -4,13 +4,20 @@ from typing import Any, Dict, List
 
 
 def initiate(database: Database, bucket_name: str, key: str, input_format: Dict[str, Any], output_format: Dict[str, Any], offsets: List[int], params: Dict[str, Any]):
-  [combine, keys, last] = util.combine_instance(bucket_name, key, params)
+  if util.is_set(params, "manifest"):
+    name = "{0:d}/{1:f}-{2:d}/{3:d}-{4:d}".format(input_format["prefix"], input_format["timestamp"], input_format["nonce"], input_format["bin"], input_format["num_bins"])
+    [last, keys] = database.arrive(bucket_name, name, key, input_format["num_files"])
+    combine = last == key
+  else:
+    [combine, keys, last] = util.combine_instance(bucket_name, key, params)
   if "trigger_key" in params:
     bucket = params["trigger_bucket"]
     key = params["trigger_key"]
   else:
     bucket = bucket_name
-    key = database.get_entries(bucket_name, params["input_prefix"])[0].key 
+    # Only the run is listed, since a stage prefix spans every run
+    prefix = "{0:d}/{1:f}-{2:d}/".format(params["input_prefix"], input_format["timestamp"], input_format["nonce"])
+    key = next(database.iterate_entries(bucket_name, prefix)).key
 
   if combine:
     payload = {
@@ -30,4 +37,4 @@ def initiate(database: Database, bucket_name: str, key: str, input_format: Dict[
 
 
 def handler(event, context):
-  util.handle(event, context, initiate)
+  util.handle(event, context, lambda database, *args: database.run_stage(initiate, *args, event=event))
@@ -26,6 +26,7 @@ def map_file(database: Database, table: str, key: str, input_format: Dict[str, A
   file_id = 0
   num_files = len(keys)
   keys.sort()
+  payloads = []
   for i in range(num_files):
     target_file = keys[i]
     file_id += 1
@@ -62,8 +63,10 @@ def map_file(database: Database, table: str, key: str, input_format: Dict[str, A
       payload["Records"][0]["s3"]["extra_params"]["pivots"] = ranges
       payload["Records"][0]["s3"]["pivots"] = ranges
 
-    database.invoke(params["output_function"], payload)
+    payloads.append(payload)
+
+  database.invoke_many(params["output_function"], payloads)
 
 
 def handler(event, context):
-  util.handle(event, context, map_file)
+  util.handle(event, context, lambda database, *args: database.run_stage(map_file, *args, event=event))
@@ -18,11 +18,12 @@ def find_match(bucket_name, key, input_format, output_format, offsets, params):
     with open(util.LOG_NAME, "a+") as f:
       for key in keys:
         obj = s3.Object(bucket_name, key)
-        it = iterator(obj, params["chunk_size"])
-        if params["find"] == "max sum":
-          score = it.sum(params["identifier"])
-        else:
-          raise Exception("Not implemented", params["find"])
+        with iterator(obj, params["chunk_size"]) as it:
+          it.enable_prefetch(params)
+          if params["find"] == "max sum":
+            score = it.sum(params["identifier"])
+          else:
+            raise Exception("Not implemented", params["find"])
 
         print("key {0:s} score {1:d}".format(key, score))
         f.write("key {0:s} score {1:d}\n".format(key, score))
@@ -39,4 +40,4 @@ def find_match(bucket_name, key, input_format, output_format, offsets, params):
 
 
 def handler(event, context):
-  util.handle(event, context, find_match)
+  util.handle(event, context, lambda database, *args: database.run_stage(find_match, *args, event=event))
@@ -10,8 +10,8 @@ def create_pivots(d: Database, format_lib: Any, iterator_class: Any, items: List
   if len(items) == 0:
     return []
 
-  pivots: List[float] = map(lambda item: iterator_class.get_identifier_value(item, format_lib.Identifiers[params["identifier"]]), items)
-  pivots = list(set(list(pivots)))
+  values = iterator_class.get_identifier_values(items, format_lib.Identifiers[params["identifier"]])
+  pivots: List[float] = list(set(map(lambda value: float(value), values)))
   pivots.sort()
 
   max_identifier: float = float(pivots[-1] + 1)
@@ -49,4 +49,4 @@ def handle_pivots(database: Database, bucket_name, key, input_format, output_for
 
 
 def handler(event, context):
-  util.handle(event, context, handle_pivots)
+  util.handle(event, context, lambda database, *args: database.run_stage(handle_pivots, *args, event=event))
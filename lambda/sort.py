@@ -1,8 +1,14 @@
 import importlib
 import util
 from database import Database
-from iterator import OffsetBounds
-from typing import Any, Dict, List, Tuple
+from iterator import ItemIndex, ItemViews, OffsetBounds
+from typing import Any, Dict, List, Optional, Tuple
+
+# NumPy comes from a layer on Lambda, so sorting falls back to Python without it
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 
 def bin_input(sorted_input: List[Tuple[float, Any]], bin_ranges: List[Dict[str, int]]) -> List[Any]:
@@ -23,13 +29,48 @@ def bin_input(sorted_input: List[Tuple[float, Any]], bin_ranges: List[Dict[str,
   return binned_input
 
 
+def get_index_values(it, identifier, count: int) -> Optional[List[float]]:
+  # Identifier values the previous stage stored in the item index of the input, if they match the items
+  index: Optional[ItemIndex] = it.get_index()
+  if index is None or index.identifier != ItemIndex.identifier_name(identifier):
+    return None
+  [i, j] = index.find(it.get_start_index(), it.get_end_index())
+  values: Optional[List[float]] = index.get_values(i, j)
+  if values is None or len(values) != count:
+    return None
+  return values
+
+
+def select_items(items: Any, positions: List[int]) -> Any:
+  # Views of the input are selected without copying the items out of the buffer
+  if isinstance(items, ItemViews):
+    return items.take(positions)
+  return list(map(lambda i: items[i], positions))
+
+
 def write_binned_input(database: Database, binned_input: List[Any], bin_ranges: List[Dict[str, int]], extra: Dict[str, Any], output_format, iterator_class, params):
   for i in range(len(binned_input)):
-    [content, metadata] = iterator_class.from_array(binned_input[i], None, extra)
     output_format["bin"] = bin_ranges[i]["bin"]
     output_format["num_bins"] = len(bin_ranges)
     bin_key = util.file_name(output_format)
-    database.write(params["bucket"], bin_key, content, metadata)
+    # The items of each bin are in order, so the combine can merge the bins without sorting them
+    with database.writer(params["bucket"], bin_key, {"sorted": "True"}) as f:
+      [_, metadata] = iterator_class.from_array(binned_input[i], f, extra)
+      f.close(metadata)
+
+
+def write_bundle(database: Database, binned_input: List[Any], bin_ranges: List[Dict[str, int]], extra: Dict[str, Any], output_format, iterator_class, params):
+  # Bin 0 holds a bundle with the output of every bin, so the combine barrier counts one bundle per worker
+  parts = []
+  for i in range(len(binned_input)):
+    [content, metadata] = iterator_class.from_array(binned_input[i], None, extra)
+    parts.append((str(bin_ranges[i]["bin"]), content, {**metadata, "sorted": "True"}))
+  output_format["bin"] = 0
+  output_format["num_bins"] = len(bin_ranges)
+  bundle_key = util.file_name(output_format)
+  database.write_bundle(params["bucket"], bundle_key, parts, {}, False)
+  payloads = list(map(lambda bin_range: database.create_payload(params["bucket"], bundle_key, {"bundle_bin": bin_range["bin"]}), bin_ranges))
+  database.invoke_many(params["output_function"], payloads)
 
 
 def handle_sort(database: Database, table_name: str, key: str, input_format: Dict[str, Any], output_format: Dict[str, Any], offsets: List[int], params: Dict[str, Any]):
@@ -41,15 +82,30 @@ def handle_sort(database: Database, table_name: str, key: str, input_format: Dic
     it = iterator_class(entry, OffsetBounds(offsets[0], offsets[1]))
   else:
     it = iterator_class(entry, None)
+  identifier = format_lib.Identifiers[params["identifier"]]
   extra = it.get_extra()
+  if util.is_set(params, "index"):
+    extra = {**extra, "identifier": identifier, "index": True}
   items = it.get(it.get_start_index(), it.get_end_index())
-  items = list(map(lambda item: (it.get_identifier_value(item, format_lib.Identifiers[params["identifier"]]), item), items))
-  sorted_items = sorted(items, key=lambda k: k[0])
+  if not isinstance(items, ItemViews):
+    items = list(items)
+  values = get_index_values(it, identifier, len(items))
+  if values is None:
+    values = it.get_identifier_values(items, identifier)
+  # The items are binned by position, and each bin is selected from the input at the end
+  if np is not None:
+    positions = np.argsort(values, kind="stable").tolist()
+  else:
+    positions = sorted(range(len(items)), key=lambda i: values[i])
+  sorted_items = list(map(lambda i: (values[i], i), positions))
   bin_ranges = params["pivots"]
-  binned_input = bin_input(sorted_items, bin_ranges)
-  write_binned_input(database, binned_input, bin_ranges, extra, dict(output_format), iterator_class, params)
+  binned_input = list(map(lambda bin_positions: select_items(items, bin_positions), bin_input(sorted_items, bin_ranges)))
+  if util.is_set(params, "bundle"):
+    write_bundle(database, binned_input, bin_ranges, extra, dict(output_format), iterator_class, params)
+  else:
+    write_binned_input(database, binned_input, bin_ranges, extra, dict(output_format), iterator_class, params)
   return True
 
 
 def handler(event, context):
-  util.handle(event, context, handle_sort)
+  util.handle(event, context, lambda database, *args: database.run_stage(handle_sort, *args, event=event))
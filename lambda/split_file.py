@@ -1,20 +1,22 @@
 import boto3
 import pivot
-import threading
 import util
 from database import Database
-from typing import Any, Dict, List, Optional
+from iterator import ItemIndex
+from typing import Any, Dict, List, Optional, Tuple
 
 
 def split_file(database: Database, bucket_name: str, key: str, input_format: Dict[str, Any], output_format: Dict[str, Any], offsets: List[int], params: Dict[str, Any]):
   split_size = params["split_size"]
 
   input_bucket = bucket_name
+  token = "{0:f}-{1:d}".format(output_format["timestamp"], output_format["nonce"])
   if util.is_set(params, "ranges"):
     if "input_prefix" in params:
-      obj = database.get_entries(bucket_name, params["input_prefix"])[0]
+      # Only the run is listed, since a stage prefix spans every run
+      obj = next(database.iterate_entries(bucket_name, "{0:d}/{1:s}/".format(params["input_prefix"], token)))
       input_key = obj.key
-      pivot_key = database.get_entries(bucket_name, "4/")[0].key # TODO Unhardcode
+      pivot_key = next(database.iterate_entries(bucket_name, "4/{0:s}/".format(token))).key # TODO Unhardcode
       [_, _, ranges] = pivot.get_pivot_ranges(bucket_name, pivot_key, params)
     else:
       [input_bucket, input_key, ranges] = pivot.get_pivot_ranges(bucket_name, key, params)
@@ -29,11 +31,19 @@ def split_file(database: Database, bucket_name: str, key: str, input_format: Dic
   content_length: int = obj.content_length()
 #  num_files = int((content_length + split_size - 1) / split_size)
   num_files = 10
+  index_content: Optional[bytes] = obj.get_index()
+  split_ranges: Optional[List[Tuple[int, int]]] = None
+  if index_content is not None:
+    # Splits start at the start of an item, so each item is read by exactly one function
+    split_ranges = ItemIndex.from_bytes(index_content).split(split_size, content_length)
+    num_files = len(split_ranges)
 
-  threads = []
-  token = "{0:f}-{1:d}".format(output_format["timestamp"], output_format["nonce"])
+  payloads = []
   while file_id <= num_files:
-    offsets = [(file_id - 1) * split_size, min(content_length, (file_id) * split_size) - 1]
+    if split_ranges is not None:
+      offsets = list(split_ranges[file_id - 1])
+    else:
+      offsets = [(file_id - 1) * split_size, min(content_length, (file_id) * split_size) - 1]
     extra_params = {**output_format, **{
       "file_id": file_id,
       "num_files": num_files,
@@ -46,14 +56,12 @@ def split_file(database: Database, bucket_name: str, key: str, input_format: Dic
     payload = database.create_payload(params["bucket"], input_key, extra_params)
     payload["log"] = [token, output_format["prefix"], output_format["bin"], output_format["num_bins"], file_id, num_files]
 
-    threads.append(threading.Thread(target=database.invoke, args=(params["output_function"], payload)))
-    threads[-1].start()
+    payloads.append(payload)
     file_id += 1
 
-  for thread in threads:
-    thread.join()
+  database.invoke_many(params["output_function"], payloads)
   return True
 
 
 def handler(event, context):
-  util.handle(event, context, split_file)
+  util.handle(event, context, lambda database, *args: database.run_stage(split_file, *args, event=event))
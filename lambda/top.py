@@ -18,28 +18,25 @@ def find_top(d: Database, table: str, key: str, input_format: Dict[str, Any], ou
   entry = d.get_entry(table, key)
   format_lib = importlib.import_module(params["format"])
   iterator = getattr(format_lib, "Iterator")
-  it = iterator(entry, offsets)
-
   top = []
-  more = True
-  while more:
-    [items, _, more] = it.next()
-
-    for item in items:
-      score: float = it.get_identifier_value(item, params["identifier"])
-      heapq.heappush(top, Element(score, item))
-      if len(top) > params["number"]:
-        heapq.heappop(top)
+  with iterator(entry, offsets) as it:
+    it.enable_prefetch(params)
+    more = True
+    while more:
+      [items, _, more] = it.next()
+
+      for item in items:
+        score: float = it.get_identifier_value(item, params["identifier"])
+        heapq.heappush(top, Element(score, item))
+        if len(top) > params["number"]:
+          heapq.heappop(top)
 
   file_name = util.file_name(output_format)
-  temp_name = "/tmp/{0:s}".format(file_name)
   items = list(map(lambda t: t.value, top))
-  with open(temp_name, "wb+") as f:
+  with d.writer(table, file_name, {}) as f:
     [content, metadata] = iterator.from_array(items, f, it.get_extra())
-
-  with open(temp_name, "rb") as f:
-    d.put(table, file_name, f, metadata)
+    f.close(metadata)
 
 
 def handler(event, context):
-  util.handle(event, context, find_top)
+  util.handle(event, context, lambda database, *args: database.run_stage(find_top, *args, event=event))
@@ -67,9 +67,20 @@ def create_parameter_files(zip_directory, function_name, params):
     pparams = params["pipeline"][i]
     if pparams["name"] == function_name:
       p = {**params["functions"][function_name], **pparams}
-      for value in ["timeout", "num_bins", "bucket", "storage_class", "log", "scheduler"]:
+      for value in ["timeout", "num_bins", "bucket", "storage_class", "log", "scheduler", "key_layout", "index", "manifest"]:
         if value in params:
           p[value] = params[value]
+      if any(map(lambda stage: "codec" in {**params["functions"][stage["name"]], **stage}, params["pipeline"])):
+        # Readers only look for frame indexes if a stage of the pipeline compresses its output
+        p["compressed"] = True
+      if "gc" in params and params["gc"] and i == len(params["pipeline"]) - 1:
+        # The last stage deletes the outputs of the stages before it, except for the durable ones
+        p["gc"] = True
+        p["gc_keep"] = []
+        for j in range(len(params["pipeline"])):
+          stage_params = {**params["functions"][params["pipeline"][j]["name"]], **params["pipeline"][j]}
+          if "durable" in stage_params and stage_params["durable"]:
+            p["gc_keep"].append(j + 1)
 
       name = "{0:d}.json".format(i)
       json_path = "{0:s}/{1:s}".format(zip_directory, name)
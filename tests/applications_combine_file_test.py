@@ -43,5 +43,33 @@ class CombineFunction(unittest.TestCase):
     self.assertEqual(combined_entry.key, "1/123.400000-13/1-1/1-0.000000-1-suffix.new")
     self.assertEqual(combined_entry.get_content().decode("utf-8"), "A B C\nD E F\nG H I\nJ K L\n")
 
+  def test_server_side(self):
+    database: TestDatabase = TestDatabase()
+    database.min_part_size = 4
+    database.part_size = 8
+    table1: TestTable = database.create_table("table1")
+    table1.add_entry("0/123.400000-13/1-1/2-0.00000-2-suffix.new", "G H I\nJ K L")
+    entry1: TestEntry = table1.add_entry("0/123.400000-13/1-1/1-0.0000-2-suffix.new", "A B C\nD E F")
+    log = database.create_table("log")
+    params = {
+      "bucket": table1.name,
+      "file": "combine_file",
+      "format": "new_line",
+      "log": log.name,
+      "name": "combine",
+      "server_side": True,
+      "sort": False,
+      "storage_class": "test",
+      "output_format": "new_line",
+      "timeout": 60,
+    }
+    database.params = params
+    event = tutils.create_event(database, table1.name, entry1.key)
+    context = tutils.create_context(params)
+    combine_files.handler(event, context)
+    combined_entry = database.get_entry(table1.name, "1/123.400000-13/1-1/1-0.000000-1-suffix.new")
+    self.assertEqual(combined_entry.get_content().decode("utf-8"), "A B C\nD E F\nG H I\nJ K L")
+    self.assertEqual(database.copy_count, 2)
+
 if __name__ == "__main__":
   unittest.main()
@@ -78,6 +78,62 @@ optimal_alignment_score: 540 suboptimal_alignment_score: 9""")
 
     self.assertEqual(objs[3].get_content().decode("utf-8"), "")
 
+  def test_bundle(self):
+    s3: TestDatabase = TestDatabase()
+    s3.create_table("log")
+    table1: TestTable = s3.create_table("table1")
+
+    entry1: TestEntry = table1.add_entry("0/123.400000-13/1-1/1-1-1-suffix.blast",
+"""target_name: 1
+query_name: 1
+optimal_alignment_score: 540 suboptimal_alignment_score: 9
+
+target_name: 1
+query_name: 1
+optimal_alignment_score: 193 suboptimal_alignment_score: 48""")
+    pivots: List[Dict[str, Any]] = []
+    increment = 300000
+    for i in range(3):
+      start = i * increment
+      pivots.append({
+        "range": [start, start + increment],
+        "bin": i + 1
+      })
+
+    params = {
+      "bucket": table1.name,
+      "bundle": True,
+      "execute": 0,
+      "file": "sort",
+      "format": "blast",
+      "identifier": "score",
+      "log": "log",
+      "name": "sort",
+      "output_function": "combine",
+      "pivots": pivots,
+      "s3": s3,
+      "storage_class": "STANDARD",
+      "timeout": 60,
+    }
+
+    event = tutils.create_event(s3, table1.name, entry1.key, params)
+    context = tutils.create_context(params)
+    sort.handler(event, context)
+
+    # One bundle with every bin, and one combine invocation per bin
+    objs = sorted(s3.get_entries(table1.name), key=lambda obj: obj.key)
+    self.assertEqual(len(objs), 2)
+    self.assertEqual(list(map(lambda payload: payload["Records"][0]["s3"]["extra_params"]["bundle_bin"], s3.payloads)), [1, 2, 3])
+    self.assertEqual(s3.get_bundle_entry(table1.name, objs[1].key, "1").get_content().decode("utf-8"),
+"""target_name: 1
+query_name: 1
+optimal_alignment_score: 193 suboptimal_alignment_score: 48""")
+    self.assertEqual(s3.get_bundle_entry(table1.name, objs[1].key, "2").get_content().decode("utf-8"),
+"""target_name: 1
+query_name: 1
+optimal_alignment_score: 540 suboptimal_alignment_score: 9""")
+    self.assertEqual(s3.get_bundle_entry(table1.name, objs[1].key, "3").get_content(), b"")
+
   def test_offsets(self):
     s3 = TestDatabase()
     s3.create_table("log")
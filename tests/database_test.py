@@ -0,0 +1,943 @@
+import asyncio
+import inspect
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from botocore.exceptions import ClientError
+import tutils
+from tutils import TestDatabase, TestEntry, TestTable
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir + "/formats")
+import new_line
+from iterator import OffsetBounds
+sys.path.insert(0, parentdir)
+from database import BlockCache, KeyLayout, LocalDatabase, LocalEntry, Object, RateLimiter, S3, S3Coordinator, Statistics
+
+
+class BlockCacheMethods(unittest.TestCase):
+  def test_get_range(self):
+    statistics = Statistics()
+    entry = TestEntry("test.new_line", b"0123456789abcdefghij", statistics)
+    entry.cache = BlockCache(4, 100)
+
+    self.assertEqual(entry.get_range(2, 9), b"23456789")
+    self.assertEqual(statistics.read_count, 1)
+    self.assertEqual(statistics.cache_miss_count, 3)
+
+    # Overlapping read only fetches the missing block
+    self.assertEqual(entry.get_range(6, 13), b"6789abcd")
+    self.assertEqual(statistics.read_count, 2)
+    self.assertEqual(statistics.cache_hit_count, 2)
+    self.assertEqual(statistics.cache_miss_count, 4)
+
+    # Read past the end of the content
+    self.assertEqual(entry.get_range(18, 30), b"ij")
+    self.assertEqual(entry.get_range(16, 19), b"ghij")
+    self.assertEqual(statistics.read_count, 3)
+    entry.destroy()
+
+  def test_eviction(self):
+    statistics = Statistics()
+    entry = TestEntry("test.new_line", b"0123456789abcdefghij", statistics)
+    entry.cache = BlockCache(4, 8)
+
+    self.assertEqual(entry.get_range(0, 11), b"0123456789ab")
+    self.assertEqual(entry.cache.memory_byte_count, 8)
+    # First block was evicted
+    self.assertEqual(entry.get_range(0, 3), b"0123")
+    self.assertEqual(statistics.read_count, 2)
+    self.assertEqual(entry.get_range(8, 11), b"89ab")
+    self.assertEqual(statistics.read_count, 2)
+    entry.destroy()
+
+  def test_disk(self):
+    directory = "/tmp/block_cache_test"
+    statistics = Statistics()
+    entry = TestEntry("test.new_line", b"0123456789abcdefghij", statistics)
+    entry.cache = BlockCache(4, 4, 8, directory)
+
+    self.assertEqual(entry.get_range(0, 11), b"0123456789ab")
+    self.assertEqual(entry.cache.disk_byte_count, 8)
+    self.assertEqual(len(os.listdir(directory)), 2)
+
+    # Served from disk
+    self.assertEqual(entry.get_range(0, 7), b"01234567")
+    self.assertEqual(statistics.read_count, 1)
+    self.assertEqual(statistics.cache_hit_count, 2)
+
+    entry.cache.invalidate(entry.cache_key())
+    self.assertEqual(entry.cache.disk_byte_count, 0)
+    self.assertEqual(entry.cache.memory_byte_count, 0)
+    self.assertEqual(len(os.listdir(directory)), 0)
+    shutil.rmtree(directory)
+    entry.destroy()
+
+
+class StatisticsMethods(unittest.TestCase):
+  def test_read_paths(self):
+    database: TestDatabase = TestDatabase()
+    table1: TestTable = database.create_table("table1")
+    entry: TestEntry = table1.add_entry("test.new_line", b"0123456789")
+    self.assertEqual(entry.get_range(2, 5), b"2345")
+    self.assertEqual(entry.get_content(), b"0123456789")
+    database.download(table1.name, "test.new_line", "/tmp/statistics_test")
+    os.remove("/tmp/statistics_test")
+    self.assertEqual(database.statistics.read_count, 3)
+    self.assertEqual(database.statistics.read_byte_count, 24)
+    self.assertEqual(sum(database.statistics.latency_histograms["get"]), 3)
+    self.assertEqual(len(database.statistics.latency_histograms["get"]), len(Statistics.latency_bounds) + 1)
+    database.destroy()
+
+  def test_write_log(self):
+    database: TestDatabase = TestDatabase()
+    database.create_table("table1")
+    database.create_table("log")
+    database.write("table1", "test.new_line", b"A B C\n", {}, False)
+    database.write_log("log", "0/123.4-13/1-1/1-1-1.log", {"duration": 1.0})
+    log = json.loads(database.get_entry("log", "0/123.4-13/1-1/1-1-1.log").get_content().decode("utf-8"))
+    self.assertEqual(log["duration"], 1.0)
+    self.assertEqual(log["write_byte_count"], 6)
+    self.assertEqual(sum(log["latency_histograms"]["put"]), 1)
+    self.assertEqual(log["retry_count"], 0)
+    self.assertGreaterEqual(log["user_time"], 0.0)
+    database.destroy()
+
+  def test_stage_log(self):
+    database: TestDatabase = TestDatabase()
+    database.params = {"log": "log", "name": "split"}
+    table1: TestTable = database.create_table("table1")
+    database.create_table("log")
+    key = "0/123.400000-13/1-1/1-1-1-suffix.new_line"
+    table1.add_entry(key, "A B C\n")
+
+    def stage(database, table_name, key):
+      return database.get_entry(table_name, key).get_content()
+
+    # Each invocation writes one log once its stage returns
+    event = tutils.create_event(database, table1.name, key)
+    self.assertEqual(database.run_stage(stage, table1.name, key, event=event), b"A B C\n")
+    log = json.loads(database.get_entry("log", key + ".split.log").get_content().decode("utf-8"))
+    self.assertEqual(log["read_byte_count"], 6)
+    self.assertGreaterEqual(log["duration"], 0.0)
+
+    # Invocations for the files of a split object have a log each
+    event["log"] = ["123.400000-13", 1, 1, 1, 2, 3]
+    database.run_stage(stage, table1.name, key, event=event)
+    self.assertTrue(database.contains("log", key + ".split-2-3.log"))
+    self.assertEqual(len(database.get_entries("log")), 2)
+    database.destroy()
+
+
+class CodecMethods(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def test_write(self):
+    content = b"".join(map(lambda i: "{0:d}\tA\tB\n".format(i % 10).encode("utf-8"), range(1000)))
+    for name in ["lzma", "zlib"]:
+      database = LocalDatabase(self.root, {"codec": name, "codec_frame_size": 2048})
+      database.create_table("table1")
+      database.write("table1", "test.tsv", content, {"count": "1000"})
+      entry = database.get_entry("table1", "test.tsv")
+      self.assertTrue(entry.is_compressed())
+      self.assertLess(os.path.getsize(entry.path), len(content))
+      self.assertEqual(entry.content_length(), len(content))
+      self.assertEqual(entry.get_metadata()["count"], "1000")
+      self.assertEqual(entry.get_content(), content)
+      self.assertEqual(entry.get_range(0, 0), content[0:1])
+      self.assertEqual(entry.get_range(2000, 4200), content[2000:4201])
+      self.assertEqual(entry.get_range(len(content) - 5, len(content) + 10), content[-5:])
+      entry.close()
+
+  def test_writer(self):
+    database = LocalDatabase(self.root, {"codec": "zlib", "codec_frame_size": 8})
+    database.min_part_size = 4
+    database.part_size = 4
+    database.create_table("table1")
+    plain = LocalDatabase(self.root)
+    plain.write("table1", "input.new_line", b"0123456789", {})
+    with database.writer("table1", "output.new_line", {}) as f:
+      f.write(b"abcdef")
+      f.copy(plain.get_entry("table1", "input.new_line"), 0, 9)
+      f.close({"count": "1"})
+    entry = plain.get_entry("table1", "output.new_line")
+    self.assertEqual(entry.get_content(), b"abcdef0123456789")
+    self.assertEqual(entry.get_metadata()["count"], "1")
+    self.assertEqual(entry.get_range(5, 7), b"f01")
+
+    # Stages without a codec still read compressed input
+    plain.download("table1", "output.new_line", self.root + "/output")
+    with open(self.root + "/output", "rb") as f:
+      self.assertEqual(f.read(), b"abcdef0123456789")
+    entry.close()
+
+
+class FakeBody:
+  def __init__(self, content: bytes):
+    self.content = content
+
+  def read(self):
+    return self.content
+
+
+class FakeResource:
+  # Stands in for a boto3 S3 Object resource
+  def __init__(self, content: bytes, etag: str):
+    self.bucket_name = "table1"
+    self.client = self
+    self.content = content
+    self.etag = etag
+    self.get_etags = []
+    self.head_count = 0
+    self.key = "0/123.400000-13/1-1/1-1-1-suffix.new_line"
+    self.meta = self
+    self.throttles = 0
+
+  def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+    if self.throttles > 0:
+      self.throttles -= 1
+      raise ClientError({"Error": {"Code": "SlowDown"}}, "GetObject")
+    self.get_etags.append(IfMatch)
+    if IfMatch is not None and IfMatch != self.etag:
+      raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "GetObject")
+    content = self.content
+    if Range is not None:
+      [start, end] = list(map(int, Range.split("=")[1].split("-")))
+      content = content[start:end + 1]
+    return {"Body": FakeBody(content), "ETag": self.etag}
+
+  def head_object(self, Bucket, Key):
+    self.head_count += 1
+    return {"ContentLength": len(self.content), "ETag": self.etag, "LastModified": datetime.now(), "Metadata": {"count": "1"}}
+
+
+class ObjectMethods(unittest.TestCase):
+  def test_head(self):
+    resource = FakeResource(b"0123456789", "etag1")
+    obj = Object("test.new_line", resource, Statistics())
+    self.assertEqual(obj.get_metadata(), {"count": "1"})
+    self.assertEqual(obj.content_length(), 10)
+    obj.last_modified_at()
+    self.assertEqual(resource.head_count, 1)
+    self.assertEqual(obj.get_range(2, 4), b"234")
+    self.assertEqual(resource.get_etags, ["etag1"])
+
+  def test_replaced(self):
+    resource = FakeResource(b"0123456789", "etag1")
+    obj = Object("test.new_line", resource, Statistics(), None, 10, 0.0, "etag1")
+    obj.metadata = {}
+    resource.content = b"abcdefghijklmnop"
+    resource.etag = "etag2"
+
+    # The cached ETag no longer matches, so the head is reloaded and the read retried
+    self.assertEqual(obj.get_range(2, 4), b"cde")
+    self.assertEqual(resource.get_etags, ["etag1", "etag2"])
+    self.assertEqual(obj.content_length(), 16)
+    self.assertEqual(resource.head_count, 1)
+
+  def test_throttled(self):
+    # Reads go through the rate limiter, which retries throttled requests
+    resource = FakeResource(b"0123456789", "etag1")
+    resource.throttles = 2
+    statistics = Statistics()
+    limiter = RateLimiter(statistics, lambda e: isinstance(e, ClientError) and e.response["Error"]["Code"] == "SlowDown")
+    limiter.max_backoff = 0.01
+    obj = Object("test.new_line", resource, statistics, None, 10, 0.0, "etag1", False, False, limiter)
+    self.assertEqual(obj.get_range(2, 4), b"234")
+    self.assertEqual(statistics.throttle_count, 2)
+    self.assertLess(limiter.buckets[("get", "table1/0")].rate, RateLimiter.rates["get"])
+
+  def test_uncompressed(self):
+    # Listed objects of a pipeline without a codec are read without a head
+    resource = FakeResource(b"0123456789", "etag1")
+    obj = Object("test.new_line", resource, Statistics(), None, 10, 0.0, "etag1", False)
+    self.assertFalse(obj.is_compressed())
+    self.assertEqual(obj.content_length(), 10)
+    self.assertEqual(obj.get_content(), b"0123456789")
+    self.assertEqual(obj.get_range(2, 4), b"234")
+    self.assertEqual(resource.head_count, 0)
+
+    # Otherwise the metadata tells whether the object is compressed
+    obj = Object("test.new_line", resource, Statistics(), None, 10, 0.0, "etag1")
+    self.assertEqual(obj.content_length(), 10)
+    self.assertEqual(resource.head_count, 1)
+
+
+class FlakyEntry(TestEntry):
+  def __init__(self, key, content, failures):
+    TestEntry.__init__(self, key, content)
+    self.failures = failures
+    self.lock = threading.Lock()
+    self.ranges = []
+
+  def __get_range__(self, start_index, end_index):
+    with self.lock:
+      self.ranges.append(start_index)
+      if start_index in self.failures:
+        self.failures.remove(start_index)
+        raise Exception("Connection reset")
+    return TestEntry.__get_range__(self, start_index, end_index)
+
+
+class DownloadMethods(unittest.TestCase):
+  def test_ranges(self):
+    content = b"0123456789abcdefghijklmnopqrstuvwxyz"
+    entry = FlakyEntry("download.new_line", content, [8, 24])
+    entry.download_part_size = 8
+    with tempfile.TemporaryFile() as f:
+      self.assertEqual(entry.download(f), len(content))
+      self.assertEqual(f.tell(), len(content))
+      f.seek(0)
+      self.assertEqual(f.read(), content)
+    # Only the failed ranges are fetched again
+    self.assertEqual(sorted(entry.ranges), [0, 8, 8, 16, 24, 24, 32])
+    self.assertEqual(entry.statistics.retry_count, 2)
+    self.assertEqual(entry.statistics.read_byte_count, len(content))
+    # The ranges are fetched on worker threads while the caller waits
+    self.assertGreater(entry.statistics.background_io_time, 0.0)
+    self.assertGreater(entry.statistics.io_time, 0.0)
+    entry.destroy()
+
+  def test_failure(self):
+    entry = FlakyEntry("download.new_line", b"0123456789abcdefghij", [8, 8, 8])
+    entry.download_part_size = 8
+    with tempfile.TemporaryFile() as f:
+      with self.assertRaises(Exception):
+        entry.download(f)
+    entry.destroy()
+
+
+class RangePlanMethods(unittest.TestCase):
+  def test_plan_ranges(self):
+    entry = TestEntry("0/123.400000-13/1-1/1-1-1-suffix.new_line", bytes(range(100)) * 10)
+    entry.range_gap_size = 10
+    entry.plan_ranges([(0, 9), (15, 30), (100, 110)])
+    self.assertEqual(entry.get_range(15, 30), bytes(range(15, 31)))
+    self.assertEqual(entry.get_range(0, 4), bytes(range(0, 5)))
+    self.assertEqual(entry.statistics.read_count, 1)
+    # The plan is dropped once every planned byte has been read
+    self.assertEqual(entry.get_range(5, 9), bytes(range(5, 10)))
+    self.assertEqual(entry.get_range(0, 4), bytes(range(0, 5)))
+    self.assertEqual(entry.statistics.read_count, 2)
+    self.assertEqual(entry.get_range(100, 110), bytes(range(0, 11)))
+    self.assertEqual(entry.statistics.read_count, 3)
+    self.assertEqual(len(entry.plans), 0)
+    entry.destroy()
+
+
+class ConcurrencyMethods(unittest.TestCase):
+  def test_counters(self):
+    statistics = Statistics()
+    threads = list(map(lambda i: threading.Thread(target=lambda: [statistics.add("read_count") for j in range(10000)]), range(8)))
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(statistics.read_count, 80000)
+    with self.assertRaises(AttributeError):
+      statistics.unknown_count
+
+  def test_local_database(self):
+    root = tempfile.mkdtemp()
+    database = LocalDatabase(root)
+    database.create_table("table1")
+
+    def run(i):
+      key = "{0:d}.new_line".format(i)
+      database.write("table1", key, "{0:d}\n".format(i).encode("utf-8"), {})
+      entry = database.get_entry("table1", key)
+      content = entry.get_content()
+      entry.close()
+      return content
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+      contents = list(executor.map(run, range(100)))
+    self.assertEqual(contents, list(map(lambda i: "{0:d}\n".format(i).encode("utf-8"), range(100))))
+    self.assertEqual(database.statistics.write_count, 100)
+    self.assertEqual(database.statistics.read_count, 100)
+    self.assertEqual(sum(database.statistics.latency_histograms["put"]), 100)
+    shutil.rmtree(root)
+
+
+class AsyncMethods(unittest.TestCase):
+  def test_database(self):
+    database: TestDatabase = TestDatabase()
+    database.params = {"ancestry": [], "output_function": "next"}
+    table1: TestTable = database.create_table("table1")
+    for i in range(4):
+      table1.add_entry("0/{0:d}.new_line".format(i), "{0:d} A B\n".format(i))
+
+    async def stage(database, table_name):
+      entries = await database.aget_entries(table_name, "0/")
+      contents = await asyncio.gather(*map(lambda entry: entry.aget_content(), entries))
+      ranges = await asyncio.gather(*map(lambda entry: entry.aget_range(2, 2), entries))
+      await database.awrite(table_name, "1/output.new_line", b"".join(contents), {}, False)
+      await database.ainvoke("next", {"id": 1})
+      return ranges
+
+    self.assertEqual(database.run_stage(stage, table1.name), [b"A", b"A", b"A", b"A"])
+    self.assertEqual(database.get_entry(table1.name, "1/output.new_line").get_content(), b"0 A B\n1 A B\n2 A B\n3 A B\n")
+    self.assertEqual(database.payloads[-1], {"id": 1})
+    # Stage functions that aren't coroutines are called as they are
+    self.assertEqual(database.run_stage(lambda database, table_name: table_name, table1.name), table1.name)
+    database.destroy()
+
+  def test_load(self):
+    root = tempfile.mkdtemp()
+    database = LocalDatabase(root, {"codec": "zlib"})
+    database.create_table("table1")
+    database.write("table1", "test.new_line", b"A B C\n", {"count": "1"})
+    entry = asyncio.get_event_loop().run_until_complete(database.get_entry("table1", "test.new_line").aload())
+    self.assertEqual(entry.get_content(), b"A B C\n")
+    self.assertEqual(entry.get_metadata(), {"count": "1"})
+    self.assertEqual(entry.get_range(2, 2), b"B")
+    shutil.rmtree(root)
+
+
+class PagedDatabase(TestDatabase):
+  def __get_entries_page__(self, table_name, prefix, token):
+    entries = self.__get_entries__(table_name, prefix)
+    start = int(token) if token else 0
+    next_token = str(start + 2) if start + 2 < len(entries) else None
+    return (entries[start:start + 2], next_token)
+
+
+class ListingMethods(unittest.TestCase):
+  def test_iterate_entries(self):
+    database: PagedDatabase = PagedDatabase()
+    table1: TestTable = database.create_table("table1")
+    for i in range(5):
+      table1.add_entry("0/{0:d}.new_line".format(i), "A B C\n")
+
+    entries = database.get_entries(table1.name, "0/")
+    self.assertEqual(list(map(lambda entry: entry.key, entries)), list(map(lambda i: "0/{0:d}.new_line".format(i), range(5))))
+    self.assertEqual(database.statistics.list_count, 3)
+
+    # Only the first page is listed
+    entry = next(database.iterate_entries(table1.name, "0/"))
+    self.assertEqual(entry.key, "0/0.new_line")
+    self.assertEqual(database.statistics.list_count, 4)
+    database.destroy()
+
+
+class FakeListingClient:
+  # Stands in for the S3 client and resource of a bucket that is only listed
+  def __init__(self, keys):
+    self.client = self
+    self.head_count = 0
+    self.keys = keys
+    self.meta = self
+
+  def Object(self, bucket_name, key):
+    resource = FakeResource(b"", "etag")
+    resource.bucket_name = bucket_name
+    resource.client = self
+    resource.key = key
+    return resource
+
+  def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+    [start, end] = list(map(int, Range.split("=")[1].split("-"))) if Range is not None else [0, 5]
+    return {"Body": FakeBody(b"A B C\n"[start:end + 1]), "ETag": "etag"}
+
+  def head_object(self, Bucket, Key):
+    self.head_count += 1
+    return {"ContentLength": 6, "ETag": "etag", "LastModified": datetime.now(), "Metadata": {}}
+
+  def list_objects_v2(self, Bucket, Prefix=None, ContinuationToken=None):
+    start = int(ContinuationToken) if ContinuationToken else 0
+    contents = list(map(lambda key: {"Key": key, "Size": 6, "LastModified": datetime.fromtimestamp(1700000000), "ETag": "etag"}, self.keys[start:start + 2]))
+    truncated = start + 2 < len(self.keys)
+    return {"Contents": contents, "IsTruncated": truncated, "NextContinuationToken": str(start + 2)}
+
+
+class ListedDatabase(TestDatabase):
+  def __get_entries_page__(self, table_name, prefix, token):
+    return S3.__get_entries_page__(self, table_name, prefix, token)
+
+
+class ListedMethods(unittest.TestCase):
+  def test_no_head(self):
+    # Listed objects already know their size and modification time
+    keys = list(map(lambda i: "1/123.400000-13/1-1/{0:d}-1-3-suffix.new_line".format(i), range(1, 4)))
+    client = FakeListingClient(keys)
+    database: ListedDatabase = ListedDatabase()
+    database.local = threading.local()
+    database.local.s3 = client
+    entries = database.get_entries("table1", "1/123.400000-13/")
+    self.assertEqual(list(map(lambda entry: entry.key, entries)), keys)
+    for entry in entries:
+      self.assertEqual(entry.content_length(), 6)
+      self.assertEqual(entry.last_modified_at(), 1700000000)
+    self.assertEqual(client.head_count, 0)
+    database.destroy()
+
+  def test_unindexed(self):
+    # Iterators only look for an item index if the pipeline sets index
+    keys = ["1/123.400000-13/1-1/1-1-1-suffix.new_line"]
+    client = FakeListingClient(keys)
+    database: ListedDatabase = ListedDatabase()
+    database.local = threading.local()
+    database.local.s3 = client
+    [entry] = database.get_entries("table1", "1/123.400000-13/")
+    with new_line.Iterator(entry, OffsetBounds(0, 5)) as it:
+      self.assertEqual(list(it.get(0, 5)), [b"A B C"])
+    self.assertEqual(client.head_count, 0)
+
+    database.indexed = True
+    [entry] = database.get_entries("table1", "1/123.400000-13/")
+    self.assertIsNone(entry.get_index())
+    self.assertEqual(client.head_count, 1)
+    database.destroy()
+
+
+class ThrottledDatabase(TestDatabase):
+  def __init__(self, throttle_count: int):
+    TestDatabase.__init__(self)
+    self.lock = threading.Lock()
+    self.throttle_count = throttle_count
+    self.invoked = []
+
+  def __invoke__(self, name, payload):
+    with self.lock:
+      if self.throttle_count > 0:
+        self.throttle_count -= 1
+        raise ClientError({"Error": {"Code": "TooManyRequestsException"}}, "Invoke")
+      self.invoked.append(payload["id"])
+
+
+class InvokeMethods(unittest.TestCase):
+  def test_invoke_many(self):
+    database: ThrottledDatabase = ThrottledDatabase(3)
+    payloads = list(map(lambda i: {"id": i}, range(20)))
+    latencies = database.invoke_many("function", payloads, 4)
+    self.assertEqual(len(latencies), 20)
+    self.assertEqual(database.payloads, payloads)
+    self.assertEqual(sorted(database.invoked), list(range(20)))
+    self.assertEqual(database.statistics.invoke_count, 20)
+    self.assertEqual(database.statistics.invoke_throttle_count, 3)
+    self.assertEqual(database.statistics.retry_count, 3)
+    self.assertEqual(sum(database.statistics.latency_histograms["invoke"]), 20)
+    self.assertEqual(database.invoke_many("function", []), [])
+
+  def test_invoke_error(self):
+    database: TestDatabase = TestDatabase()
+    database.__invoke__ = lambda name, payload: 1 / 0
+    with self.assertRaises(ZeroDivisionError):
+      database.invoke_many("function", [{"id": 1}])
+
+
+class FakeManifestClient:
+  # Stands in for the S3 client. The first conditional write of the counter fails, as if another arrival won the race.
+  def __init__(self):
+    self.conflicts = 1
+    self.content = None
+    self.etag = 0
+
+  def get_object(self, Bucket, Key):
+    if self.content is None:
+      raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+    return {"Body": FakeBody(self.content), "ETag": str(self.etag)}
+
+  def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+    if self.conflicts > 0:
+      self.conflicts -= 1
+      self.content = json.dumps({"count": 1, "last": None}).encode("utf-8")
+      self.etag += 1
+      raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+    assert(IfMatch == str(self.etag) if self.content is not None else IfNoneMatch == "*")
+    self.content = Body
+    self.etag += 1
+
+
+class CoordinatorMethods(unittest.TestCase):
+  def test_conflict(self):
+    database = TestDatabase()
+    client = FakeManifestClient()
+    resource = FakeResource(b"", "")
+    resource.client = client
+    database.local = threading.local()
+    database.local.s3 = resource
+    table1: TestTable = database.create_table("table1")
+    table1.add_entry("manifest/a/other", b"")
+    coordinator = S3Coordinator(database)
+    coordinator.max_backoff = 0.01
+    self.assertEqual(coordinator.arrive("table1", "manifest/a", "key", 2), ("key", ["key", "other"], {}))
+    self.assertEqual(database.statistics.retry_count, 1)
+    # The counter only holds the count and the completing arrival, and each arrival has a marker
+    self.assertEqual(json.loads(client.content.decode("utf-8")), {"count": 2, "last": "key"})
+    self.assertTrue(database.contains("table1", "manifest/a/key"))
+    database.destroy()
+
+
+class RateLimiterMethods(unittest.TestCase):
+  def test_throttled_prefix(self):
+    statistics = Statistics()
+    limiter = RateLimiter(statistics, lambda e: isinstance(e, ClientError))
+    limiter.max_backoff = 0.01
+    failures = [2]
+
+    def put():
+      if failures[0] > 0:
+        failures[0] -= 1
+        raise ClientError({"Error": {"Code": "SlowDown"}}, "PutObject")
+      return "done"
+
+    self.assertEqual(limiter.call("put", "table1/1/123.4-13/1-1/1-1-1.new_line", put), "done")
+    self.assertEqual(statistics.throttle_count, 2)
+    self.assertEqual(len(statistics.throttle_wait_times), 1)
+
+    # Only the throttled prefix slows down
+    self.assertLess(limiter.buckets[("put", "table1/1")].rate, RateLimiter.rates["put"])
+    self.assertEqual(limiter.call("put", "table1/2/123.4-13/1-1/1-1-1.new_line", lambda: "other"), "other")
+    self.assertEqual(limiter.buckets[("put", "table1/2")].rate, RateLimiter.rates["put"])
+    self.assertEqual(len(statistics.throttle_wait_times), 1)
+
+  def test_error(self):
+    limiter = RateLimiter(Statistics(), lambda e: isinstance(e, ClientError))
+    with self.assertRaises(ZeroDivisionError):
+      limiter.call("get", "table1/0/test.new_line", lambda: 1 / 0)
+
+
+class MultipartWriterMethods(unittest.TestCase):
+  def test_small(self):
+    database: TestDatabase = TestDatabase()
+    table1: TestTable = database.create_table("table1")
+    with database.writer(table1.name, "small.new_line", {}) as f:
+      f.write(b"A B C\n")
+      f.write(b"D E F\n")
+    self.assertEqual(database.get_entry(table1.name, "small.new_line").get_content(), b"A B C\nD E F\n")
+    self.assertEqual(database.upload_count, 0)
+    self.assertEqual(database.statistics.write_count, 1)
+    database.destroy()
+
+  def test_parts(self):
+    database: TestDatabase = TestDatabase()
+    database.min_part_size = 4
+    database.part_size = 4
+    table1: TestTable = database.create_table("table1")
+    content = b"0123456789abcdefghij\nklmnop"
+    with database.writer(table1.name, "large.new_line", {}) as f:
+      for i in range(0, len(content), 3):
+        f.write(content[i:i + 3])
+      self.assertFalse(database.contains(table1.name, "large.new_line"))
+    self.assertEqual(database.get_entry(table1.name, "large.new_line").get_content(), content)
+    self.assertEqual(len(database.uploads), 0)
+    # 1 create, 7 parts and 1 complete
+    self.assertEqual(database.statistics.write_count, 9)
+    self.assertEqual(database.statistics.write_byte_count, len(content))
+    database.destroy()
+
+  def test_metadata(self):
+    database: TestDatabase = TestDatabase()
+    database.min_part_size = 4
+    database.part_size = 4
+    table1: TestTable = database.create_table("table1")
+    metadata = {"sorted": "True"}
+    with database.writer(table1.name, "indexed.new_line", metadata) as f:
+      f.expect_index()
+      f.write(b"0123456789")
+      f.set_index(b"index")
+      f.close({"count": "1"})
+    # The caller's metadata isn't changed
+    self.assertEqual(metadata, {"sorted": "True"})
+    entry = database.get_entry(table1.name, "indexed.new_line")
+    self.assertEqual(entry.get_metadata(), {"sorted": "True", "item_index": "True", "count": "1"})
+    self.assertEqual(table1.indexes["indexed.new_line"], b"index")
+    # Only the metadata added at close is set with a copy
+    self.assertEqual(database.replace_count, 1)
+
+    with database.writer(table1.name, "created.new_line", metadata) as f:
+      f.expect_index()
+      f.write(b"0123456789")
+      f.set_index(b"index")
+    self.assertEqual(database.replace_count, 1)
+    self.assertEqual(database.get_entry(table1.name, "created.new_line").get_metadata(), {"sorted": "True", "item_index": "True"})
+    database.destroy()
+
+  def test_abort(self):
+    database: TestDatabase = TestDatabase()
+    database.min_part_size = 4
+    database.part_size = 4
+    table1: TestTable = database.create_table("table1")
+    with self.assertRaises(Exception):
+      with database.writer(table1.name, "abort.new_line", {}) as f:
+        f.write(b"0123456789")
+        raise Exception("Failure")
+    self.assertFalse(database.contains(table1.name, "abort.new_line"))
+    self.assertEqual(len(database.uploads), 0)
+    database.destroy()
+
+  def test_copy(self):
+    database: TestDatabase = TestDatabase()
+    database.min_part_size = 4
+    database.part_size = 8
+    table1: TestTable = database.create_table("table1")
+    entry1: TestEntry = table1.add_entry("test1.new_line", b"0123456789")
+    entry2: TestEntry = table1.add_entry("test2.new_line", b"abc")
+    with database.writer(table1.name, "copy.new_line", {}) as f:
+      f.write(b"#")
+      f.copy(entry1, 0, 9)
+      f.write(b"#")
+      f.copy(entry2, 0, 2)
+      f.copy(entry1, 2, 9)
+    self.assertEqual(database.get_entry(table1.name, "copy.new_line").get_content(), b"#0123456789#abc23456789")
+    # "#" is topped up with "012", so only "3456789" and "23456789" are copied
+    self.assertEqual(database.copy_count, 2)
+    database.destroy()
+
+
+class LocalDatabaseMethods(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.database = LocalDatabase(self.root)
+    self.database.create_table("table1")
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def test_write(self):
+    self.database.write("table1", "0/123.400000-13/1-1/1-1-1-suffix.new_line", b"A B C\nD E F\n", {"count": "2"})
+    self.database.write("table1", "1/123.400000-13/1-1/1-1-1-suffix.new_line", b"", {})
+    self.assertTrue(self.database.contains("table1", "0/123.400000-13/1-1/1-1-1-suffix.new_line"))
+    self.assertFalse(self.database.contains("table1", "2/123.400000-13/1-1/1-1-1-suffix.new_line"))
+
+    entries = self.database.get_entries("table1")
+    self.assertEqual(list(map(lambda entry: entry.key, entries)), [
+      "0/123.400000-13/1-1/1-1-1-suffix.new_line",
+      "1/123.400000-13/1-1/1-1-1-suffix.new_line",
+    ])
+    self.assertEqual(len(self.database.get_entries("table1", "1/")), 1)
+
+    entry: LocalEntry = entries[0]
+    self.assertEqual(entry.content_length(), 12)
+    self.assertEqual(entry.get_metadata(), {"count": "2"})
+    self.assertEqual(entry.get_range(6, 8), b"D E")
+    self.assertEqual(entry.get_range(6, 100), b"D E F\n")
+    view = entry.get_view(0, 4)
+    # The view is of the memory map, not of a copy
+    self.assertIs(view.obj, entry.map)
+    self.assertEqual(view.tobytes(), b"A B C")
+    view.release()
+    self.assertEqual(entry.get_content(), b"A B C\nD E F\n")
+    entry.close()
+    self.assertEqual(entries[1].get_content(), b"")
+    self.assertEqual(entries[1].get_metadata(), {})
+
+  def test_token_layout(self):
+    self.database.params = {"ancestry": [], "output_function": "next", "key_layout": "token"}
+    self.database.write("table1", "1/123.400000-13/1-2/1-1-1-suffix.new_line", b"A\n", {})
+    self.database.write("table1", "1/123.400000-13/2-2/1-1-1-suffix.new_line", b"B\n", {})
+    self.database.write("table1", "1/123.400000-14/1-2/1-1-1-suffix.new_line", b"C\n", {})
+    self.assertEqual(self.database.payloads[0]["Records"][0]["s3"]["object"]["key"], "1/123.400000-13/1-2/1-1-1-suffix.new_line")
+    self.assertTrue(os.path.isdir(self.root + "/table1/123.400000-13/1"))
+
+    key = "1/123.400000-13/2-2/1-1-1-suffix.new_line"
+    self.assertTrue(self.database.contains("table1", key))
+    self.assertEqual(self.database.get_entry("table1", key).get_content(), b"B\n")
+    self.assertEqual(self.database.read("table1", key), b"B\n")
+    for [prefix, count] in [("1/123.400000-13/", 2), ("1/123.400000-13/2-", 1), ("1/123.400000-13/2-2/", 1), ("2/123.400000-13/", 0)]:
+      entries = self.database.get_entries("table1", prefix)
+      self.assertEqual(len(entries), count)
+      self.assertTrue(all(map(lambda entry: entry.key.startswith(prefix), entries)))
+    # A stage prefix without a token would list every run
+    with self.assertRaises(Exception):
+      self.database.get_entries("table1", "1/")
+
+  def test_token_layout_input(self):
+    # upload.py writes inputs in the standard layout, whatever the layout of the pipeline
+    key = "0/1700000000.123456-42/1-1/1-1-1-tide.mzML"
+    LocalDatabase(self.root).write("table1", key, b"<mzML/>", {}, False)
+    self.assertTrue(os.path.isfile(self.root + "/table1/" + key))
+
+    self.database.params = {"ancestry": [], "key_layout": "token"}
+    self.assertTrue(self.database.contains("table1", key))
+    self.assertEqual(self.database.get_entry("table1", key).get_content(), b"<mzML/>")
+    for prefix in ["0/", "0/1700000000.123456-42/", "0/1700000000.123456-42/1-1/"]:
+      self.assertEqual(list(map(lambda entry: entry.key, self.database.get_entries("table1", prefix))), [key])
+    self.database.write("table1", "1/1700000000.123456-42/1-1/1-1-1-tide.mzML", b"<mzML/>", {}, False)
+    self.assertEqual(sorted(self.database.get_run_keys("table1", "1700000000.123456-42")), [key, "1/1700000000.123456-42/1-1/1-1-1-tide.mzML"])
+
+  def test_arrive(self):
+    keys = list(map(lambda i: "1/123.400000-13/1-1/{0:d}-1-8-suffix.new_line".format(i), range(1, 9)))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+      results = list(executor.map(lambda key: self.database.arrive("table1", "1/123.400000-13/1-1", key, 8), keys + keys))
+    # Only duplicates of the completing arrival complete the barrier again
+    completed = set(filter(lambda key: key is not None, map(lambda i: results[i][0] if results[i][0] == (keys + keys)[i] else None, range(len(results)))))
+    self.assertEqual(len(completed), 1)
+    [last, arrived] = self.database.arrive("table1", "1/123.400000-13/1-1", keys[0], 8)
+    self.assertEqual(sorted(arrived), keys)
+    [retried, _] = self.database.arrive("table1", "1/123.400000-13/1-1", last, 8)
+    self.assertEqual(retried, last)
+    self.assertEqual(self.database.get_entries("table1"), [])
+
+    # A duplicate arrival is counted, but the barrier waits until every key has arrived
+    keys = ["1/123.400000-13/2-2/1-1-2-suffix.new_line", "1/123.400000-13/2-2/2-1-2-suffix.new_line"]
+    self.assertEqual(self.database.arrive("table1", "1/123.400000-13/2-2", keys[0], 2), (None, []))
+    self.assertEqual(self.database.arrive("table1", "1/123.400000-13/2-2", keys[0], 2), (None, []))
+    self.assertEqual(self.database.arrive("table1", "1/123.400000-13/2-2", keys[1], 2), (keys[1], keys))
+
+  def test_relay(self):
+    self.database.params = {"ancestry": [], "output_function": "next", "relay_size": 8}
+    self.database.write("table1", "1/small.new_line", b"A B C\n", {"count": "1"})
+    self.database.write("table1", "1/large.new_line", b"A B C\nD E F\n", {"count": "2"})
+    self.assertFalse(self.database.contains("table1", "1/small.new_line"))
+    self.assertTrue(self.database.contains("table1", "1/large.new_line"))
+    self.assertEqual(len(self.database.payloads), 2)
+    self.assertNotIn("relay", self.database.payloads[1]["Records"][0]["s3"])
+
+    # The next stage serves the content from its payload
+    database = LocalDatabase(self.root)
+    database.run_stage(lambda database: None, event=self.database.payloads[0])
+    entry = database.get_entry("table1", "1/small.new_line")
+    self.assertEqual(entry.get_content(), b"A B C\n")
+    self.assertEqual(entry.get_range(2, 4), b"B C")
+    self.assertEqual(entry.get_metadata(), {"count": "1"})
+    self.assertEqual(database.statistics.read_count, 0)
+
+    # Durable stages write the object too
+    self.database.params["durable"] = True
+    self.database.write("table1", "1/durable.new_line", b"A B C\n", {})
+    self.assertTrue(self.database.contains("table1", "1/durable.new_line"))
+    self.assertIn("relay", self.database.payloads[2]["Records"][0]["s3"])
+
+  def test_relay_barrier(self):
+    # Relayed keys arrive with their content, so the completing arrival can read every key
+    keys = ["1/123.400000-13/1-1/1-1-2-suffix.new_line", "1/123.400000-13/1-1/2-1-2-suffix.new_line"]
+    self.database.params = {"ancestry": [], "output_function": "next", "relay_size": 8}
+    self.database.write("table1", keys[0], b"A\n", {"count": "1"})
+    self.database.write("table1", keys[1], b"B C D E F\n", {"count": "1"})
+    self.assertFalse(self.database.contains("table1", keys[0]))
+
+    databases = [LocalDatabase(self.root), LocalDatabase(self.root)]
+    for [database, payload] in zip(databases, self.database.payloads):
+      database.load_relayed(payload)
+    self.assertEqual(databases[0].arrive("table1", "1/123.400000-13/1-1", keys[0], 2), (None, []))
+    self.assertEqual(databases[1].arrive("table1", "1/123.400000-13/1-1", keys[1], 2), (keys[1], keys))
+    self.assertEqual(databases[1].get_entry("table1", keys[0]).get_content(), b"A\n")
+    self.assertEqual(databases[1].get_entry("table1", keys[0]).get_metadata(), {"count": "1"})
+    self.assertEqual(databases[1].get_entry("table1", keys[1]).get_content(), b"B C D E F\n")
+    self.assertEqual(databases[1].statistics.read_count, 1)
+
+  def test_delete(self):
+    self.database.delete_batch_size = 2
+    keys = list(map(lambda i: "1/123.400000-13/1-1/{0:d}-1-5-suffix.new_line".format(i), range(1, 6)))
+    for key in keys:
+      self.database.write("table1", key, b"A\n", {"count": "1"})
+    self.database.delete("table1", keys[:4])
+    self.assertEqual(list(map(lambda entry: entry.key, self.database.get_entries("table1"))), keys[4:])
+    self.assertEqual(self.database.statistics.delete_count, 4)
+    self.assertEqual(sum(self.database.statistics.latency_histograms["delete"]), 2)
+
+  def test_index(self):
+    key = "1/123.400000-13/1-1/1-1-1-suffix.new_line"
+    with self.database.writer("table1", key, {}) as f:
+      f.write(b"A\nB\n")
+      f.set_index(b"index")
+      f.close({"count": "2"})
+    entry = self.database.get_entry("table1", key)
+    self.assertEqual(entry.get_metadata(), {"count": "2", "item_index": "True"})
+    self.assertEqual(entry.get_index(), b"index")
+    # Indexes aren't listed with the objects
+    self.assertEqual(list(map(lambda entry: entry.key, self.database.get_entries("table1"))), [key])
+
+    self.database.delete("table1", [key])
+    self.assertEqual(os.listdir(self.root + "/table1/1/123.400000-13/1-1"), [])
+
+  def test_collect_garbage(self):
+    self.database.params = {"ancestry": [], "gc": True, "gc_keep": [2], "key_layout": "token"}
+    for prefix in range(4):
+      self.database.write("table1", "{0:d}/123.400000-13/1-1/1-1-1-suffix.new_line".format(prefix), b"A\n", {}, False)
+    self.database.write("table1", "1/123.400000-14/1-1/1-1-1-suffix.new_line", b"A\n", {}, False)
+
+    # The intermediates are only deleted once every file of every bin of the final stage is written
+    self.database.write("table1", "4/123.400000-13/1-2/1-1-2-suffix.new_line", b"A\n", {})
+    self.database.write("table1", "4/123.400000-13/2-2/1-1-1-suffix.new_line", b"A\n", {})
+    self.database.write("table1", "4/123.400000-13/2-2/1-1-1-suffix.new_line", b"A\n", {})
+    self.assertEqual(len(self.database.get_entries("table1")), 7)
+    self.database.write("table1", "4/123.400000-13/1-2/2-1-2-suffix.new_line", b"A\n", {})
+    self.assertEqual(sorted(map(lambda entry: entry.key, self.database.get_entries("table1"))), [
+      "0/123.400000-13/1-1/1-1-1-suffix.new_line",
+      "1/123.400000-14/1-1/1-1-1-suffix.new_line",
+      "2/123.400000-13/1-1/1-1-1-suffix.new_line",
+      "4/123.400000-13/1-2/1-1-2-suffix.new_line",
+      "4/123.400000-13/1-2/2-1-2-suffix.new_line",
+      "4/123.400000-13/2-2/1-1-1-suffix.new_line",
+    ])
+    self.assertFalse(os.path.exists(self.root + "/table1/.ripple-manifest/123.400000-13"))
+
+    # File names without a suffix end in the number of files
+    self.database.write("table1", "3/123.400000-15/1-1/1-1-1-suffix.new_line", b"A\n", {}, False)
+    self.database.write("table1", "4/123.400000-15/1-1/1-0.000000-2.txt", b"A\n", {})
+    self.assertTrue(self.database.contains("table1", "3/123.400000-15/1-1/1-1-1-suffix.new_line"))
+    self.database.write("table1", "4/123.400000-15/1-1/2-0.000000-2.txt", b"A\n", {})
+    self.assertFalse(self.database.contains("table1", "3/123.400000-15/1-1/1-1-1-suffix.new_line"))
+
+  def test_key_layout(self):
+    key = "1/123.400000-13/2-4/1-1-1-suffix.new_line"
+    stored = KeyLayout.to_token_first(key)
+    self.assertEqual(stored.split("/")[:2], ["123.400000-13", "1"])
+    self.assertEqual(KeyLayout.to_standard(stored), key)
+    self.assertEqual(KeyLayout.to_standard(key), key)
+    self.assertEqual(KeyLayout.token(key), "123.400000-13")
+    self.assertEqual(KeyLayout.token(stored), "123.400000-13")
+    self.assertNotEqual(stored.split("/")[2], KeyLayout.to_token_first("1/123.400000-13/1-4/1-1-1-suffix.new_line").split("/")[2])
+    self.assertEqual(KeyLayout.to_token_first("fasta/input.fasta"), "fasta/input.fasta")
+    self.assertEqual(KeyLayout.to_token_first_prefix("1/123.400000-13/"), "123.400000-13/1/")
+    with self.assertRaises(Exception):
+      KeyLayout.to_token_first_prefix("1/")
+    # Inputs keep the standard layout
+    self.assertEqual(KeyLayout.to_token_first("0/123.400000-13/1-1/1-1-1-tide.mzML"), "0/123.400000-13/1-1/1-1-1-tide.mzML")
+    self.assertEqual(KeyLayout.to_token_first_prefix("0/"), "0/")
+
+  def test_invoke(self):
+    self.database.params = {"ancestry": [], "output_function": "next"}
+    self.database.write("table1", "0/test.new_line", b"A B C\n", {})
+    self.assertEqual(len(self.database.payloads), 1)
+    self.assertEqual(self.database.payloads[0]["Records"][0]["s3"]["object"]["key"], "0/test.new_line")
+
+  def test_bundle(self):
+    self.database.min_part_size = 4
+    self.database.part_size = 4
+    parts = [("1", b"A B C\n", {"count": "1"}), ("2", b"", {}), ("3", b"D E F\nG H I\n", {"count": "2"})]
+    self.database.write_bundle("table1", "1/123.400000-13/0-3/1-1-1-suffix.new_line", parts, {})
+    entry = self.database.get_bundle_entry("table1", "1/123.400000-13/0-3/1-1-1-suffix.new_line", "3")
+    self.assertEqual(entry.content_length(), 12)
+    self.assertEqual(entry.get_metadata(), {"count": "2"})
+    self.assertEqual(entry.get_range(6, 100), b"G H I\n")
+    self.assertEqual(self.database.get_bundle_entry("table1", "1/123.400000-13/0-3/1-1-1-suffix.new_line", "2").get_content(), b"")
+
+    # Copies are taken from the range of the part in the bundle
+    with self.database.writer("table1", "output.new_line", {}) as f:
+      f.copy(entry, 0, 11)
+    self.assertEqual(self.database.get_entry("table1", "output.new_line").get_content(), b"D E F\nG H I\n")
+
+  def test_writer(self):
+    self.database.min_part_size = 4
+    self.database.part_size = 4
+    self.database.write("table1", "input.new_line", b"0123456789", {})
+    entry: LocalEntry = self.database.get_entry("table1", "input.new_line")
+    with self.database.writer("table1", "output.new_line", {}) as f:
+      f.write(b"abcdef")
+      f.copy(entry, 0, 9)
+      f.close({"count": "1"})
+    entry.close()
+    output: LocalEntry = self.database.get_entry("table1", "output.new_line")
+    self.assertEqual(output.get_content(), b"abcdef0123456789")
+    self.assertEqual(output.get_metadata(), {"count": "1"})
+    # Uploads and metadata files aren't listed
+    self.assertEqual(len(self.database.get_entries("table1")), 2)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,40 @@
+import inspect
+import os
+import sys
+import unittest
+from iterator import OffsetBounds
+from tutils import TestEntry
+from typing import Any, Optional
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir + "/formats")
+import confidence
+
+
+class TestIterator(confidence.Iterator):
+  def __init__(self, entry: TestEntry, offset_bounds: Optional[OffsetBounds], adjust_chunk_size: int, read_chunk_size: int):
+    self.adjust_chunk_size = adjust_chunk_size
+    self.read_chunk_size = read_chunk_size
+    confidence.Iterator.__init__(self, entry, offset_bounds)
+
+
+class IteratorMethods(unittest.TestCase):
+  def test_fraction(self):
+    lines = ["a\tb\tc\td\te\tf\tg\th\ti\tq-value"]
+    lines += list(map(lambda q: "1\t2\t3\t4\t5\t6\t7\t8\t9\t{0:s}".format(q), ["0.001", "0.5", "0.01", "0.2", "0.005"]))
+    entry = TestEntry("test.confidence", "\n".join(lines) + "\n")
+
+    # The header isn't counted
+    it = TestIterator(entry, None, 1000, 1000)
+    self.assertEqual(it.fraction(confidence.Identifiers.qvalue), (3, 1))
+
+    # Requires multiple passes
+    it = TestIterator(entry, None, 40, 40)
+    [count, total] = it.fraction(confidence.Identifiers.qvalue)
+    self.assertEqual(count, 3)
+    self.assertTrue(total > 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
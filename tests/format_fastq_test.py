@@ -2,7 +2,7 @@ import inspect
 import os
 import sys
 import unittest
-from iterator import OffsetBounds
+from iterator import LineTokenizer, OffsetBounds, RegexTokenizer
 from tutils import TestDatabase, TestEntry
 from typing import Any, Optional
 
@@ -88,6 +88,20 @@ class IteratorMethods(unittest.TestCase):
     self.assertEqual(offset_bounds, OffsetBounds(178, 265))
     self.assertFalse(more)
 
+  def test_tokenizers(self):
+    delimiter = fastq.Iterator.delimiter
+    # Records are found with the regex, and only the offsets with the lines
+    self.assertIsInstance(delimiter.item_tokenizer, RegexTokenizer)
+    self.assertIsInstance(delimiter.offset_tokenizer, LineTokenizer)
+    line: LineTokenizer = LineTokenizer(delimiter)
+    regex: RegexTokenizer = RegexTokenizer(delimiter)
+    content: bytes = b"\n".join(expected_items)
+    # Aligned records, a partial record before the first one, a record without enough lines,
+    # and quality lines that start with the record start
+    for chunk in [content, content[50:], content[:240], b"@a\nAC\n+\n@@\n@b\nGT\n+\n@A", b"x\n@a\nAC\n+\n"]:
+      self.assertEqual(line.last_offset_token(chunk), regex.last_offset_token(chunk))
+    self.assertEqual(list(map(lambda span: content[span[0]:span[1]], delimiter.item_tokenizer.item_spans(content))), expected_items)
+
 
 if __name__ == "__main__":
   unittest.main()
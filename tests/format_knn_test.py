@@ -52,5 +52,25 @@ class IteratorMethods(unittest.TestCase):
                              ])
 
 
+  def test_combine_path(self):
+    # Sorted knn combines keep the k closest neighbors of each point rather than
+    # merging sorted runs, so the k-way merge is never used.
+    class MergeIterator(knn.Iterator):
+      @classmethod
+      def __merge__(cls, runs):
+        raise Exception("MergeIterator::__merge__ should not be called")
+
+    database: TestDatabase = TestDatabase()
+    table1: TestTable = database.create_table("table1")
+    entry1: TestEntry = table1.add_entry("test1.knn", "1.0 2.0 255 123 0,0.100000 0,0.300000 1")
+    entry2: TestEntry = table1.add_entry("test2.knn", "1.0 2.0 255 123 0,0.200000 1")
+    temp_name = "/tmp/ripple_test"
+    with open(temp_name, "wb+") as f:
+      MergeIterator.combine([entry1, entry2], f, {"k": 2, "sort": True})
+
+    with open(temp_name) as f:
+      self.assertEqual(f.read().strip(), "1.0 2.0 255 123 0,0.200000 1,0.100000 0")
+    os.remove(temp_name)
+
 if __name__ == "__main__":
   unittest.main()
@@ -1,15 +1,18 @@
 import inspect
 import os
 import sys
+import tempfile
 import unittest
-from iterator import OffsetBounds
+from iterator import Delimiter, DelimiterPosition, FindTokenizer, ItemIndex, ItemViews, OffsetBounds, RegexTokenizer
 from tutils import TestDatabase, TestEntry, TestTable
-from typing import Any, Optional
+from typing import Any, List, Optional
 
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir + "/formats")
 import new_line
+sys.path.insert(0, parentdir)
+from database import LocalDatabase
 
 
 class TestIterator(new_line.Iterator):
@@ -19,6 +22,18 @@ class TestIterator(new_line.Iterator):
     new_line.Iterator.__init__(self, entry, offset_bounds)
 
 
+class SortedIterator(new_line.Iterator):
+  read_chunk_size = 8
+  write_batch_size = 2
+
+  def __init__(self, entry: TestEntry, offset_bounds: Optional[OffsetBounds] = None):
+    new_line.Iterator.__init__(self, entry, offset_bounds)
+
+  @classmethod
+  def get_identifier_value(cls: Any, item: bytes, identifier: None) -> float:
+    return float(item.split(b" ")[0])
+
+
 class IteratorMethods(unittest.TestCase):
   def test_adjust(self):
     database: TestDatabase = TestDatabase()
@@ -67,6 +82,22 @@ class IteratorMethods(unittest.TestCase):
     self.assertFalse(more)
     self.assertEqual(list(items), [b"1 2 3"])
 
+  def test_local_entry(self):
+    # Windows of a local entry are views of its memory map
+    with tempfile.TemporaryDirectory() as root:
+      database: LocalDatabase = LocalDatabase(root)
+      database.create_table("table1")
+      database.write("table1", "test.new_line", b"A B C\na b c\n1 2 3\n", {}, False)
+      entry = database.get_entry("table1", "test.new_line")
+      it = TestIterator(entry, None, 7, 7)
+      items: List[bytes] = []
+      more = True
+      while more:
+        [window_items, _, more] = it.next()
+        items += list(window_items)
+      self.assertEqual(items, [b"A B C", b"a b c", b"1 2 3"])
+      entry.close()
+
   def test_overflow(self):
     database: TestDatabase = TestDatabase()
     log: TestTable = database.create_table("log")
@@ -100,6 +131,43 @@ class IteratorMethods(unittest.TestCase):
     self.assertEqual(offset_bounds, OffsetBounds(32, 49))
     self.assertFalse(more)
 
+  def test_prefetch(self):
+    database: TestDatabase = TestDatabase()
+    log: TestTable = database.create_table("log")
+    table1: TestTable = database.create_table("table1")
+    entry1: TestEntry = table1.add_entry("test.new_line", "A B C D E F G H\na b c d e f g h\n1 2 3 4 5 6 7 8 9\n")
+
+    expected = []
+    it = TestIterator(entry1, None, 10, 10)
+    more = True
+    while more:
+      [items, offset_bounds, more] = it.next()
+      expected.append((list(items), offset_bounds, more))
+
+    it = TestIterator(entry1, None, 10, 10)
+    it.prefetch(3)
+    more = True
+    actual = []
+    while more:
+      [items, offset_bounds, more] = it.next()
+      actual.append((list(items), offset_bounds, more))
+    self.assertEqual(actual, expected)
+    self.assertEqual(it.prefetch_count, 0)
+
+    # Memory budget of 1 MB with 10 byte windows
+    it = TestIterator(entry1, None, 10, 10)
+    it.prefetch(1000*1000, 1)
+    self.assertEqual(it.prefetch_count, int(250*1000 / 11) - 1)
+    it.stop_prefetch()
+
+    # Stopping before the last window shuts the prefetch down on exit
+    with TestIterator(entry1, None, 10, 10) as it:
+      it.prefetch(3)
+      it.next()
+      self.assertIsNotNone(it.prefetch_executor)
+    self.assertIsNone(it.prefetch_executor)
+    self.assertEqual(len(it.prefetched), 0)
+
   def test_combine(self):
     database: TestDatabase = TestDatabase()
     log: TestTable = database.create_table("log")
@@ -114,10 +182,114 @@ class IteratorMethods(unittest.TestCase):
     with open(temp_name, "wb+") as f:
       new_line.Iterator.combine(entries, f, {})
 
+    with open(temp_name) as f:
+      self.assertEqual(f.read(), "".join(list(map(lambda entry: entry.get_content().decode("utf-8"), entries))))
+
+    with open(temp_name, "wb+") as f:
+      new_line.Iterator.combine(entries, f, {"prefetch": 2})
+
     with open(temp_name) as f:
       self.assertEqual(f.read(), "".join(list(map(lambda entry: entry.get_content().decode("utf-8"), entries))))
     os.remove(temp_name)
 
+  def test_sorted_combine(self):
+    database: TestDatabase = TestDatabase()
+    table1: TestTable = database.create_table("table1")
+    table1.add_entry("test1.new_line", "1 a\n4 b\n7 c\n", metadata={"sorted": "True"})
+    table1.add_entry("test2.new_line", "2 d\n4 e\n9 f\n10 g\n", metadata={"sorted": "True"})
+    table1.add_entry("test3.new_line", "", metadata={"sorted": "True"})
+    # Not a sorted run, so it's sorted before it's merged
+    table1.add_entry("test4.new_line", "8 h\n3 i\n", metadata={})
+    entries: List[TestEntry] = database.get_entries(table1.name)
+
+    temp_name = "/tmp/ripple_test"
+    with open(temp_name, "wb+") as f:
+      SortedIterator.combine(entries, f, {"sort": True, "identifier": None})
+
+    with open(temp_name) as f:
+      self.assertEqual(f.read(), "1 a\n2 d\n3 i\n4 b\n4 e\n7 c\n8 h\n9 f\n10 g")
+    os.remove(temp_name)
+
+  def test_index(self):
+    database: TestDatabase = TestDatabase()
+    table1: TestTable = database.create_table("table1")
+    with database.writer(table1.name, "test.new_line", {}) as f:
+      SortedIterator.write_array(iter([b"1 a", b"2 bb", b"3 c", b"4 dd", b"5 e"]), f, {"index": True, "identifier": None})
+      f.close()
+    entry: TestEntry = database.get_entry(table1.name, "test.new_line")
+    self.assertEqual(entry.get_content(), b"1 a\n2 bb\n3 c\n4 dd\n5 e")
+
+    index = ItemIndex.from_bytes(entry.get_index())
+    self.assertEqual(index.starts, [0, 4, 9, 13, 18])
+    self.assertEqual(index.ends, [3, 8, 12, 17, 21])
+    self.assertEqual(index.identifier, "None")
+    self.assertEqual(index.values, [1.0, 2.0, 3.0, 4.0, 5.0])
+
+    # Splits start at an item, and each item is read once
+    ranges = index.split(8, entry.content_length())
+    self.assertEqual(ranges, [(0, 8), (9, 17), (18, 20)])
+    items = []
+    for [start_index, end_index] in ranges:
+      it = SortedIterator(entry, OffsetBounds(start_index, end_index))
+      items += list(it.get(it.get_start_index(), it.get_end_index()))
+    self.assertEqual(items, [b"1 a", b"2 bb", b"3 c", b"4 dd", b"5 e"])
+
+    # Bounds that aren't aligned go to the item their start is in
+    it = SortedIterator(entry, OffsetBounds(2, 10))
+    self.assertEqual(list(it.get(it.get_start_index(), it.get_end_index())), [b"2 bb", b"3 c"])
+
+  def test_index_combine(self):
+    database: TestDatabase = TestDatabase()
+    table1: TestTable = database.create_table("table1")
+    table1.add_entry("test1.new_line", "1 a\n2 b\n")
+    table1.add_entry("test2.new_line", "\n3 c\n4 d")
+    entries: List[TestEntry] = database.get_entries(table1.name)
+    with database.writer(table1.name, "combined.new_line", {}) as f:
+      SortedIterator.combine(entries, f, {"index": True})
+      f.close()
+    entry: TestEntry = database.get_entry(table1.name, "combined.new_line")
+    index = ItemIndex.from_bytes(entry.get_index())
+    content: bytes = entry.get_content()
+    self.assertEqual(list(map(lambda i: content[index.starts[i]:index.ends[i]], range(len(index)))), [b"1 a", b"2 b", b"3 c", b"4 d"])
+    self.assertIsNone(index.values)
+
+  def test_item_views(self):
+    content = b"1 a\n\n2 b\n3 c\n4 d\n"
+    items = new_line.Iterator.to_array(content)
+    self.assertIsInstance(items, ItemViews)
+    self.assertEqual(list(items), [b"1 a", b"2 b", b"3 c", b"4 d"])
+    self.assertEqual(items.buffer, content)
+
+    # Adjacent items are written with one slice of the buffer
+    views = items.take([1, 2, 3, 0])
+    self.assertEqual(list(views.__runs__(b"\n")), [(5, 16), (0, 3)])
+    self.assertEqual(views.join(b"\n"), b"2 b\n3 c\n4 d\n1 a")
+    temp_name = "/tmp/ripple_test"
+    with open(temp_name, "wb+") as f:
+      new_line.Iterator.from_array(views, f, {})
+    with open(temp_name, "rb") as f:
+      self.assertEqual(f.read(), b"2 b\n3 c\n4 d\n1 a")
+    os.remove(temp_name)
+    self.assertEqual(new_line.Iterator.from_array(views, None, {})[0], b"2 b\n3 c\n4 d\n1 a")
+
+  def test_tokenizers(self):
+    self.assertIsInstance(new_line.Iterator.delimiter.item_tokenizer, FindTokenizer)
+    self.assertIsInstance(Delimiter("\n", "\n", DelimiterPosition.inbetween, regex="(.*)").item_tokenizer, RegexTokenizer)
+    delimiters = [
+      new_line.Iterator.delimiter,
+      # Only counts at the start of a line
+      Delimiter(">", ">", DelimiterPosition.start),
+      # Matches can overlap
+      Delimiter("\n\n", "\n\n", DelimiterPosition.inbetween),
+      Delimiter("</s>\n", "</s>\n", DelimiterPosition.end),
+    ]
+    for delimiter in delimiters:
+      find: FindTokenizer = FindTokenizer(delimiter)
+      regex: RegexTokenizer = RegexTokenizer(delimiter)
+      for content in [b"", b"\n", b"a>b\n>c\n\n\n>d", b"\n\n\na\n\n\n\nb\n", b"<s>a</s>\n \n<s>b</s>\n<s>c"]:
+        self.assertEqual(find.item_spans(content), regex.item_spans(content))
+        self.assertEqual(find.last_offset_token(content), regex.last_offset_token(content))
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -73,6 +73,32 @@ class PivotMethods(unittest.TestCase):
       self.assertEqual(f.read(), "{0:s}\nkey3\n1.0\t81.0".format(table1.name))
     os.remove(temp_name)
 
+  def test_combine_merge(self):
+    class MergeIterator(pivot.Iterator):
+      merges: ClassVar[int] = 0
+
+      @classmethod
+      def __merge__(cls, runs):
+        cls.merges += 1
+        return pivot.Iterator.__merge__(runs)
+
+    database: TestDatabase = TestDatabase()
+    table1: TestTable = database.create_table("table1")
+    table1.add_entry("test1.pivot", "bucket1\nkey1\n1\t5\t20\t25\t60")
+    table1.add_entry("test2.pivot", "bucket1\nkey2\n5\t10\t12\t25\t61\t70\t80")
+    table1.add_entry("test3.pivot", "bucket1\nkey3\n")
+    entries: List[TestEntry] = database.get_entries(table1.name)
+
+    # Pivots in more than one file are only counted once
+    temp_name = "/tmp/ripple_test"
+    with open(temp_name, "wb+") as f:
+      MergeIterator.combine(entries, f, {})
+    self.assertEqual(MergeIterator.merges, 1)
+
+    with open(temp_name) as f:
+      self.assertEqual(f.read(), "bucket1\nkey3\n1.0\t5.0\t10.0\t12.0\t20.0\t25.0\t60.0\t61.0\t70.0\t80.0")
+    os.remove(temp_name)
+
   def test_combine_edge_case(self):
     # If we always increment by an integer amount, we may run into the
     # case where the last bin has significantly less values than the rest
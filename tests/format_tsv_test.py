@@ -3,7 +3,7 @@ import os
 import sys
 import unittest
 from iterator import OffsetBounds
-from tutils import TestEntry
+from tutils import TestDatabase, TestEntry, TestTable
 from typing import Any, Optional
 
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -57,6 +57,48 @@ class IteratorMethods(unittest.TestCase):
       self.assertEqual(f.read(), "HEADER\nA\tB\tC\na\tb\tc\n1\t2\t3\nD\tE\tF\nd\te\tf\n4\t5\t6\nG\tH\tI\ng\th\ti\n7\t8\t9\nJ\tK\tL\nj\tk\tl\n10\t11\t12\n")
     os.remove(temp_name)
 
+  def test_server_side_combine(self):
+    database: TestDatabase = TestDatabase()
+    database.min_part_size = 4
+    database.part_size = 8
+    table1: TestTable = database.create_table("table1")
+    entry1 = table1.add_entry("test1.tsv", "HEADER\nA\tB\tC\na\tb\tc\n1\t2\t3")
+    entry2 = table1.add_entry("test2.tsv", "HEADER\nD\tE\tF\nd\te\tf\n4\t5\t6\n")
+    entry3 = table1.add_entry("test3.tsv", "")
+    entry4 = table1.add_entry("test4.tsv", "HEADER\nJ\tK\tL\nj\tk\tl\n10\t11\t12\n")
+    entries = [entry1, entry2, entry3, entry4]
+
+    temp_name = "/tmp/ripple_test"
+    with open(temp_name, "wb+") as f:
+      tsv.Iterator.combine(entries, f, {})
+    with open(temp_name, "rb") as f:
+      expected: bytes = f.read()
+    os.remove(temp_name)
+
+    with database.writer(table1.name, "output.tsv", {}) as f:
+      tsv.Iterator.combine(entries, f, {"server_side": True})
+    self.assertEqual(database.get_entry(table1.name, "output.tsv").get_content(), expected)
+    self.assertEqual(database.copy_count, 3)
+    database.destroy()
+
+  def test_column_values(self):
+    content = b"a\t1.5\tx\n\nb\t-2\ty\r\nc\t3e2\n"
+    values = tsv.Iterator.__column_values__(content, 1, b"\t", None)
+    self.assertEqual(list(values), [1.5, -2.0, 300.0])
+
+    # Items are parsed the same way as content
+    values = tsv.Iterator.__column_values__([b"a\t1.5", b"b\t-2"], 1, b"\t", None)
+    self.assertEqual(list(values), [1.5, -2.0])
+
+    # The last column ends at the end of the line
+    values = tsv.Iterator.__column_values__(b"1\t2\n3\t4", 1, b"\t", None)
+    self.assertEqual(list(values), [2.0, 4.0])
+    values = tsv.Iterator.__column_values__(b"1\t2\n3\t4", 0, b"\t", None)
+    self.assertEqual(list(values), [1.0, 3.0])
+
+    with self.assertRaises(Exception):
+      tsv.Iterator.__column_values__(b"1\t2\n3\n", 1, b"\t", None)
+
 
 if __name__ == "__main__":
   unittest.main()
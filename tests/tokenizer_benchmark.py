@@ -0,0 +1,92 @@
+import inspect
+import os
+import random
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+sys.path.insert(0, parentdir + "/formats")
+import blast
+import fasta
+import fastq
+import mzML
+import new_line
+from iterator import Delimiter, RegexTokenizer, Tokenizer
+
+# Measures the throughput of every tokenizer that supports the delimiter of each format.
+# Delimiter.item_tokenizers and Delimiter.offset_tokenizers list the tokenizers in the order measured here,
+# and the selected ones are marked with *.
+# Usage: python3 tests/tokenizer_benchmark.py [size in MB]
+
+
+def sequence(length: int) -> str:
+  return "".join(map(lambda _: random.choice("ACGT"), range(length)))
+
+
+def new_line_content(count: int) -> bytes:
+  return "\n".join(map(lambda i: "chr1\t{0:d}\t{1:d}\t{2:s}".format(i, i + 100, sequence(20)), range(count))).encode()
+
+
+def fasta_content(count: int) -> bytes:
+  return "".join(map(lambda i: ">sequence{0:d}\n{1:s}\n{2:s}\n".format(i, sequence(60), sequence(40)), range(count))).encode()
+
+
+def fastq_content(count: int) -> bytes:
+  return "\n".join(map(lambda i: "@cluster_{0:d}:UMI_GCAGGA\n{1:s}\n+\n{2:s}".format(i, sequence(31), "8;;;>DC@DAC=B?C@9?B?CDCB@><<??A"), range(count))).encode()
+
+
+def blast_content(count: int) -> bytes:
+  return "\n\n".join(map(lambda i: "target_name: {0:d}\nquery_name: {0:d}\noptimal_alignment_score: {1:d} suboptimal_alignment_score: 9".format(i, i % 500), range(count))).encode()
+
+
+def mzML_content(count: int) -> bytes:
+  spectrum = '<spectrum index="{0:d}" id="scan={0:d}"><cvParam name="ms level" value="2"/></spectrum>\n'
+  return "".join(map(lambda i: spectrum.format(i), range(count))).encode()
+
+
+formats: Dict[str, Any] = {
+  "blast": (blast.Iterator.delimiter, blast_content),
+  "fasta": (fasta.Iterator.delimiter, fasta_content),
+  "fastq": (fastq.Iterator.delimiter, fastq_content),
+  "mzML": (mzML.Iterator.delimiter, mzML_content),
+  "new_line": (new_line.Iterator.delimiter, new_line_content),
+}
+
+
+def throughput(f: Callable[[], Any], length: int) -> float:
+  # Best of 3 runs, in MB/s
+  best: float = float("inf")
+  for _ in range(3):
+    start_time: float = time.time()
+    f()
+    best = min(best, time.time() - start_time)
+  return length / max(best, 1e-9) / 1000 / 1000
+
+
+def main():
+  size: float = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+  for [name, [delimiter, create]] in sorted(formats.items()):
+    content: bytes = create(1000)
+    content = create(int(size * 1000 * 1000 * 1000 / len(content)))
+    expected_spans = RegexTokenizer(delimiter).item_spans(content)
+    expected_offset: int = RegexTokenizer(delimiter).last_offset_token(content)
+    tokenizer_classes: List[Any] = Delimiter.item_tokenizers + list(filter(lambda tokenizer: tokenizer not in Delimiter.item_tokenizers, Delimiter.offset_tokenizers))
+    for tokenizer_class in filter(lambda tokenizer: tokenizer.supports(delimiter), tokenizer_classes):
+      tokenizer: Tokenizer = tokenizer_class(delimiter)
+      assert(tokenizer.last_offset_token(content) == expected_offset)
+      offsets: float = throughput(lambda: tokenizer.last_offset_token(content), len(content))
+      offset_selected: str = "*" if type(tokenizer) == type(delimiter.offset_tokenizer) else " "
+      # Offset tokenizers such as LineTokenizer don't split chunks into items
+      items: str = "{0:>10s}     ".format("-")
+      item_selected: str = " "
+      if tokenizer_class in Delimiter.item_tokenizers:
+        assert(tokenizer.item_spans(content) == expected_spans)
+        items = "{0:10.1f} MB/s".format(throughput(lambda: tokenizer.item_spans(content), len(content)))
+        item_selected = "*" if type(tokenizer) == type(delimiter.item_tokenizer) else " "
+      print("{0:10s} {1:6s} items {2:s}{3:s}  last offset {4:10.1f} MB/s{5:s}".format(name, tokenizer.name, items, item_selected, offsets, offset_selected))
+
+if __name__ == "__main__":
+  main()
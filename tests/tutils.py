@@ -1,14 +1,15 @@
 import inspect
 import os
+import shutil
 import sys
 import time
-from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Set, Union
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 import database
-from database import Database, Entry, Statistics, S3, Table
+from database import Database, Entry, LocalCoordinator, Statistics, S3, Table
 
 
 def equal_lists(list1, list2):
@@ -44,7 +45,7 @@ def create_payload(table_name: str, key: str, prefix: int, file_id: Optional[int
 
 
 class TestEntry(Entry):
-  def __init__(self, key: str, content: Optional[Union[str, bytes]], statistics: Optional[database.Statistics]=None):
+  def __init__(self, key: str, content: Optional[Union[str, bytes]], statistics: Optional[database.Statistics]=None, metadata: Optional[Dict[str, str]]=None):
     self.file_name = key.replace("/tmp/s3/", "")
     self.file_name = key.replace("/tmp/", "")
     self.file_name = self.file_name.replace("/", "-")
@@ -52,6 +53,8 @@ class TestEntry(Entry):
     if statistics is None:
       statistics = Statistics()
     Entry.__init__(self, key, None, statistics)
+    self.index: Optional[bytes] = None
+    self.metadata = metadata if metadata is not None else {}
 
     if content is not None:
       if type(content) == str:
@@ -74,12 +77,15 @@ class TestEntry(Entry):
     with open(self.file_name, "rb") as f:
       return f.read()
 
+  def __get_index__(self) -> Optional[bytes]:
+    return self.index
+
   def __get_range__(self, start_index: int, end_index: int) -> bytes:
     with open(self.file_name, "rb") as f:
       f.seek(start_index)
       return f.read(end_index - start_index + 1)
 
-  def content_length(self) -> int:
+  def __content_length__(self) -> int:
     return self.length
 
   def destroy(self):
@@ -87,7 +93,7 @@ class TestEntry(Entry):
       os.remove(self.file_name)
 
   def get_metadata(self) -> Dict[str, str]:
-    return {}
+    return self.metadata
 
   def last_modified_at(self) -> float:
     return self.last_modified
@@ -99,9 +105,11 @@ class TestTable(Table):
   def __init__(self, name: str, statistics: database.Statistics, resources: Any):
     Table.__init__(self, name, statistics, resources)
     self.entries = {}
+    self.indexes: Dict[str, bytes] = {}
 
-  def add_entry(self, key: str, content: Union[str, bytes]) -> TestEntry:
-    entry = TestEntry(key, content, self.statistics)
+  def add_entry(self, key: str, content: Union[str, bytes], metadata: Optional[Dict[str, str]]=None) -> TestEntry:
+    entry = TestEntry(key, content, self.statistics, metadata)
+    entry.index = self.indexes.get(key)
     self.entries[key] = entry
     return entry
 
@@ -117,19 +125,42 @@ class TestTable(Table):
 class TestDatabase(S3):
   payloads: List[Dict[str, Any]]
   tables: Dict[str, TestTable]
+  uploads: Dict[str, Dict[int, bytes]]
 
   def __init__(self):
     Database.__init__(self)
     self.params = {}
     self.payloads = []
+    self.copy_count = 0
+    self.replace_count = 0
     self.tables = {}
+    self.upload_count = 0
+    self.upload_metadata: Dict[str, Dict[str, str]] = {}
+    self.uploads = {}
     if not os.path.isdir("/tmp/s3"):
       os.mkdir("/tmp/s3")
-
-  def __download__(self, table_name: str, key: str, f: BinaryIO) -> int:
-    entry: TestEntry = self.get_entry(table_name, key)
-    assert(entry is not None)
-    return entry.download(f)
+    # The manifest directory is only created once a barrier is used
+    self.manifest_root = "/tmp/s3/manifest-{0:d}-{1:d}".format(os.getpid(), id(self))
+    self.coordinator = LocalCoordinator(self.manifest_root)
+
+  def __abort_upload__(self, table_name: str, key: str, upload_id: str):
+    del self.uploads[upload_id]
+
+  def __complete_upload__(self, table_name: str, key: str, upload_id: str, parts: List[Dict[str, Any]], metadata: Optional[Dict[str, str]], invoke: bool):
+    upload: Dict[int, bytes] = self.uploads.pop(upload_id)
+    part_numbers: List[int] = list(map(lambda part: part["PartNumber"], parts))
+    assert(part_numbers == list(range(1, len(upload) + 1)))
+    content: bytes = b"".join(map(lambda part_number: upload[part_number], part_numbers))
+    if metadata is not None:
+      self.replace_count += 1
+    self.__write__(table_name, key, content, metadata if metadata is not None else self.upload_metadata.pop(upload_id))
+
+  def __create_upload__(self, table_name: str, key: str, metadata: Dict[str, str]) -> str:
+    self.upload_count += 1
+    upload_id: str = "{0:s}/{1:s}/{2:d}".format(table_name, key, self.upload_count)
+    self.uploads[upload_id] = {}
+    self.upload_metadata[upload_id] = metadata
+    return upload_id
 
   def __get_content__(self, table_name: str, key: str, start_byte: int, end_byte: int) -> bytes:
     content: str = self.get_entry(table_name, key).content
@@ -142,14 +173,31 @@ class TestDatabase(S3):
     entries = list(map(lambda key: self.tables[table_name].entries[key], keys))
     return sorted(entries, key=lambda entry: entry.key)
 
+  def __get_entries_page__(self, table_name: str, prefix: Optional[str], token: Optional[str]) -> Tuple[List[TestEntry], Optional[str]]:
+    return (self.__get_entries__(table_name, prefix), None)
+
   def __put__(self, table_name: str, key: str, f: BinaryIO, metadata: Dict[str, str], invoke=False):
     self.__write__(table_name, key, f.read(), metadata)
 
   def __read__(self, table_name: str, key: str) -> str:
     return self.get_entry(table_name, key).content
 
+  def __upload_part__(self, table_name: str, key: str, upload_id: str, part_number: int, content: bytes) -> str:
+    self.uploads[upload_id][part_number] = content
+    return str(part_number)
+
+  def __upload_part_copy__(self, table_name: str, key: str, upload_id: str, part_number: int, entry: Entry, start_index: int, end_index: int) -> str:
+    self.copy_count += 1
+    with open(entry.file_name, "rb") as f:
+      f.seek(start_index)
+      self.uploads[upload_id][part_number] = f.read(end_index - start_index + 1)
+    return str(part_number)
+
+  def __write_index__(self, table_name: str, key: str, content: bytes):
+    self.tables[table_name].indexes[key] = content
+
   def __write__(self, table_name: str, key: str, content: bytes, metadata: Dict[str, str], invoke=False):
-    self.add_entry(table_name, key, content)
+    self.tables[table_name].add_entry(key, content, metadata)
     if not key.endswith(".log"):
       self.payloads.append({
         "Records": [{
@@ -185,15 +233,19 @@ class TestDatabase(S3):
   def destroy(self):
     for table in self.tables.values():
       table.destroy()
+    shutil.rmtree(self.manifest_root, ignore_errors=True)
 
-  def get_entry(self, table_name: str, key: str) -> Optional[TestEntry]:
+  def get_entry(self, table_name: str, key: str) -> Optional[Entry]:
+    entry: Optional[Entry] = self.entries.get((table_name, key))
+    if entry is not None:
+      return entry
     table: TestTable = self.tables[table_name]
     if key in table.entries:
       return table.entries[key]
     return None
 
-  def invoke(self, name, payload):
-    self.payloads.append(payload)
+  def __invoke__(self, name, payload):
+    pass
 
 
 class Context: